@@ -12,6 +12,9 @@
 import os
 import time
 import argparse
+import sqlite3
+import json
+import hashlib
 
 import numpy as np
 from astropy import log
@@ -21,6 +24,7 @@ from scipy import signal, ndimage
 import matplotlib.pyplot as plt
 
 import precisionguide as pg
+import stage_timing
 
 # Constants for use in code
 # Measured in /data/io/IoIO/observing/Exposure_Time_Calcs.xlsx
@@ -49,6 +53,253 @@ run_level_default_ND_params \
 # Temporary set to 2 during really hazy weather 
 guider_nd_Filter_number = 3
 
+# back_level method, either 'cwt' (the original find_peaks_cwt
+# histogram method) or 'bincount' (fast equivalent)
+back_level_method = 'cwt'
+# back_level_bincount parameters: fraction of pixels, counted from the
+# bottom, that are considered part of the low end of the histogram;
+# Gaussian smoothing of the histogram in units of readnoise; and
+# minimum peak height, relative to the highest peak
+back_level_low_end = 0.99
+back_level_smooth = 3
+back_level_min_peak = 0.1
+
+# Number of largest peaks per strip CorObsData.ND_edges_batch
+# considers when looking for the pair of ND filter edges in non-flat
+# images
+ND_batch_npeaks = 8
+
+# ND filter masks are full-frame boolean arrays which are expensive to
+# build and are asked for several times per image (e.g. 3 CorObsData
+# per pair in ReduceCorObs.reduce_pair).  Keep a handful of them
+# around, keyed by everything that goes into their construction
+ND_mask_cache_size = 8
+_ND_mask_cache = {}
+
+def ND_mask(ND_params, shape, edge_mask=0):
+    """Returns boolean mask of ND filter pixels
+
+    Parameters
+    ----------
+    ND_params : array-like (2, 2)
+        Slopes and intercepts of the ND filter edges (see
+        CorObsData.ND_params), unbinned coordinates
+
+    shape : tuple
+        Unbinned (Y, X) shape of image
+
+    edge_mask : int
+        Number of pixels to shave off (positive) or add to (negative)
+        each side of the ND filter
+
+    The mask is cached and returned read-only, so copy it before
+    modifying it
+    """
+    ND_params = np.asarray(ND_params, dtype=float)
+    shape = tuple(int(s) for s in shape)
+    key = (tuple(ND_params.flatten()), shape, edge_mask)
+    mask = _ND_mask_cache.get(key)
+    if mask is not None:
+        return mask
+    # Calculate the ND filter edges for every row in one shot.  Note
+    # that astype(int) truncates toward 0, just like the original
+    # row-by-row calculation did
+    iy = np.arange(shape[0])
+    bounds = (ND_params[1,:]
+              + ND_params[0,:]*(iy[:, np.newaxis] - shape[0]/2)
+              + np.asarray((edge_mask, -edge_mask)))
+    bounds = bounds.astype(int)
+    # Do a sanity check.  Note C order of indices
+    if np.any(bounds[:,1] > shape[1]):
+        raise ValueError('X dimension of image is smaller than position of ND filter!  Subimaging/binning mismatch?')
+    ix = np.arange(shape[1])
+    mask = np.logical_and(ix >= bounds[:, 0:1], ix < bounds[:, 1:2])
+    mask.setflags(write=False)
+    if len(_ND_mask_cache) >= ND_mask_cache_size:
+        # Dictionaries keep insertion order, so this drops the oldest
+        del _ND_mask_cache[next(iter(_ND_mask_cache))]
+    _ND_mask_cache[key] = mask
+    return mask
+
+# Bump this whenever a change to CorObsData would change ND_params,
+# obj_center or quality so that NDParamsCache entries are invalidated
+ND_algorithm_version = '3'
+
+class NDParamsCache():
+    """On-disk cache of CorObsData results
+
+    Maps raw-file identity (absolute path, size and modification
+    time) plus the CorObsData parameters that affect the calculation
+    to ND_params, obj_center and quality.  Entries recorded with a
+    different ND_algorithm_version are ignored and overwritten.  Only
+    the SQLite filename is stored in the object, so it can be passed
+    freely to multiprocessing workers
+
+    Parameters
+    ----------
+    fname : str
+        SQLite database filename.  Created if it does not exist
+    """
+    def __init__(self, fname):
+        self.fname = fname
+
+    def connect(self):
+        d = os.path.dirname(self.fname)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        # Generous timeout, since many Pool workers write at once
+        con = sqlite3.connect(self.fname, timeout=60)
+        con.execute('CREATE TABLE IF NOT EXISTS ND_params '
+                    '(fname TEXT, phash TEXT, size INTEGER, '
+                    'mtime INTEGER, version TEXT, ND_params TEXT, '
+                    'obj_center TEXT, quality INTEGER, '
+                    'back_level REAL, '
+                    'PRIMARY KEY (fname, phash))')
+        columns = [c[1] for c in con.execute('PRAGMA table_info(ND_params)')]
+        if 'back_level' not in columns:
+            # Table from before back_level was cached.  Those rows have
+            # an older ND_algorithm_version, so they will be replaced
+            con.execute('ALTER TABLE ND_params ADD COLUMN back_level REAL')
+        return con
+
+    @staticmethod
+    def param_hash(params):
+        """Returns hash of dictionary of parameters"""
+        p = json.dumps(params, sort_keys=True,
+                       default=lambda o: np.asarray(o).tolist())
+        return hashlib.sha1(p.encode()).hexdigest()
+
+    def get(self, fname, params):
+        """Returns dictionary with keys ND_params, obj_center, quality
+        and back_level if fname has been processed with params before
+        or None if not.  ND_params of None means a previous calculation
+        failed"""
+        try:
+            st = os.stat(fname)
+            con = self.connect()
+            with con:
+                row = con.execute(
+                    'SELECT size, mtime, version, ND_params, obj_center, '
+                    'quality, back_level FROM ND_params '
+                    'WHERE fname=? AND phash=?',
+                    (os.path.abspath(fname),
+                     self.param_hash(params))).fetchone()
+            con.close()
+        except (OSError, sqlite3.Error) as e:
+            log.warning('ND_params cache ' + self.fname
+                        + ' not available: ' + str(e))
+            return None
+        if (row is None
+            or row[0] != st.st_size
+            or row[1] != st.st_mtime_ns
+            or row[2] != ND_algorithm_version):
+            return None
+        return {'ND_params': json.loads(row[3]),
+                'obj_center': json.loads(row[4]),
+                'quality': row[5],
+                'back_level': row[6]}
+
+    def put(self, fname, params,
+            ND_params=None, obj_center=None, quality=None,
+            back_level=None):
+        """Record results of processing fname with params"""
+        try:
+            st = os.stat(fname)
+            con = self.connect()
+            with con:
+                con.execute(
+                    'INSERT OR REPLACE INTO ND_params VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (os.path.abspath(fname),
+                     self.param_hash(params),
+                     st.st_size,
+                     st.st_mtime_ns,
+                     ND_algorithm_version,
+                     json.dumps(None if ND_params is None
+                                else np.asarray(ND_params).tolist()),
+                     json.dumps(None if obj_center is None
+                                else np.asarray(obj_center).tolist()),
+                     None if quality is None else int(quality),
+                     None if back_level is None else float(back_level)))
+            con.close()
+        except (OSError, sqlite3.Error) as e:
+            log.warning('Could not write to ND_params cache ' + self.fname
+                        + ': ' + str(e))
+
+# Bump this whenever a change to back_level would change its results
+# so that BackLevelCache entries are invalidated
+back_level_version = '1'
+
+class BackLevelCache():
+    """On-disk index of per-file background statistics
+
+    Maps raw-file identity (absolute path, size and modification
+    time) and back_level method to the JD of the observation and its
+    back_level, so that a night's background can be modeled without
+    opening its files again.  Like NDParamsCache, only the SQLite
+    filename is stored in the object
+
+    Parameters
+    ----------
+    fname : str
+        SQLite database filename.  Created if it does not exist
+    """
+    def __init__(self, fname):
+        self.fname = fname
+
+    def connect(self):
+        d = os.path.dirname(self.fname)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        con = sqlite3.connect(self.fname, timeout=60)
+        con.execute('CREATE TABLE IF NOT EXISTS back_level '
+                    '(fname TEXT, method TEXT, size INTEGER, '
+                    'mtime INTEGER, version TEXT, jd REAL, '
+                    'back_level REAL, '
+                    'PRIMARY KEY (fname, method))')
+        return con
+
+    def get(self, fnames, method):
+        """Returns dictionary keyed by those of fnames that have a
+        current entry for method of (jd, back_level)"""
+        found = {}
+        try:
+            con = self.connect()
+            with con:
+                for f in fnames:
+                    row = con.execute(
+                        'SELECT size, mtime, version, jd, back_level '
+                        'FROM back_level WHERE fname=? AND method=?',
+                        (os.path.abspath(f), method)).fetchone()
+                    if row is None or row[2] != back_level_version:
+                        continue
+                    st = os.stat(f)
+                    if (row[0] == st.st_size
+                        and row[1] == st.st_mtime_ns):
+                        found[f] = (row[3], row[4])
+            con.close()
+        except (OSError, sqlite3.Error) as e:
+            log.warning('back_level cache ' + self.fname
+                        + ' not available: ' + str(e))
+        return found
+
+    def put(self, fname, method, jd, back_level):
+        """Record (jd, back_level) of fname measured with method"""
+        try:
+            st = os.stat(fname)
+            con = self.connect()
+            with con:
+                con.execute(
+                    'INSERT OR REPLACE INTO back_level VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?)',
+                    (os.path.abspath(fname), method,
+                     st.st_size, st.st_mtime_ns, back_level_version,
+                     float(jd), float(back_level)))
+            con.close()
+        except (OSError, sqlite3.Error) as e:
+            log.warning('Could not write to back_level cache ' + self.fname
+                        + ': ' + str(e))
+
 def hist_of_im(im, readnoise=None):
     """Returns a tuple of the histogram of image and index into centers of
 bins."""
@@ -66,7 +317,7 @@ bins."""
     #plt.show()
     return (hist, centers)
 
-def back_level(im, readnoise=None):
+def back_level(im, readnoise=None, method=None):
     # Use the histogram technique to spot the bias level of the image.
     # The coronagraph creates a margin of un-illuminated pixels on the
     # CCD.  These are great for estimating the bias and scattered
@@ -76,10 +327,65 @@ def back_level(im, readnoise=None):
     # --> This is very specific to the coronagraph.  Consider porting first peak find from IDL
     # --> histogram is wrong because readnoise units are in electrons, not ADU
     # --> consider making find_peaks_cwt args relative to readnoise
+    # method='bincount' is a much faster equivalent
+    if method is None:
+        method = back_level_method
+    if method == 'bincount':
+        return back_level_bincount(im, readnoise)
+    if method != 'cwt':
+        raise ValueError('Unknown back_level method ' + str(method))
     im_hist, im_hist_centers = hist_of_im(im, readnoise)
     im_peak_idx = signal.find_peaks_cwt(im_hist, np.arange(10, 50))
     return im_hist_centers[im_peak_idx[0]]
 
+def back_level_bincount(im, readnoise=None):
+    """Fast version of back_level.  Histograms the image 1 ADU at a time
+    with np.bincount (raw data are uint16), smooths the histogram
+    on the scale of the readnoise and returns the first significant
+    peak in the low end of the histogram"""
+    data = np.asarray(im).ravel()
+    if not np.issubdtype(data.dtype, np.integer):
+        data = np.round(data).astype(int)
+    offset = data.min()
+    counts = np.bincount(data - offset)
+    return back_level_counts(counts, offset, readnoise)
+
+def back_level_counts(counts, offset=0, readnoise=None):
+    """back_level_bincount of a histogram of 1 ADU bins, the first of
+    which is at offset ADU.  Lets the histogram be accumulated a piece
+    of the image at a time"""
+    if readnoise is None:
+        readnoise = global_readnoise
+    # Leading and trailing empty bins make no difference to the
+    # histogram of the whole image
+    nz = np.flatnonzero(counts)
+    counts = counts[nz[0]:nz[-1]+1]
+    offset += nz[0]
+    # Restrict ourselves to the low end of the histogram, dropping
+    # bright pixels from Jupiter, stars, etc., which would otherwise
+    # stretch our histogram out to the saturation level
+    cum = np.cumsum(counts)
+    top = np.searchsorted(cum, back_level_low_end * cum[-1]) + 1
+    counts = counts[0:top]
+    # find_peaks_cwt in back_level smooths with widths of 10 - 50
+    # readnoise-sized bins.  Do something similar, but cheaper
+    smoothed = ndimage.gaussian_filter1d(counts.astype(float),
+                                         back_level_smooth * readnoise,
+                                         mode='constant')
+    is_peak = np.zeros(smoothed.shape, bool)
+    is_peak[1:-1] = np.logical_and(smoothed[1:-1] > smoothed[0:-2],
+                                   smoothed[1:-1] >= smoothed[2:])
+    # Ignore little wiggles from isolated dead/hot pixels
+    is_peak = np.logical_and(is_peak,
+                             smoothed > back_level_min_peak
+                             * np.max(smoothed))
+    peak_idx = np.flatnonzero(is_peak)
+    if peak_idx.size == 0:
+        # Histogram is monotonic, which means our peak is right at
+        # one end or the other
+        peak_idx = [np.argmax(smoothed)]
+    return float(offset + peak_idx[0])
+
 class CorObsData(pg.ObsData):
     """Object for containing coronagraph image data used for centering Jupiter
     """
@@ -102,6 +408,8 @@ class CorObsData(pg.ObsData):
                  max_parallel_delta_pix=50, # Find 2 lines inconsistent
                  max_ND_width_range=[80,400], # jump-starting flats & sanity check others
                  biasnoise=20, # std of a typical bias image
+                 ND_edge_finder='batch', # or 'cwt' for find_peaks_cwt
+                 ND_cache=None, # NDParamsCache or its filename
                  plot_prof=False,
                  plot_dprof=False,
                  plot_ND_edges=False):
@@ -154,6 +462,10 @@ class CorObsData(pg.ObsData):
         self.max_parallel_delta_pix = max_parallel_delta_pix
         self.max_ND_width_range	    = max_ND_width_range
         self.biasnoise		    = biasnoise
+        self.ND_edge_finder         = ND_edge_finder
+        if isinstance(ND_cache, str):
+            ND_cache = NDParamsCache(ND_cache)
+        self.ND_cache               = ND_cache
         self.plot_prof		    = plot_prof 
         self.plot_dprof             = plot_dprof
         self.plot_ND_edges	    = plot_ND_edges
@@ -169,6 +481,8 @@ class CorObsData(pg.ObsData):
         self._ND_params = None
         # These are the coordinates into the ND filter
         self._ND_coords = None
+        # Boolean mask of the ND filter, equivalent to _ND_coords
+        self._ND_mask = None
         # Angle is the (average) angle of the lines, useful for cases
         # where the filter is rotated significantly off of 90 degrees
         # (which is where I will run it frequently)
@@ -179,6 +493,10 @@ class CorObsData(pg.ObsData):
         # calls populate_obj, and cleanup methods
         super().__init__(HDUList_im_or_fname)
 
+    def read_im(self, HDUList_im_or_fname=None):
+        with stage_timing.stage('read'):
+            return super().read_im(HDUList_im_or_fname)
+
     def populate_obj(self):
         """Calculate quantities that will be stored long-term in object"""
         # Note that if MaxIm is not configured to write IRAF-complient
@@ -229,13 +547,74 @@ class CorObsData(pg.ObsData):
             else:
                 self.cwt_width_arange = np.arange(8, 80)
 
+        # See if we have done our work on this file before
+        fname = None
+        if self.ND_cache is not None and self._ND_params is None:
+            fname = self.HDUList.filename()
+        if fname is not None and not self.recalculate:
+            cached = self.ND_cache.get(fname, self.cache_params)
+            if cached is not None and cached['ND_params'] is not None:
+                self._ND_params = np.asarray(cached['ND_params'])
+                self.ND_params_to_header()
+                if cached['obj_center'] is not None:
+                    self._obj_center = np.asarray(cached['obj_center'])
+                    self.quality = cached['quality']
+                    self.obj_center_to_header()
+                # back_level is used after the image is released
+                self._back_level = cached['back_level']
+                # Nothing new to store
+                fname = None
+
         # Do our work & leave the results in the property
-        self.ND_params
-        if self.isflat:
-            return
-        self.obj_center
-        self.desired_center
-        self.obj_to_ND
+        with stage_timing.stage('ND_params'):
+            self.ND_params
+        if not self.isflat:
+            with stage_timing.stage('obj_center'):
+                self.obj_center
+            self.desired_center
+            self.obj_to_ND
+            if self.ND_cache is not None:
+                # Needed by callers after the image is released, so
+                # make sure it is available and cached
+                self.back_level
+        if fname is not None:
+            self.ND_cache.put(fname, self.cache_params,
+                              ND_params=self._ND_params,
+                              obj_center=self._obj_center,
+                              quality=self.quality,
+                              back_level=self._back_level)
+
+    @property
+    def cache_params(self):
+        """Dictionary of parameters which affect ND_params, obj_center and quality"""
+        return {'default_ND_params': self.default_ND_params,
+                'y_center': self.y_center,
+                'readnoise': self.readnoise,
+                'n_y_steps': self.n_y_steps,
+                'x_filt_width': self.x_filt_width,
+                'edge_mask': self.edge_mask,
+                'cwt_width_arange': self.cwt_width_arange,
+                'cwt_min_snr': self.cwt_min_snr,
+                'search_margin': self.search_margin,
+                'max_fit_delta_pix': self.max_fit_delta_pix,
+                'max_parallel_delta_pix': self.max_parallel_delta_pix,
+                'max_ND_width_range': self.max_ND_width_range,
+                'biasnoise': self.biasnoise,
+                'ND_edge_finder': self.ND_edge_finder,
+                'back_level_method': back_level_method}
+
+    def ND_params_to_header(self):
+        # Note transpose, since we are working in C!
+        ND_params = self._ND_params
+        self.header['NDPAR00'] = (ND_params[0,0], 'ND filt left side slope')
+        self.header['NDPAR01'] = (ND_params[1,0], 'ND filt left side offset at Y center of im')
+        self.header['NDPAR10'] = (ND_params[0,1], 'ND filt right side slope')
+        self.header['NDPAR11'] = (ND_params[1,1], 'ND filt right side offset at Y center of im')
+
+    def obj_center_to_header(self):
+        self.header['OBJ_CR0'] = (self._obj_center[1], 'Object center X')
+        self.header['OBJ_CR1'] = (self._obj_center[0], 'Object center Y')
+        self.header['QUALITY'] = (self.quality, 'Quality on 0-10 scale of center determination')
 
     @property
     def hist_of_im(self):
@@ -274,27 +653,24 @@ bins.  Uses readnoise (default = 5 e- RMS) to define bin widths
         # additional scattered light).  A star off the ND filter
         # /data/io/IoIO/raw/2017-05-28/Sky_Flat-0001_SII_on-band.fit
         # gives 124 num_sat
-        satc = np.where(im > 60000)
-        num_sat = len(satc[0])
+        num_sat = np.count_nonzero(im > 60000)
         #log.debug('Number of saturated pixels in image: ' + str(num_sat))
 
         # Work another way to see if the ND filter has a low flux
         # Note, this assignment dereferences im from HDUList[0].data
         im  = im - self.back_level
         
-        # Get the coordinates of the ND filter
-        NDc = self.ND_coords
+        # Get the mask of the ND filter
+        NDm = self.ND_mask
 
-        # Filter ND coords for ones that are at least 5 std of the
+        # Filter ND pixels for ones that are at least 5 std of the
         # bias noise above the median.  Calculate a fresh median for
         # the ND filter just in case it is different than the median
         # of the image as a whole (which is now 0 -- see above).  We
         # can't use the std of the ND filter, since it is too biased
         # by Jupiter when it is there.
-        NDmed = np.median(im[NDc])
-        boostc = np.where(im[NDc] > (NDmed + 5*self.biasnoise))
-        boost_NDc0 = np.asarray(NDc[0])[boostc]
-        boost_NDc1 = np.asarray(NDc[1])[boostc]
+        NDmed = np.median(im[NDm])
+        boostm = np.logical_and(NDm, im > (NDmed + 5*self.biasnoise))
 
         # Come up with a metric for when Jupiter is in the ND filter.
         # Below is my scratch work        
@@ -312,7 +688,7 @@ bins.  Uses readnoise (default = 5 e- RMS) to define bin widths
         # np.pi * (Rj/plate)**2 * 1000 
         # array([ 3119112.76311733,  1103540.18436529])
         
-        sum_on_ND_filter = np.sum(im[boost_NDc0, boost_NDc1])
+        sum_on_ND_filter = np.sum(im[boostm])
         #log.debug('sum of significant pixels on ND filter = ' + str(sum_on_ND_filter))
         print('sum_on_ND_filter = ', sum_on_ND_filter)
         #if num_sat > 1000 or sum_on_ND_filter < 1E6:
@@ -323,7 +699,7 @@ bins.  Uses readnoise (default = 5 e- RMS) to define bin widths
             # make the center of mass calc more accurate, just set
             # everything that is not getting toward saturation to 0
             # --> Might want to fine-tune or remove this so bright
-            im[np.where(im < 40000)] = 0
+            im[im < 40000] = 0
             
             #log.debug('Approx number of saturating pixels ' + str(np.sum(im)/65000))
 
@@ -347,7 +723,7 @@ bins.  Uses readnoise (default = 5 e- RMS) to define bin widths
                 # input/output Cartesian direction by default
                 xx, yy = np.meshgrid(x, y)
                 rr = np.sqrt(xx**2 + yy**2)
-                im[np.where(rr > 200)] = 0
+                im[rr > 200] = 0
                 y_x = np.asarray(ndimage.measurements.center_of_mass(im))
     
                 self._obj_center = y_x
@@ -357,10 +733,10 @@ bins.  Uses readnoise (default = 5 e- RMS) to define bin widths
             # Here is where we boost what is sure to be Jupiter, if Jupiter is
             # in the ND filter
             # --> this has trouble when there is bright skys
-            im[boost_NDc0, boost_NDc1] *= 1000
+            im[boostm] *= 1000
             # Clean up any signal from clouds off the ND filter, which can
             # mess up the center of mass calculation
-            im[np.where(im < 65000)] = 0
+            im[im < 65000] = 0
             y_x = ndimage.measurements.center_of_mass(im)
     
             #print(y_x[::-1])
@@ -373,9 +749,7 @@ bins.  Uses readnoise (default = 5 e- RMS) to define bin widths
             log.debug('Object center (X, Y; binned) = '
                       + str(self.binned(self._obj_center)[::-1]))
             self.quality = 6
-        self.header['OBJ_CR0'] = (self._obj_center[1], 'Object center X')
-        self.header['OBJ_CR1'] = (self._obj_center[0], 'Object center Y')
-        self.header['QUALITY'] = (self.quality, 'Quality on 0-10 scale of center determination')
+        self.obj_center_to_header()
         return self._obj_center
 
     @property
@@ -408,34 +782,23 @@ bins.  Uses readnoise (default = 5 e- RMS) to define bin widths
     # image (currently inherited) _and_ move it around relative to the
     # ND filter
 
+    @property
+    def ND_mask(self):
+        """Returns boolean mask of ND filter in unbinned image coordinates"""
+        if self._ND_mask is not None:
+            return self._ND_mask
+        us = self.unbinned(self.oshape)
+        self._ND_mask = ND_mask(self.ND_params, us, self.edge_mask)
+        return self._ND_mask
+
     @property
     def ND_coords(self):
-        """Returns tuple of coordinates of ND filter"""
+        """Returns tuple of coordinates of ND filter.  Use ND_mask when
+        possible, since it is cheaper to index with"""
         if self._ND_coords is not None:
             return self._ND_coords
-
-        # Work with unbinned image
-        xs = [] ; ys = []
-        us = self.unbinned(self.oshape)
-        for iy in np.arange(0, us[0]):
-            bounds = (self.ND_params[1,:]
-                      + self.ND_params[0,:]*(iy - us[0]/2)
-                      + np.asarray((self.edge_mask, -self.edge_mask)))
-            bounds = bounds.astype(int)
-            for ix in np.arange(bounds[0], bounds[1]):
-                xs.append(ix)
-                ys.append(iy)
-
-        # Do a sanity check.  Note C order of indices
-        badidx = np.where(np.asarray(ys) > us[0])
-        if np.any(badidx[0]):
-            raise ValueError('Y dimension of image is smaller than position of ND filter!  Subimaging/binning mismatch?')
-        badidx = np.where(np.asarray(xs) > us[1])
-        if np.any(badidx[0]):
-            raise ValueError('X dimension of image is smaller than position of ND filter!  Subimaging/binning mismatch?')
-
-        self._ND_coords = (ys, xs)
-        # NOTE C order and the fact that this is a tuple of tuples
+        # NOTE C order and the fact that this is a tuple of arrays
+        self._ND_coords = np.nonzero(self.ND_mask)
         return self._ND_coords
 
     def ND_edges(self, y, external_ND_params=None):
@@ -556,8 +919,6 @@ bins.  Uses readnoise (default = 5 e- RMS) to define bin widths
         # contrast, so we can use a slightly different algorithm for
         # them and iterate to jump-start the process with them
 
-        ND_edges = [] ; ypts = []
-
         # Create yrange at y_bin intervals starting at ytop (low
         # number in C fashion) and extending to ybot (high number),
         # chopping of the last one if it goes too far
@@ -569,6 +930,84 @@ bins.  Uses readnoise (default = 5 e- RMS) to define bin widths
         # picturing the image in C fashion, indexed from the top down,
         # ypt_top is the top point from which we bin y_bin rows together
 
+        if self.ND_edge_finder == 'cwt':
+            ND_edges, ypts, bounds = self.ND_edges_cwt(im, yrange, y_bin)
+        else:
+            ND_edges, ypts, bounds = self.ND_edges_batch(im, yrange, y_bin)
+            if len(ND_edges) < 2:
+                log.info('Batch ND edge finder could not find edges, falling back to find_peaks_cwt')
+                ND_edges, ypts, bounds = self.ND_edges_cwt(im, yrange, y_bin)
+
+        if len(ND_edges) < 2:
+            if self.default_ND_params is None:
+                raise ValueError('Not able to find ND filter position')
+            log.warning('Unable to improve filter position over initial guess')
+            self._ND_params = self.default_ND_params
+            return self._ND_params
+            
+        ND_edges = np.asarray(ND_edges) + bounds[0]
+        ypts = np.asarray(ypts)
+        
+        # Put the ND_edges back into the original orientation before
+        # we cshifted them with default_ND_params
+        if self.default_ND_params is not None:
+            es = []
+            for iy in np.arange(ypts.size):
+                this_default_ND_center\
+                    = np.round(
+                        np.mean(
+                            self.ND_edges(
+                                ypts[iy], self.default_ND_params)))
+                cshift = int(this_default_ND_center - im.shape[1]/2.)
+                es.append(ND_edges[iy,:] + cshift)
+
+                #es.append(self.default_ND_params[1,:] - im.shape[1]/2. + self.default_ND_params[0,:]*(this_y - im.shape[0]/2))
+            ND_edges =  np.asarray(es)
+
+        if self.plot_ND_edges:
+            plt.plot(ypts, ND_edges)
+            plt.show()
+        
+
+        # Try an iterative approach to fitting lines to the ND_edges
+        ND_edges = np.asarray(ND_edges)
+        ND_params0 = pg.iter_linfit(ypts-im.shape[0]/2, ND_edges[:,0],
+                                    self.max_fit_delta_pix)
+        ND_params1 = pg.iter_linfit(ypts-im.shape[0]/2, ND_edges[:,1],
+                                    self.max_fit_delta_pix)
+        # Note when np.polyfit is given 2 vectors, the coefs
+        # come out in columns, one per vector, as expected in C.
+        ND_params = np.transpose(np.asarray((ND_params0, ND_params1)))
+                
+        # DEBUGGING
+        #plt.plot(ypts, self.ND_edges(ypts, ND_params))
+        #plt.show()
+
+        dp = abs((ND_params[0,1] - ND_params[0,0]) * im.shape[0]/2)
+        if dp > self.max_parallel_delta_pix:
+            txt = 'ND filter edges are not parallel.  Edges are off by ' + str(dp) + ' pixels.'
+            #print(txt)
+            #plt.plot(ypts, ND_edges)
+            #plt.show()
+            
+            if self.default_ND_params is None:
+                raise ValueError(txt + '  No initial try available, raising error.')
+            log.warning(txt + ' Returning initial try.')
+            ND_params = self.default_ND_params
+
+        self._ND_params = ND_params
+        # The HDUList headers are objects, so we can do this
+        # assignment and the original object property gets modified
+        self.ND_params_to_header()
+
+        return self._ND_params
+
+    def ND_edges_cwt(self, im, yrange, y_bin):
+        """Find ND filter edges one y_bin strip at a time with
+        signal.find_peaks_cwt.  Slow, but the original algorithm, so
+        it is kept as a fallback for ND_edges_batch.  Returns tuple
+        (ND_edges, ypts, bounds)"""
+        ND_edges = [] ; ypts = []
         for ypt_top in yrange:
             # We will be referencing the measured points to the center
             # of the bin
@@ -613,7 +1052,7 @@ bins.  Uses readnoise (default = 5 e- RMS) to define bin widths
                     # determine how many columns we will shift each row by
                     # using the default_ND_params
                     this_ND_center \
-                        = np.int(
+                        = int(
                             np.round(
                                 np.mean(
                                     self.ND_edges(
@@ -725,75 +1164,112 @@ bins.  Uses readnoise (default = 5 e- RMS) to define bin widths
             if self.plot_dprof:
                 plt.plot(s)
                 plt.show()
+        return (ND_edges, ypts, bounds)
+
+    def ND_edges_batch(self, im, yrange, y_bin):
+        """Find ND filter edges in all y_bin strips at once.  The strips
+        are extracted with fancy indexing, smoothed and differentiated
+        as a 2D array and the two edges of each strip are found with a
+        vectorized local maximum search.  Returns tuple (ND_edges,
+        ypts, bounds) like ND_edges_cwt"""
+        # rows is (n_strips, y_bin) indices into im
+        rows = yrange[:, np.newaxis] + np.arange(y_bin)
+        ycents = yrange + y_bin/2
+        if self.default_ND_params is None:
+            # Flat case.  See ND_edges_cwt for discussion of algorithm
+            bounds = SII_filt_crop[:,1]
+            profile = np.sum(im[rows, bounds[0]:bounds[1]], 1)
+            smoothed_profile \
+                = signal.savgol_filter(profile, self.x_filt_width, 3,
+                                       axis=1)
+            d = np.gradient(smoothed_profile, 10, axis=1)
+            d2 = np.gradient(d, 10, axis=1)
+            s = np.abs(d2) * profile
+        else:
+            # Non-flat case.  Morph the image by shifting each row by
+            # the amount predicted by the default_ND_params, this
+            # time building all of the subims in one go
+            default_ND_width = (self.default_ND_params[1,1]
+                                - self.default_ND_params[1,0])
+            subim_hw = int(default_ND_width/2 + self.search_margin)
+            imshape = self.unbinned(self.HDUList[0].data.shape)
+            # Same arithmetic as ND_edges so rounding is identical
+            edges = (self.default_ND_params[1,:]
+                     + self.default_ND_params[0,:]
+                     * (rows[..., np.newaxis] - imshape[0]/2))
+            ND_centers = np.round(np.mean(edges, axis=-1)).astype(int)
+            if np.any(ND_centers < 1000):
+                raise ValueError('this_ND_center too small')
+            cols = ND_centers[..., np.newaxis] + np.arange(-subim_hw,
+                                                           subim_hw)
+            subim = im[rows[..., np.newaxis], cols]
+            profile = np.sum(subim, 1)
+            smoothed_profile \
+                = signal.savgol_filter(profile, self.x_filt_width, 0,
+                                       axis=1)
+            d = np.gradient(smoothed_profile, 10, axis=1)
+            # The edges show up as fat, flat-topped peaks which
+            # find_peaks_cwt handles by matching wavelets of a range
+            # of widths.  Smoothing one more time turns the flat tops
+            # into a well-defined maximum at their centers
+            s = ndimage.uniform_filter1d(np.abs(d), self.x_filt_width,
+                                         axis=1)
+            bounds = im.shape[1]/2 + np.asarray((-subim_hw, subim_hw))
+            bounds = bounds.astype(int)
 
-        if len(ND_edges) < 2:
-            if self.default_ND_params is None:
-                raise ValueError('Not able to find ND filter position')
-            log.warning('Unable to improve filter position over initial guess')
-            self._ND_params = self.default_ND_params
-            return self._ND_params
-            
-        ND_edges = np.asarray(ND_edges) + bounds[0]
-        ypts = np.asarray(ypts)
-        
-        # Put the ND_edges back into the original orientation before
-        # we cshifted them with default_ND_params
-        if self.default_ND_params is not None:
-            es = []
-            for iy in np.arange(ypts.size):
-                this_default_ND_center\
-                    = np.round(
-                        np.mean(
-                            self.ND_edges(
-                                ypts[iy], self.default_ND_params)))
-                cshift = int(this_default_ND_center - im.shape[1]/2.)
-                es.append(ND_edges[iy,:] + cshift)
-
-                #es.append(self.default_ND_params[1,:] - im.shape[1]/2. + self.default_ND_params[0,:]*(this_y - im.shape[0]/2))
-            ND_edges =  np.asarray(es)
-
-        if self.plot_ND_edges:
-            plt.plot(ypts, ND_edges)
+        # Only consider local maxima, so that the ends of the profiles
+        # and the shoulders of peaks don't get picked up
+        is_peak = np.zeros(s.shape, bool)
+        is_peak[:, 1:-1] = np.logical_and(s[:, 1:-1] > s[:, 0:-2],
+                                          s[:, 1:-1] >= s[:, 2:])
+        speaks = np.where(is_peak, s, -np.inf)
+        istrip = np.arange(s.shape[0])
+        if self.default_ND_params is None:
+            # Take the largest peak and the largest peak that is not
+            # closer to it than the narrowest allowed ND filter
+            i0 = np.argmax(speaks, axis=1)
+            near = (np.abs(np.arange(s.shape[1]) - i0[:, np.newaxis])
+                    < self.max_ND_width_range[0])
+            i1 = np.argmax(np.where(near, -np.inf, speaks), axis=1)
+            # Thow out if lower peak is too weak (see ND_edges_cwt)
+            noise = np.std(s[:, 1:-1] - s[:, 0:-2], axis=1)
+            good = speaks[istrip, i1] >= noise
+        else:
+            # In lower S/N case.  As in ND_edges_cwt, find the pair of
+            # peaks whose separation is closest to our expected value,
+            # but only consider the ND_batch_npeaks largest peaks in
+            # each strip so we can do all the combinations at once
+            npeaks = min(ND_batch_npeaks, s.shape[1])
+            pidx = np.argpartition(-speaks, npeaks-1, axis=1)[:, 0:npeaks]
+            pgood = np.isfinite(np.take_along_axis(speaks, pidx, axis=1))
+            diffs = pidx[:, np.newaxis, :] - pidx[:, :, np.newaxis]
+            closest = np.abs(diffs - default_ND_width).astype(float)
+            # Exclude self-pairs, reversed pairs and non-peaks
+            closest[diffs <= 0] = np.inf
+            closest[~(pgood[:, np.newaxis, :] & pgood[:, :, np.newaxis])] \
+                = np.inf
+            best = np.argmin(closest.reshape(closest.shape[0], -1), axis=1)
+            ip, iop = np.unravel_index(best, (npeaks, npeaks))
+            i0 = pidx[istrip, ip]
+            i1 = pidx[istrip, iop]
+            good = np.isfinite(closest[istrip, ip, iop])
+        edge_idx = np.sort(np.stack((i0, i1), axis=1), axis=1)
+        # Sanity check
+        de = edge_idx[:,1] - edge_idx[:,0]
+        good = np.logical_and.reduce((good,
+                                      de >= self.max_ND_width_range[0],
+                                      de <= self.max_ND_width_range[1]))
+        if not np.all(good):
+            log.info('No clear two peaks inside bounds ' + str(bounds)
+                     + ' for ' + str(np.count_nonzero(~good))
+                     + ' of ' + str(good.size) + ' strips')
+        if self.plot_prof:
+            plt.plot(profile.T)
             plt.show()
-        
-
-        # Try an iterative approach to fitting lines to the ND_edges
-        ND_edges = np.asarray(ND_edges)
-        ND_params0 = pg.iter_linfit(ypts-im.shape[0]/2, ND_edges[:,0],
-                                    self.max_fit_delta_pix)
-        ND_params1 = pg.iter_linfit(ypts-im.shape[0]/2, ND_edges[:,1],
-                                    self.max_fit_delta_pix)
-        # Note when np.polyfit is given 2 vectors, the coefs
-        # come out in columns, one per vector, as expected in C.
-        ND_params = np.transpose(np.asarray((ND_params0, ND_params1)))
-                
-        # DEBUGGING
-        #plt.plot(ypts, self.ND_edges(ypts, ND_params))
-        #plt.show()
-
-        dp = abs((ND_params[0,1] - ND_params[0,0]) * im.shape[0]/2)
-        if dp > self.max_parallel_delta_pix:
-            txt = 'ND filter edges are not parallel.  Edges are off by ' + str(dp) + ' pixels.'
-            #print(txt)
-            #plt.plot(ypts, ND_edges)
-            #plt.show()
-            
-            if self.default_ND_params is None:
-                raise ValueError(txt + '  No initial try available, raising error.')
-            log.warning(txt + ' Returning initial try.')
-            ND_params = self.default_ND_params
-
-        self._ND_params = ND_params
-        # The HDUList headers are objects, so we can do this
-        # assignment and the original object property gets modified
-        h = self.HDUList[0].header
-        # Note transpose, since we are working in C!
-        self.header['NDPAR00'] = (ND_params[0,0], 'ND filt left side slope')
-        self.header['NDPAR01'] = (ND_params[1,0], 'ND filt left side offset at Y center of im')
-        self.header['NDPAR10'] = (ND_params[0,1], 'ND filt right side slope')
-        self.header['NDPAR11'] = (ND_params[1,1], 'ND filt right side offset at Y center of im')
-
-        return self._ND_params
+        if self.plot_dprof:
+            plt.plot(s.T)
+            plt.show()
+        return (list(edge_idx[good]), list(ycents[good]), bounds)
 
 def IPT_Na_R(args):
     P = pg.PrecisionGuide("CorObsData", "IoIO") # other defaults should be good
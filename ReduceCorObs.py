@@ -3,12 +3,18 @@ import os
 import re
 import time
 import datetime
-from multiprocessing import Pool
-import csv
+import threading
+import queue
+import pickle
+import functools
+from multiprocessing import Pool, Manager, current_process
+import json
+import itertools
 import argparse
 
 import numpy as np
 from scipy import ndimage
+from scipy import special
 from scipy.interpolate import UnivariateSpline
 from astropy import log
 from astropy import units as u
@@ -18,7 +24,6 @@ from astropy.coordinates import EarthLocation
 from astropy.coordinates import solar_system_ephemeris, get_body
 from skimage import exposure
 
-from astroquery.jplhorizons import Horizons
 #from photutils import CircularAperture, aperture_photometry
 #from photutils import RectangularAperture
 
@@ -32,6 +37,15 @@ from astropy.io import fits
 
 import IoIO
 #from IoIO import CorObsData, run_level_default_ND_params
+from header_index import HeaderCollection
+from ephemeris import get_ephemeris
+from ap_sum_store import (APSumStore, ap_sum_writer, check_writer,
+                          wait_for_writer)
+import pairing
+import stage_timing
+import movie_io
+from fits_access import (open_fits, read_header, read_data, primary_image,
+                         iter_row_blocks, io_stats, log_io_stats)
 import define as D
 
 # Constants for use in code
@@ -88,6 +102,23 @@ global_bias = 1633 # ADU
 global_dark = 0.021 # ADU/s
 reduce_edge_mask = -10 # Block out beyond ND filter
 ap_sum_fname = 'ap_sum.csv'
+# JSON list of aperture sets evaluated by reduce_pair.  See
+# ApertureCatalog
+aperture_catalog_fname = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'aperture_catalog.json')
+# On-disk cache of IoIO.CorObsData ND_params, obj_center and quality
+# so that re-running reductions skips the expensive centering step.
+# Set to None to disable
+ND_params_cache_fname = os.path.join(data_root, 'reduced',
+                                     'ND_params_cache.sqlite')
+# pairing.match policy used to choose the off-band frame reduced with
+# each on-band frame.  'nearest' or 'nearest_before'
+on_off_pairing_policy = 'nearest'
+# On-disk index of the (jd, back_level) of each file Background has
+# measured (see IoIO.BackLevelCache), so reruns don't reread them.
+# Set to None to disable
+back_level_cache_fname = os.path.join(data_root, 'reduced',
+                                      'back_level_cache.sqlite')
 
 # 80 would be perfect match.  Lets go a little short of that
 #global_frame_rate = 80
@@ -95,14 +126,57 @@ global_frame_rate = 40
 default_movie_speedup = 24000
 movie_edge_mask = -8
 #movie_edge_mask = 0
+# make_movie renders each reduced file once into a uint8 frame, kept
+# memory-mapped in movie_frames_<line>.npy (with a .json manifest) in
+# the reduced directory.  Later movies re-render only files that have
+# changed.  False renders frames as moviepy asks for them
+movie_frame_cache = True
+# Bump when MovieCorObs.render changes, to re-render cached frames
+movie_frame_version = '1'
+# Number of rendered frames MovieCorObs keeps in memory when frames
+# are not pre-rendered
+movie_frame_lru_size = 8
 # Max perpendicular distance from center of ND filter
 max_ND_dist = 20
+# Spline order of the shift + rotate resampling in reduce_pair.  3 is
+# what ndimage.interpolation.shift and rotate use.  1 is much faster
+reduce_resample_order = 3
+# Half-width (Rj) of the region of the On and Off aperture images
+# that reduce_pair resamples.  Pixels outside are 0, so On and Off
+# apertures that are not entirely inside this region (including the
+# whole-image and excluding-box ones) are NaN, and the half-width is
+# recorded in APCROP.  None resamples the whole frame
+reduce_aperture_crop = None
+# Format of the reduced images reduce_pair writes (see write_reduced).
+# reduced_dtype: e.g. np.float32.  None keeps float64.
+# reduced_crop: half-width (Rj) of the box around Jupiter written.
+#   None writes the whole rotated frame.
+# reduced_compression: astropy CompImageHDU compression_type (e.g.
+#   'RICE_1', which quantizes floats, or 'GZIP_2').  None is
+#   uncompressed.
+reduced_dtype = None
+reduced_crop = None
+reduced_compression = None
+# JSON-lines file that ReduceDir and ReduceTree append the per-stage
+# timing of reduce_pair to (see stage_timing).  Set to None to disable
+stage_timing_fname = os.path.join(data_root, 'reduced',
+                                  'reduce_timing.jsonl')
+# Also record the stage times of each reduced file in its header
+# (T_READ, T_BACK, etc.)
+stage_times_to_header = False
 # Hyperthreading is a little optimistic reporting two full processes
 # per core.  Just stick with one process per core
 threads_per_core = 2
 # Raised this from 100 since I am doing a better job with bias & dark
 # Try even higher for Na sake
 background_light_threshold = 250 # ADU
+# IoIO.back_level method used by Background.  'bincount' agrees with
+# the original 'cwt' method to within about a readnoise and is much
+# faster, but differs where the sky peak blends into the bias peak,
+# which changes ONBSUB/OFFBSUB and the aperture sums.  Select it
+# (reduce --back_level_method) once back_level_bench has passed on a
+# regression set
+background_back_level_method = 'cwt'
 #movie_background_light_threshold = 250 # rayleighs
 movie_background_light_threshold = 800 # rayleighs
 
@@ -215,16 +289,30 @@ def get_filt_name(collection, line=None, band='None'):
     return filt[0]
 
         
-def get_ND_params_1flat(fname):
+def get_ND_params_1flat(fname, ND_cache=None):
+    if ND_cache is None and ND_params_cache_fname is not None:
+        ND_cache = IoIO.NDParamsCache(ND_params_cache_fname)
+    # The whole iteration is cached, including failures, under
+    # these parameters
+    flat_params = {'get_ND_params_1flat': 3}
+    if ND_cache is not None:
+        cached = ND_cache.get(fname, flat_params)
+        if cached is not None:
+            if cached['ND_params'] is None:
+                return None
+            return np.asarray(cached['ND_params'])
     iter_ND_params = None
     try:
         # Iterate to get independent default_ND_params for each flat
         default_ND_params = None
         for i in np.arange(3):
-            F = IoIO.CorObsData(fname, default_ND_params=iter_ND_params)
+            F = IoIO.CorObsData(fname, default_ND_params=iter_ND_params,
+                                ND_cache=ND_cache)
             iter_ND_params = F.ND_params
     except ValueError as e:
         log.error('Skipping: ' + fname + '. ' + str(e))
+    if ND_cache is not None:
+        ND_cache.put(fname, flat_params, ND_params=iter_ND_params)
     return iter_ND_params
 
 def get_default_ND_params(directory=None,
@@ -236,7 +324,7 @@ def get_default_ND_params(directory=None,
     if collection is None:
         if not os.path.isdir(directory):
             raise ValueError('Specify either a collection or directory containing flats')
-        collection = ccdproc.ImageFileCollection(directory)
+        collection = HeaderCollection(directory)
     if maxcount is None:
         maxcount = 10
     if num_processes is None:
@@ -245,13 +333,26 @@ def get_default_ND_params(directory=None,
         log.warning('IMAGETYP keyword not found in any files: ' + directory)
         return None 
 
-    flats = collection.files_filtered(imagetyp='FLAT', include_path=True)
+    flats = get_flat_fnames(collection, maxcount)
     if len(flats) == 0:
         return None
-    maxcount = np.min((len(flats), maxcount))
     # Do this in parallel for speed :-)
     with Pool(processes=num_processes) as p:
-        ND_params_list = p.map(get_ND_params_1flat, flats[0:maxcount])
+        ND_params_list = p.map(get_ND_params_1flat, flats)
+    return median_ND_params(ND_params_list)
+
+def get_flat_fnames(collection, maxcount=None):
+    """Returns up to maxcount (default 10) flat filenames in collection"""
+    if maxcount is None:
+        maxcount = 10
+    if not 'imagetyp' in collection.keywords:
+        return []
+    flats = collection.files_filtered(imagetyp='FLAT', include_path=True)
+    return flats[0:maxcount]
+
+def median_ND_params(ND_params_list):
+    """Returns median of ND_params in list, ignoring None.  Returns None
+    if there are no ND_params"""
     ND_params_list = [p for p in ND_params_list
                       if p is not None]
     if len(ND_params_list) == 0:
@@ -264,6 +365,17 @@ def get_default_ND_params(directory=None,
             np.median(ND_params_array[:, 1, 1])))
     return np.asarray(default_ND_params)
 
+def get_flat_collection(directory, collection=None):
+    """Returns collection in which to look for flats for directory.
+    ACP puts its flats in an AutoFlat subdirectory"""
+    autoflat_subdir = os.path.join(directory, 'AutoFlat') 
+    if os.path.isdir(autoflat_subdir):
+        log.debug('ACP AutoFlat subdirectory detected.  Ignoring any flats in ' + directory)
+        return HeaderCollection(autoflat_subdir)
+    if collection is None:
+        collection = HeaderCollection(directory)
+    return collection
+
 # -->I think this is obsolete too
 def cmd_get_default_ND_params(args):
     print(get_default_ND_params(args.directory, args.maxcount))
@@ -306,7 +418,8 @@ def ND_params_dir(directory=None, default_ND_params=None):
     for count, f in enumerate(objs):
         D.say(f)
         try:
-            O = IoIO.CorObsData(f, default_ND_params=default_ND_params)
+            O = IoIO.CorObsData(f, default_ND_params=default_ND_params,
+                                ND_cache=ND_params_cache_fname)
             if O.header["EXPTIME"] == 300:
                 if O.header["FILTER"] == "[SII] 6731A 10A FWHM":
                     torus_count += 1
@@ -374,6 +487,129 @@ def ND_params_tree(args):
     D.say('Total torus: ' + str(totaltorus))
     D.say('Total Na: ' + str(totalNa))
 
+def ND_params_benchmark(args):
+    """Time CorObsData ND_params per frame for each ND edge finder"""
+    default_ND_params = args.default_ND_params
+    if default_ND_params is None:
+        default_ND_params = IoIO.run_level_default_ND_params
+    results = {}
+    for edge_finder in ['cwt', 'batch']:
+        elapsed = []
+        for f in args.fnames:
+            with fits.open(f) as HDUL:
+                start = time.time()
+                # Pass a copy of the HDUList so NDPAR keywords
+                # written by the first edge finder aren't read
+                # back in by the second
+                O = IoIO.CorObsData(fits.HDUList([h.copy() for h in HDUL]),
+                                    default_ND_params=default_ND_params,
+                                    recalculate=True,
+                                    ND_edge_finder=edge_finder)
+                O.ND_params
+                elapsed.append(time.time() - start)
+            log.debug(edge_finder + ' ' + f + ' ' + str(elapsed[-1])
+                      + 's ND_params = ' + str(O.ND_params.tolist()))
+        results[edge_finder] = np.asarray(elapsed)
+        D.say(edge_finder + ': average per frame: '
+              + str(np.mean(elapsed)) + 's')
+    D.say('Speedup: '
+          + str(np.mean(results['cwt']) / np.mean(results['batch'])))
+    return results
+
+def back_level_benchmark(args):
+    """Compare IoIO.back_level methods on a regression set of files"""
+    tolerance = args.tolerance
+    if tolerance is None:
+        tolerance = IoIO.global_readnoise
+    elapsed = {'cwt': 0, 'bincount': 0}
+    diffs = []
+    for f in args.fnames:
+        with fits.open(f) as HDUL:
+            im = HDUL[0].data
+            b = {}
+            for method in elapsed.keys():
+                start = time.time()
+                b[method] = IoIO.back_level(im, method=method)
+                elapsed[method] += time.time() - start
+        diff = b['bincount'] - b['cwt']
+        diffs.append(diff)
+        if abs(diff) > tolerance:
+            log.warning('back_level methods differ by ' + str(diff)
+                        + ' for ' + f)
+    diffs = np.asarray(diffs)
+    for method, e in elapsed.items():
+        D.say(method + ': average per frame: '
+              + str(e/len(args.fnames)) + 's')
+    D.say('Max abs difference: ' + str(np.max(np.abs(diffs)))
+          + ', number outside tolerance of ' + str(tolerance) + ': '
+          + str(np.count_nonzero(np.abs(diffs) > tolerance)))
+    return diffs
+
+def aperture_catalog_benchmark(args):
+    """Time aperture catalog evaluation per aperture set on reduced files"""
+    ap_catalog = ApertureCatalog(args.catalog)
+    timing = {}
+    sat_time = 0
+    for f in args.fnames:
+        with open_fits(f) as HDUL:
+            header = HDUL[0].header.copy()
+            im = read_data(HDUL).astype(float)
+        start = time.time()
+        apsums = ApertureSums(im)
+        sat_time += time.time() - start
+        center = np.asarray(im.shape)/2
+        ap_catalog.evaluate(apsums, header['ANGDIAM'], center, 'AP',
+                            header, {}, timing=timing)
+    D.say('Summed-area tables: average per frame: '
+          + str(sat_time/len(args.fnames)) + 's')
+    for name, (n, elapsed) in timing.items():
+        D.say(name + ': ' + str(n/len(args.fnames)) + ' apertures, '
+              + str(elapsed/len(args.fnames)) + 's per frame, '
+              + str(elapsed/n) + 's per aperture')
+    return timing
+
+def shift_rotate(im, shift, angle, flipud=False, order=None, crop=None):
+    """Returns ndimage.interpolation.rotate(ndimage.interpolation.shift(im,
+    shift), angle), optionally followed by np.flipud, computed with a
+    single ndimage.affine_transform.  Output shape is that of rotate
+    with reshape=True.  order is the spline order (default
+    reduce_resample_order).  If crop = (y0, y1, x0, x1), only that
+    region of the output is resampled, the rest is 0"""
+    if order is None:
+        order = reduce_resample_order
+    # Same rotation matrix, output shape and centering as rotate
+    c, s = special.cosdg(angle), special.sindg(angle)
+    rot_matrix = np.array([[c, s],
+                           [-s, c]])
+    in_shape = np.asarray(im.shape)
+    iy, ix = in_shape
+    out_bounds = rot_matrix @ [[0, 0, iy, iy],
+                               [0, ix, 0, ix]]
+    out_shape = (np.ptp(out_bounds, axis=1) + 0.5).astype(int)
+    # affine_transform maps output coordinate o to input coordinate
+    # matrix @ o + offset.  shift moves input by +shift
+    offset = ((in_shape - 1) / 2
+              - rot_matrix @ ((out_shape - 1) / 2)
+              - np.asarray(shift))
+    matrix = rot_matrix
+    if flipud:
+        # out[i, j] = rotated[ny-1-i, j]
+        offset = rot_matrix @ [out_shape[0] - 1, 0] + offset
+        matrix = rot_matrix @ np.diag([-1, 1])
+    if crop is None:
+        return ndimage.affine_transform(im, matrix, offset,
+                                        output_shape=tuple(out_shape),
+                                        order=order)
+    y0, y1, x0, x1 = crop
+    y0, x0 = max(y0, 0), max(x0, 0)
+    y1, x1 = min(y1, out_shape[0]), min(x1, out_shape[1])
+    out = np.zeros(out_shape, dtype=im.dtype)
+    if y1 > y0 and x1 > x0:
+        out[y0:y1, x0:x1] = ndimage.affine_transform(
+            im, matrix, matrix @ [y0, x0] + offset,
+            output_shape=(y1-y0, x1-x0), order=order)
+    return out
+
 def TiltImage(image, ImageNorth, JupiterNorth):
     # Assuming that "0" deg is to the right and ImageNorth is "90" deg.
     # Assuming JupiterNorth is relative to ImageNorth.
@@ -400,7 +636,8 @@ def is_jupiter(hdr):
     Parameters
     ----------
     hdr : dictionary-like
-        FITS header or row from ccdproc.ImageFileCollection
+        FITS header or row from ccdproc.ImageFileCollection or
+        header_index.HeaderCollection summary
     """
     imagetyp = hdr['imagetyp']
     if imagetyp.lower() != 'light':
@@ -480,7 +717,68 @@ def is_jupiter(hdr):
     this_pointing = SkyCoord(frame=jup.frame, ra=ra, dec=dec)
     if this_pointing.separation(jup) < Angle(5, unit=u.deg):
         return True
-    return False    
+    return False
+
+def _str_column(table, name):
+    """Returns array of lower-case strings of column name of table,
+    with '' for masked values or if there is no such column"""
+    if not name in table.colnames:
+        return np.full(len(table), '')
+    c = np.ma.asarray(table[name])
+    s = np.char.lower(np.asarray(c.data, dtype=str))
+    s[np.ma.getmaskarray(c)] = ''
+    return s
+
+def _sexagesimal(values, unit):
+    """Returns Angle array of values, which are MaxIm/ACP
+    'DD MM SS.S' or 'DD:MM:SS.S' strings in unit.  Parses them
+    directly, which is much faster than Angle for arrays of strings"""
+    try:
+        a = []
+        for v in values:
+            d, m, s = str(v).replace(':', ' ').split()
+            sign = -1 if d.startswith('-') else 1
+            a.append(sign*(abs(float(d)) + float(m)/60 + float(s)/3600))
+    except ValueError:
+        return Angle(list(values), unit=unit)
+    return Angle(a, unit=unit)
+
+def is_jupiter_table(summary_table):
+    """Returns boolean array, True for each row of summary_table
+    (e.g. header_index.HeaderCollection summary) that describes an
+    observation of Jupiter.  Same tests as is_jupiter, but the
+    positions of Jupiter for all of the unlabeled rows are computed in
+    one call, at the nearest hour.  These are geocentric, since
+    Jupiter's parallax (~2 arcsec) doesn't matter to the 5 degree
+    test, so SITELAT, SITELONG and ALT-OBS aren't needed.  A missing
+    OBJECT counts as empty"""
+    imagetyp = _str_column(summary_table, 'imagetyp')
+    object = _str_column(summary_table, 'object')
+    objlist = ['Jupiter', 'IPT', 'Na', 'Na_IPT', 'Na_IPT_R']
+    light = imagetyp == 'light'
+    labeled = np.isin(object, [o.lower() for o in objlist])
+    # See is_jupiter for why no telescope coordinates means Jupiter
+    if 'objctra' in summary_table.colnames:
+        no_coords = np.ma.getmaskarray(
+            np.ma.asarray(summary_table['objctra']))
+    else:
+        no_coords = np.ones(len(summary_table), bool)
+    jupiter = light & (labeled | no_coords)
+    check = light & ~labeled & ~no_coords & (object == '')
+    if not np.any(check):
+        return jupiter
+    rows = summary_table[check]
+    T = Time(list(rows['date-obs']), format='fits')
+    # Jupiter moves less than a degree a day, so one position per hour
+    # is plenty and a night needs only a handful
+    hours, inverse = np.unique(np.round(T.jd*24), return_inverse=True)
+    with solar_system_ephemeris.set('builtin'):
+        jup = get_body('jupiter', Time(hours/24, format='jd'))[inverse]
+    ra = _sexagesimal(rows['objctra'], u.hour)
+    dec = _sexagesimal(rows['objctdec'], u.deg)
+    this_pointing = SkyCoord(frame=jup.frame, ra=ra, dec=dec)
+    jupiter[check] = this_pointing.separation(jup) < Angle(5, unit=u.deg)
+    return jupiter
 
 ##log.setLevel('DEBUG')
 ##HDUL = fits.open('/data/io/IoIO/raw/2018-06-06/SII_off-band_010.fits')
@@ -493,77 +791,167 @@ def is_jupiter(hdr):
 ##for l in summary_table:
 ##    print(l["file"], is_jupiter(l))
 
+def get_back_level_jd(f, back_level_method=None):
+    """Returns (jd, IoIO.back_level) of FITS file f.  Results are
+    recorded in back_level_cache_fname and read from there if f hasn't
+    changed"""
+    if back_level_method is None:
+        back_level_method = background_back_level_method
+    cache = None
+    if back_level_cache_fname is not None:
+        cache = IoIO.BackLevelCache(back_level_cache_fname)
+        cached = cache.get([f], back_level_method)
+        if f in cached:
+            return cached[f]
+    jd_b = measure_back_level_jd(f, back_level_method)
+    if cache is not None:
+        cache.put(f, back_level_method, *jd_b)
+    return jd_b
+
+def measure_back_level_jd(f, back_level_method):
+    with open_fits(f, raw=True) as HDUL:
+        hdr = HDUL[0].header
+        T = Time(hdr['DATE-OBS'], format='fits')
+        if (back_level_method == 'bincount'
+            and hdr['BITPIX'] == 16
+            and hdr.get('BZERO') == 2**15
+            and hdr.get('BSCALE', 1) == 1):
+            # Raw uint16 images can be histogrammed a block of rows at
+            # a time, rather than read into memory whole
+            counts = np.zeros(2**16, int)
+            for block in iter_row_blocks(HDUL):
+                counts += np.bincount(block.ravel(), minlength=2**16)
+            return (T.jd, IoIO.back_level_counts(counts))
+    with open_fits(f) as HDUL:
+        b = IoIO.back_level(read_data(HDUL),
+                            method=back_level_method)
+    return (T.jd, b)
+
+def cached_back_levels(fdict, back_level_method=None):
+    """Returns (jd_b_dict, missing), where jd_b_dict is keyed like
+    fdict with lists of (jd, back_level) of the files found in
+    back_level_cache_fname and missing is keyed like fdict with lists
+    of files not found"""
+    if back_level_method is None:
+        back_level_method = background_back_level_method
+    cached = {}
+    if back_level_cache_fname is not None:
+        cache = IoIO.BackLevelCache(back_level_cache_fname)
+        cached = cache.get(itertools.chain(*fdict.values()),
+                           back_level_method)
+    jd_b_dict = {}
+    missing = {}
+    for band, flist in fdict.items():
+        jd_b_dict[band] = [cached[f] for f in flist if f in cached]
+        missing[band] = [f for f in flist if f not in cached]
+    return (jd_b_dict, missing)
+
 class Background():
-    """Class for measuring and providing CCD background as a function of time using [SII] on-band images"""
+    """Class for measuring and providing CCD background as a function
+    of time using [SII] images (Na if there are no [SII] images of a
+    band)"""
     def __init__(self,
                  fname_or_directory=None,
                  collection=None,
-                 num_processes=None):
+                 num_processes=None,
+                 back_level_method=None,
+                 jd_b_dict=None,
+                 cache_only=False):
+        """jd_b_dict : dictionary keyed by 'on' and 'off' of lists of
+        (jd, back_level) of SII_fdict files, if already measured
+
+        cache_only : build the background from back levels found in
+        back_level_cache_fname alone, ignoring files not measured yet"""
         if fname_or_directory is None:
             fname_or_directory = '.'
+        if back_level_method is None:
+            back_level_method = background_back_level_method
+        self.back_level_method = back_level_method
         if num_processes is None:
             num_processes=int(os.cpu_count()/threads_per_core)
-        SII_on_list = []
+        if jd_b_dict is None:
+            fdict = self.SII_fdict(fname_or_directory, collection)
+            jd_b_dict, missing = cached_back_levels(fdict, back_level_method)
+            nmissing = sum([len(m) for m in missing.values()])
+            if cache_only:
+                if nmissing > 0:
+                    log.warning('Background: ignoring ' + str(nmissing)
+                                + ' files not in back_level cache')
+            elif nmissing > 0:
+                # Send workers just the filenames, rather than pickling
+                # self with each chunk
+                get_jd_b = functools.partial(get_back_level_jd,
+                                             back_level_method=back_level_method)
+                with Pool(int(min(num_processes, nmissing))) as p:
+                    for band, flist in missing.items():
+                        jd_b_dict[band].extend(p.map(get_jd_b, flist))
+        self.jd_b_dict = {}
+        self.spl_dict = {}
+        for band, jd_b_list in jd_b_dict.items():
+            if len(jd_b_list) == 0:
+                continue
+            # UnivariateSpline needs things in order.  Thanks to
+            # https://stackoverflow.com/questions/3121979/how-to-sort-list-tuple-of-lists-tuples
+            jd_b_list = sorted(jd_b_list, key=lambda tup: tup[0])
+            self.jd_b_dict[band] = jd_b_list
+            if len(jd_b_list) == 1:
+                log.warning("Only one " + band + "-band image found, doing the best I can with it's background")
+                self.spl_dict[band] = None
+                continue
+            (jdlist, backlist) = zip(*jd_b_list)
+            # A cubic needs at least 4 points
+            self.spl_dict[band] = UnivariateSpline(
+                jdlist, backlist, k=min(3, len(jd_b_list) - 1))
+        if not self.jd_b_dict:
+            raise ValueError('Background: no back levels to work with')
+
+    @staticmethod
+    def SII_fdict(fname_or_directory, collection=None):
+        """Returns dictionary containing up to two keys: on and off,
+        with the lists of [SII] files for on and off-band filters in
+        each.  Na files are used for a band with no [SII] files"""
         if os.path.isfile(fname_or_directory):
-            SII_on_list = [fname_or_directory]
+            pass
         elif os.path.isdir(fname_or_directory):
             if collection is None:
-                collection = ccdproc.ImageFileCollection(fname_or_directory)
+                collection = HeaderCollection(fname_or_directory)
             if not 'imagetyp' in collection.keywords:
                 raise ValueError('IMAGETYP keyword not found in any files: ' + fname_or_directory)
             
-        # Make a dictionary containing two keys: on and off, with
-        # the lists of files for on and off-band filters in each
         fdict = {}
         for band in ['on', 'off']:
-            SII_filt = get_filt_name(collection, '[SII]', band)
-            flist = [os.path.join(fname_or_directory, l['file'])
-                     for l in collection.summary
-                     if (l['filter'] == SII_filt
-                         and l['imagetyp'].lower() == 'light'
-                         and l['xbinning'] == 1
-                         and l['ybinning'] == 1)]
-            if len(flist) == 0:
-                continue
-            fdict[band] = flist
+            for line in ['[SII]', 'Na']:
+                filt = get_filt_name(collection, line, band)
+                flist = [os.path.join(fname_or_directory, l['file'])
+                         for l in collection.summary
+                         if (l['filter'] == filt
+                             and l['imagetyp'].lower() == 'light'
+                             and l['xbinning'] == 1
+                             and l['ybinning'] == 1)]
+                if len(flist) == 0:
+                    continue
+                if line != '[SII]':
+                    log.warning('Background: no [SII] ' + band
+                                + '-band images, using ' + line)
+                fdict[band] = flist
+                break
         if not fdict:
-            # --> could potentially do the best I can with Na or
-            # another method
-            raise ValueError('Background: no [SII] images to work with')
-        self.jd_b_dict = {}
-        self.spl_dict = {}
-        for band in ['on', 'off']:
-            with Pool(int(num_processes)) as p:
-                jd_b_list = p.map(self.worker_get_back_level, fdict[band])
-            self.jd_b_dict[band] = jd_b_list
-            if len(jd_b_list) == 1:
-                log.warning("Only one " + band + "-band image found, doing the best I can with it's background")
-                self.spl_dict[band] = None
-                return
-        # UnivariateSpline needs things in order.  Thanks to
-        # https://stackoverflow.com/questions/3121979/how-to-sort-list-tuple-of-lists-tuples
-        self.spl_dict = {}
-        for band in ['on', 'off']:
-            jd_b_list = self.jd_b_dict[band]
-            jd_b_list.sort(key=lambda tup: tup[0])
-            (jdlist, backlist) = zip(*jd_b_list)
-            spl = UnivariateSpline(jdlist, backlist)
-            self.spl_dict[band] = spl
-        return
+            raise ValueError('Background: no [SII] or Na images to work with')
+        return fdict
 
     def worker_get_back_level(self, f):
-        with fits.open(f) as HDUL:
-            T = Time(HDUL[0].header['DATE-OBS'], format='fits')
-            b = IoIO.back_level(HDUL[0].data)
-        return (T.jd, b)
+        return get_back_level_jd(f, self.back_level_method)
     
     def background(self, header):
         """Returns best estimate background for time given in FITS string format"""
         band = get_filt_band(header)
+        if not band in self.spl_dict:
+            # Both bands see the same bias and dark
+            band, = self.spl_dict.keys()
         if self.spl_dict[band] is None:
             return self.jd_b_dict[band][0][1]
         T = Time(header['DATE-OBS'], format='fits')
-        return np.asscalar(self.spl_dict[band](T.jd))
+        return float(self.spl_dict[band](T.jd))
 
 def get_tmid(l):
     """Get midpoint of observation whose FITS header is stored in dictionary l (l can be a line in a collection)"""
@@ -647,8 +1035,96 @@ def Rj_strip_sum(ang_width, im, center, Rj_ap_height, imtype, header, row):
     row[key] = asum
     return key        
 
+class ApertureSums():
+    """Summed-area tables of an image and of its nonzero pixels so that
+    the sum and number of nonzero pixels in any box can be read off
+    with four lookups.  Boxes are specified as numpy slices and follow
+    numpy slice semantics (including negative indices).  Boxes
+    containing non-finite pixels return NaN"""
+    def __init__(self, im):
+        self.shape = im.shape
+        nonfinite = ~np.isfinite(im)
+        self.sat_nonfinite = None
+        if np.any(nonfinite):
+            self.sat_nonfinite = self.integral(nonfinite, dtype=np.int32)
+            # np.where(tim != 0) counts NaN as a nonzero pixel.  Add
+            # those back in below
+            im = np.where(nonfinite, 0, im)
+        self.sat = self.integral(np.asarray(im, dtype=float))
+        # Counts of even a full frame fit comfortably in int32
+        self.sat_nonzero = self.integral(im != 0, dtype=np.int32)
+        if self.sat_nonfinite is not None:
+            self.sat_nonzero += self.sat_nonfinite
+
+    @staticmethod
+    def integral(im, dtype=None):
+        """Returns summed-area table with a leading row and column of
+        zeros.  dtype defaults to that of im"""
+        if dtype is None:
+            dtype = im.dtype
+        ny, nx = im.shape
+        sat = np.zeros((ny+1, nx+1), dtype=dtype)
+        np.cumsum(im, axis=0, dtype=dtype, out=sat[1:, 1:])
+        np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+        return sat
+
+    def _lookup(self, sat, ys, xs):
+        y0, y1, _ = ys.indices(self.shape[0])
+        x0, x1, _ = xs.indices(self.shape[1])
+        if y1 <= y0 or x1 <= x0:
+            return sat.dtype.type(0)
+        return sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]
+
+    def box(self, ys=slice(None), xs=slice(None)):
+        """Returns (sum, nonzero pixel count) of im[ys, xs]"""
+        asum = self._lookup(self.sat, ys, xs)
+        if (self.sat_nonfinite is not None
+            and self._lookup(self.sat_nonfinite, ys, xs) > 0):
+            asum = np.nan
+        return asum, self._lookup(self.sat_nonzero, ys, xs)
+
+    @staticmethod
+    def _indices(idx, n):
+        """Vectorized slice.indices for slice starts or stops"""
+        idx = np.asarray(idx, dtype=int)
+        idx = np.where(idx < 0, idx + n, idx)
+        return np.clip(idx, 0, n)
+
+    def inside(self, valid, y0, y1, x0, x1):
+        """Returns boolean array, True where box im[y0:y1, x0:x1] lies
+        within the region valid = (y0, y1, x0, x1) of im.  All True if
+        valid is None"""
+        if valid is None:
+            return np.ones(np.broadcast(y0, y1, x0, x1).shape, dtype=bool)
+        ny, nx = self.shape
+        vy0, vy1 = max(valid[0], 0), min(valid[1], ny)
+        vx0, vx1 = max(valid[2], 0), min(valid[3], nx)
+        return ((self._indices(y0, ny) >= vy0)
+                & (self._indices(y1, ny) <= vy1)
+                & (self._indices(x0, nx) >= vx0)
+                & (self._indices(x1, nx) <= vx1))
+
+    def boxes(self, y0, y1, x0, x1):
+        """Returns (sums, nonzero pixel counts) of im[y0:y1, x0:x1] for
+        arrays of box limits"""
+        ny, nx = self.shape
+        y0 = self._indices(y0, ny)
+        y1 = self._indices(y1, ny)
+        x0 = self._indices(x0, nx)
+        x1 = self._indices(x1, nx)
+        empty = np.logical_or(y1 <= y0, x1 <= x0)
+        def lookup(sat):
+            v = sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]
+            return np.where(empty, 0, v)
+        sums = lookup(self.sat)
+        if self.sat_nonfinite is not None:
+            sums = np.where(lookup(self.sat_nonfinite) > 0, np.nan, sums)
+        return sums, lookup(self.sat_nonzero)
+
 def Rj_box_sum(ang_width, im, center, Rj_ap_side, imtype, header, row):
-    """Take aperture sums -- expressed as average pixel values -- for a square box Rj_ap_side Rj on a side.  Rj_ap_side = 0 whole image, Rj_ap_side > 0 box of that side and width in Rj centered on center of image, Rj_ap_side < 0 area outside of box.  ang_width is the angular diameter of Jupiter in arcsec"""
+    """Take aperture sums -- expressed as average pixel values -- for a square box Rj_ap_side Rj on a side.  Rj_ap_side = 0 whole image, Rj_ap_side > 0 box of that side and width in Rj centered on center of image, Rj_ap_side < 0 area outside of box.  ang_width is the angular diameter of Jupiter in arcsec.  im can be an ApertureSums to avoid full-frame passes for each aperture"""
+    if not isinstance(im, ApertureSums):
+        im = ApertureSums(im)
     Rjpix = ang_width/2/plate_scale # arcsec / (arcsec/pix)
     #D.say('Rj = ', Rj, ' pixels')
     ap_side = int(Rj_ap_side * Rjpix)
@@ -659,33 +1135,24 @@ def Rj_box_sum(ang_width, im, center, Rj_ap_side, imtype, header, row):
         #log.warning('Rj_ap_side ' + str(Rj_ap_side) + ' Rj too large, setting aperture sum to zero')
         asum = 0
     else:
-        tim = im + 0
-        #D.say('Total of pixels in image: ', np.sum(tim))
-        #D.say(Rj_ap_side, ' Rj ', ap_side, ' pix')
         if ap_side > 0:
-            ny, nx = tim.shape
-            #D.say('ycenter, ny: ', center[0], ny)
-            # Blank out pixels outside of the box
-            tim[0:int(center[0]-ap_side/2), :] = 0
-            tim[int(center[0]+ap_side/2):ny, :] = 0
-            tim[:, 0:int(center[1]-ap_side/2)] = 0
-            tim[:, int(center[1]+ap_side/2):nx] = 0
-            #impl = plt.imshow(tim, origin='lower',
-            #                  cmap=plt.cm.gray, filternorm=0, interpolation='none')
-            #plt.show()
-
+            # Sum inside the box
+            asum, count = im.box(slice(int(center[0]-ap_side/2),
+                                       int(center[0]+ap_side/2)),
+                                 slice(int(center[1]-ap_side/2),
+                                       int(center[1]+ap_side/2)))
         elif ap_side < 0:
-            # Blank out the box
-            tim[int(center[0]+ap_side/2):int(center[0]-ap_side/2),
-            int(center[1]+ap_side/2):int(center[1]-ap_side/2)] = 0
-            #impl = plt.imshow(tim, origin='lower',
-            #                  cmap=plt.cm.gray, filternorm=0, interpolation='none')
-            #plt.show()
-        asum = np.sum(tim)
-        #D.say(asum)
-        good_idx = np.where(tim != 0)
-        asum /= len(good_idx[0])
-        #D.say(asum)
+            # Sum outside the box
+            bsum, bcount = im.box(slice(int(center[0]+ap_side/2),
+                                        int(center[0]-ap_side/2)),
+                                  slice(int(center[1]+ap_side/2),
+                                        int(center[1]-ap_side/2)))
+            tsum, tcount = im.box()
+            asum = tsum - bsum
+            count = tcount - bcount
+        else:
+            asum, count = im.box()
+        asum /= count
     sap_side = str(abs(Rj_ap_side))
     if ap_side > 0:
         keypm = 'p'
@@ -702,7 +1169,9 @@ def Rj_box_sum(ang_width, im, center, Rj_ap_side, imtype, header, row):
     return key        
 
 def torus_box_sum(ang_width, im, center, ew, Rj_it, Rj_ot, Rj_h, imtype, header, row):
-    """Take aperture sums -- expressed as average pixel values -- for a square box Rj_ap_side Rj on a side.  Rj_ap_side = 0 whole image, Rj_ap_side > 0 box of that side and width in Rj centered on center of image, Rj_ap_side < 0 area outside of box.  ang_width is the angular diameter of Jupiter in arcsec"""
+    """Take aperture sums -- expressed as average pixel values -- for a square box Rj_ap_side Rj on a side.  Rj_ap_side = 0 whole image, Rj_ap_side > 0 box of that side and width in Rj centered on center of image, Rj_ap_side < 0 area outside of box.  ang_width is the angular diameter of Jupiter in arcsec.  im can be an ApertureSums"""
+    if not isinstance(im, ApertureSums):
+        im = ApertureSums(im)
     Rjpix = ang_width/2/plate_scale # arcsec / (arcsec/pix)
     #D.say('Rj = ', Rj, ' pixels')
     it = int(Rj_it * Rjpix)
@@ -710,11 +1179,11 @@ def torus_box_sum(ang_width, im, center, ew, Rj_it, Rj_ot, Rj_h, imtype, header,
     ho2 = int(Rj_h/2 * Rjpix) # half height
     center = center.astype(int)
     if ew == 'east':
-        asum = np.sum(im[center[0]-ot:center[0]-it,
-                         center[1]-ho2:center[1]+ho2])
+        asum, _ = im.box(slice(center[0]-ot, center[0]-it),
+                         slice(center[1]-ho2, center[1]+ho2))
     elif ew == 'west':
-        asum = np.sum(im[center[0]+it:center[0]+ot,
-                         center[1]-ho2:center[1]+ho2])
+        asum, _ = im.box(slice(center[0]+it, center[0]+ot),
+                         slice(center[1]-ho2, center[1]+ho2))
     else:
         raise ValueError('Expect ew east or west')
     asum /=(ot-it)*ho2*2
@@ -723,6 +1192,186 @@ def torus_box_sum(ang_width, im, center, ew, Rj_it, Rj_ot, Rj_h, imtype, header,
     row[key] = asum
     return key        
 
+class ApertureCatalog():
+    """Declarative set of apertures evaluated on an ApertureSums
+
+    Parameters
+    ----------
+    catalog : str or list
+        JSON filename or list of aperture set dictionaries.  Each
+        set has a name, a type and a list of values for each of the
+        type's parameters.  One aperture is made for each
+        combination of values, looping over the parameters in the
+        order listed below (first slowest).  Types are:
+
+        Rj_box : Rj_ap_side (see Rj_box_sum)
+        torus : ew, Rj_ot, Rj_it, Rj_h (see torus_box_sum)
+        Rj_aperture : yRj, xRj, rpix (see Rj_aperture_sum)
+
+        Default: aperture_catalog_fname
+
+    Apertures not entirely inside the region valid passed to evaluate
+    (e.g. the reduce_aperture_crop region of images that are 0
+    outside of it) are NaN
+    """
+    set_params = {'Rj_box': ['Rj_ap_side'],
+                  'torus': ['ew', 'Rj_ot', 'Rj_it', 'Rj_h'],
+                  'Rj_aperture': ['yRj', 'xRj', 'rpix']}
+
+    def __init__(self, catalog=None):
+        if catalog is None:
+            catalog = aperture_catalog_fname
+        if isinstance(catalog, str):
+            with open(catalog) as f:
+                catalog = json.load(f)
+        for apset in catalog:
+            params = self.set_params.get(apset.get('type'))
+            if params is None:
+                raise ValueError('Unknown aperture type '
+                                 + str(apset.get('type')) + ' in '
+                                 + str(apset.get('name')))
+            missing = [p for p in params if p not in apset]
+            if len(missing) > 0:
+                raise ValueError('Aperture set ' + str(apset.get('name'))
+                                 + ' missing ' + str(missing))
+        self.catalog = catalog
+
+    def expand(self, apset):
+        """Returns list of parameter tuples of the apertures in apset"""
+        return list(itertools.product(
+            *[apset[p] for p in self.set_params[apset['type']]]))
+
+    def Rj_box(self, apsums, Rjpix, center, imtype, apertures, valid=None):
+        Rj_ap_side = np.asarray([a[0] for a in apertures])
+        ap_side = (Rj_ap_side * Rjpix).astype(int)
+        h = np.abs(ap_side)/2
+        oob = ((h + center[0] >= apsums.shape[0])
+               | (center[0] - h < 0)
+               | (h + center[1] >= apsums.shape[1])
+               | (center[1] - h < 0))
+        # Box inside for > 0, box to exclude for < 0
+        a = np.abs(ap_side)
+        box = ((center[0] - a/2).astype(int),
+               (center[0] + a/2).astype(int),
+               (center[1] - a/2).astype(int),
+               (center[1] + a/2).astype(int))
+        bsums, bcounts = apsums.boxes(*box)
+        # Whole image and excluding-box apertures reach the edges
+        inside = np.where(ap_side > 0, apsums.inside(valid, *box),
+                          apsums.inside(valid, 0, apsums.shape[0],
+                                        0, apsums.shape[1]))
+        tsum, tcount = apsums.box()
+        sums = np.where(ap_side > 0, bsums,
+                        np.where(ap_side < 0, tsum - bsums, tsum))
+        counts = np.where(ap_side > 0, bcounts,
+                          np.where(ap_side < 0, tcount - bcounts, tcount))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = sums / counts
+        values = np.where(inside, values, np.nan)
+        results = []
+        for R, s, v, o in zip(Rj_ap_side, ap_side, values, oob):
+            sap_side = str(abs(R))
+            if s > 0:
+                keypm = 'p'
+                comstr = 'box ' + sap_side + ' Rj in size'
+            elif s < 0:
+                keypm = 'm'
+                comstr = 'excluding box ' + sap_side + ' Rj in size'
+            else:
+                keypm = '_'
+                comstr = 'entire image'
+            key = imtype + 'Rj' + keypm + sap_side
+            results.append(('HIERARCH ' + key, key,
+                            0 if o else v, 'average of ' + comstr))
+        return results
+
+    def torus(self, apsums, Rjpix, center, imtype, apertures, valid=None):
+        center = center.astype(int)
+        sign = np.asarray([-1 if a[0] == 'east' else 1
+                           for a in apertures])
+        if np.any([a[0] not in ['east', 'west'] for a in apertures]):
+            raise ValueError('Expect ew east or west')
+        ot = (np.asarray([a[1] for a in apertures]) * Rjpix).astype(int)
+        it = (np.asarray([a[2] for a in apertures]) * Rjpix).astype(int)
+        ho2 = (np.asarray([a[3] for a in apertures])/2 * Rjpix).astype(int)
+        # East is [c-ot:c-it], west is [c+it:c+ot]
+        y0 = np.where(sign < 0, center[0] - ot, center[0] + it)
+        y1 = np.where(sign < 0, center[0] - it, center[0] + ot)
+        box = (y0, y1, center[1] - ho2, center[1] + ho2)
+        sums, _ = apsums.boxes(*box)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = sums / ((ot - it)*ho2*2)
+        values = np.where(apsums.inside(valid, *box), values, np.nan)
+        results = []
+        for (ew, Rj_ot, Rj_it, Rj_h), v in zip(apertures, values):
+            key = f'{imtype}_IPT_{ew}_{Rj_it}_{Rj_ot}_{Rj_h}'
+            results.append(('HIERARCH ' + key, key, v, f'average {ew} IPT'))
+        return results
+
+    def Rj_aperture(self, apsums, Rjpix, center, imtype, apertures,
+                    valid=None):
+        center = center.astype(int)
+        y = (np.asarray([a[0] for a in apertures]) * Rjpix).astype(int)
+        x = (np.asarray([a[1] for a in apertures]) * Rjpix).astype(int)
+        rpix = np.asarray([a[2] for a in apertures])
+        r2 = (rpix/2).astype(int)
+        box = (center[0] + y - r2, center[0] + y + r2,
+               center[1] + x - r2, center[1] + x + r2)
+        sums, _ = apsums.boxes(*box)
+        values = sums / rpix**2
+        values = np.where(apsums.inside(valid, *box), values, np.nan)
+        results = []
+        for (yRj, xRj, r), v in zip(apertures, values):
+            key = imtype + 'AP' + str(xRj) + '_' + str(yRj)
+            results.append((key, key, v, str(r) + ' pix square aperture [-]NNN_[-]MMM Rj from Jupiter'))
+        return results
+
+    def evaluate(self, apsums, ang_width, center, imtype, header, row,
+                 timing=None, valid=None):
+        """Put aperture averages of apsums (an ApertureSums) into header
+        and row.  Returns list of keys.  If timing is a dictionary,
+        [number of apertures, elapsed seconds] of each set are
+        accumulated in it by set name.  If valid = (y0, y1, x0, x1),
+        apertures not entirely inside that region are NaN in row and
+        left out of header"""
+        Rjpix = ang_width/2/plate_scale # arcsec / (arcsec/pix)
+        center = np.asarray(center)
+        keys = []
+        for apset in self.catalog:
+            start = time.time()
+            apertures = self.expand(apset)
+            if len(apertures) == 0:
+                continue
+            evaluator = getattr(self, apset['type'])
+            for hkey, key, v, comment in evaluator(
+                    apsums, Rjpix, center, imtype, apertures, valid=valid):
+                # FITS headers can't hold NaN.  The row (ap_sum.csv)
+                # does
+                if np.isfinite(v):
+                    header[hkey] = (v, comment)
+                row[key] = v
+                keys.append(key)
+            if timing is not None:
+                t = timing.setdefault(apset['name'], [0, 0])
+                t[0] += len(apertures)
+                t[1] += time.time() - start
+        return keys
+
+_aperture_catalog = None
+def get_aperture_catalog():
+    """Returns ApertureCatalog read from aperture_catalog_fname, reading it
+    only once"""
+    global _aperture_catalog
+    if _aperture_catalog is None:
+        _aperture_catalog = ApertureCatalog()
+    return _aperture_catalog
+
+def log_aperture_timing(timing):
+    for name, (n, elapsed) in timing.items():
+        log.debug('Aperture set ' + name + ': ' + str(n)
+                  + ' apertures in ' + str(elapsed) + 's ('
+                  + str(elapsed/n) + 's per aperture)')
+
 def aperture_sum(im, center, y, x, r, imtype, header, row):
     """Take aperture sums of im.  y, x relative to center"""
     r2 = int(r/2)
@@ -751,6 +1400,107 @@ def Rj_aperture_sum(ang_width, im, center, yRj, xRj, rpix, imtype, header, row):
     row[key] = asum
     return key        
 
+def write_ap_sum(outfname, fieldnames, row, ap_sum_queue=None,
+                 signature=None):
+    """Send aperture sum row of reduced file outfname to the
+    ap_sum_writer reading ap_sum_queue, if provided.  Otherwise store
+    it directly and re-export ap_sum.csv in the directory of outfname"""
+    directory = os.path.dirname(os.path.abspath(outfname))
+    if ap_sum_queue is not None:
+        ap_sum_queue.put((outfname, directory, fieldnames, row, signature))
+        return
+    store = APSumStore()
+    store.put([(outfname, directory, fieldnames, row, signature)])
+    store.export_csv(os.path.join(directory, ap_sum_fname), [directory])
+
+def reduced_fname(rawfname):
+    """Returns reduced filename of absolute raw filename rawfname"""
+    # Expect raw filenames are of the format
+    # /data/io/IoIO/raw/2018-05-20/Na_on-band_001.fits
+    # Create reduced of the format
+    # /data/io/IoIO/reduced/2018-05-20/Na_on-band_001r.fits
+    # --> Consider making the filename out of the line and on-off
+    # We should be in our normal directory structure
+    basename = os.path.basename(rawfname)
+    # Insert "r" so no collisions are possible
+    fbase, _ = os.path.splitext(basename)
+    redbasename = fbase + 'r' + '.fits'
+    # --! This is an assumtion
+    rawdatepath = os.path.dirname(rawfname)
+    datedir = os.path.split(rawdatepath)[1]
+    return os.path.join(data_root, 'reduced', datedir, redbasename)
+
+def reduction_params():
+    """Returns dictionary of the reduction version and settings that
+    reduce_pair output depends on"""
+    return {'rversion': rversion,
+            'ND_algorithm_version': IoIO.ND_algorithm_version,
+            'back_level_method': IoIO.back_level_method,
+            'reduce_edge_mask': reduce_edge_mask,
+            'reduce_resample_order': reduce_resample_order,
+            'reduce_aperture_crop': reduce_aperture_crop,
+            'reduced_dtype': np.dtype(reduced_dtype).str,
+            'reduced_crop': reduced_crop,
+            'reduced_compression': reduced_compression,
+            'background_light_threshold': background_light_threshold,
+            'background_back_level_method': background_back_level_method,
+            'aperture_catalog': get_aperture_catalog().catalog}
+
+def file_identity(fname):
+    """Returns [absolute path, size, mtime_ns] of fname"""
+    st = os.stat(fname)
+    return [os.path.abspath(fname), st.st_size, st.st_mtime_ns]
+
+def pair_signature(OnBand_fname, OffBand_fname, on_back, off_back,
+                   default_ND_params, NPole_ang, ang_width):
+    """Returns hash of everything the reduction of an on/off pair
+    depends on: the identity of the files, their background (bias +
+    dark) values, default_ND_params, ephemeris values and
+    reduction_params()"""
+    return IoIO.NDParamsCache.param_hash(
+        {'on': file_identity(OnBand_fname),
+         'off': file_identity(OffBand_fname),
+         'on_back': on_back,
+         'off_back': off_back,
+         'default_ND_params': default_ND_params,
+         'NPole_ang': NPole_ang,
+         'ang_width': ang_width,
+         'params': reduction_params()})
+
+def night_signature(directory, collection=None, default_ND_params=None):
+    """Returns hash of the inputs of the reduction of the night of raw
+    data in directory: the identity of its files and flats, the
+    default_ND_params the night is reduced with (from its own flats
+    or, for nights without, carried over from another night), the
+    ephemeris at each on-band observation and reduction_params().
+    Returns None if the night can't be characterized (e.g. ephemeris
+    doesn't cover it)"""
+    if collection is None:
+        collection = HeaderCollection(directory)
+    try:
+        files = []
+        if collection.summary is not None:
+            files = [os.path.join(directory, f)
+                     for f in collection.summary['file']]
+        files.extend(get_flat_fnames(get_flat_collection(directory,
+                                                         collection)))
+        ephem = []
+        if 'filter' in collection.keywords:
+            date_obs = dict(zip(collection.summary['file'],
+                                collection.summary['date-obs']))
+            for on, off in get_on_off_pairs(directory, collection):
+                ephem.append(get_ephemeris().Jupiter(
+                    date_obs[os.path.basename(on)]))
+        files = [file_identity(f) for f in sorted(set(files))]
+    except Exception as e:
+        log.debug('No signature for ' + directory + ': ' + str(e))
+        return None
+    return IoIO.NDParamsCache.param_hash(
+        {'files': files,
+         'default_ND_params': default_ND_params,
+         'ephemeris': ephem,
+         'params': reduction_params()})
+
 def reduce_pair(OnBand_fname=None,
                 OffBand_fname=None,
                 back_obj=None,
@@ -758,9 +1508,13 @@ def reduce_pair(OnBand_fname=None,
                 NPole_ang=None,
                 ang_width=None,
                 outfname=None,
-                recalculate=False):
-     with fits.open(OnBand_fname) as OnBand_HDUList, \
-        fits.open(OffBand_fname) as OffBand_HDUList:
+                recalculate=False,
+                ap_sum_queue=None,
+                incremental=False):
+     # Stage times (see stage_timing) are of this pair only
+     stage_timing.reset()
+     with open_fits(OnBand_fname) as OnBand_HDUList, \
+        open_fits(OffBand_fname) as OffBand_HDUList:
         log.debug(OnBand_HDUList.filename() + ' ' + OffBand_HDUList.filename())
         # Check to see if we want to recalculate & overwrite.  Do this
         # in general so we can be called at any directory level
@@ -776,61 +1530,66 @@ def reduce_pair(OnBand_fname=None,
                 log.warning("Outfname not specified and on-band image fname was not an absolute path and outfname is not specified.  I can't deconstruct the raw to reduced path structure, writing to current directory, ReducedCorObs.fits")
                 outfname = 'ReducedCorObs.fits'
             else:
-                # Expect raw filenames are of the format
-                # /data/io/IoIO/raw/2018-05-20/Na_on-band_001.fits
-                # Create reduced of the format
-                # /data/io/IoIO/reduced/2018-05-20/Na_on-band_001r.fits
-                # --> Consider making the filename out of the line and on-off
-                # We should be in our normal directory structure
-                basename = os.path.basename(rawfname)
-                # Insert "r" so no collisions are possible
-                fbase, _ = os.path.splitext(basename)
-                redbasename = fbase + 'r' + '.fits'
-                # --! This is an assumtion
-                rawdatepath = os.path.dirname(rawfname)
-                datedir = os.path.split(rawdatepath)[1]
-                red_data_root = os.path.join(data_root, 'reduced')
-                reddir = os.path.join(data_root, 'reduced', datedir)
-                outfname = os.path.join(reddir, redbasename)
+                outfname = reduced_fname(rawfname)
     
         # Return if we have nothing to do.
         if (not recalculate
+            and not incremental
             and os.path.isfile(outfname)):
             log.debug('skipping -- output file exists and recalculate=False: '
                       + outfname)
             return
+        if back_obj is None:
+            rawfname = OnBand_HDUList.filename()
+            if rawfname is None:
+                back_obj = Background(OnBand_HDUList)
+            else:
+                back_obj = Background(os.path.dirname(rawfname))
+        signature = None
+        if incremental:
+            if NPole_ang is None:
+                NPole_ang, ang_width = get_ephemeris().Jupiter(T)
+            signature = pair_signature(
+                OnBand_fname, OffBand_fname,
+                back_obj.background(header),
+                back_obj.background(OffBand_HDUList[0].header),
+                default_ND_params, NPole_ang, ang_width)
+            if (not recalculate
+                and os.path.isfile(outfname)
+                and APSumStore().signature(outfname) == signature):
+                log.debug('skipping -- inputs unchanged since last reduction: '
+                          + outfname)
+                return
     
         # Use IoIO.CorObsData to get basic properties like background level
         # and center.
         OnBandObsData = IoIO.CorObsData(OnBand_HDUList,
                                         default_ND_params=default_ND_params,
-                                        edge_mask=reduce_edge_mask)
+                                        edge_mask=reduce_edge_mask,
+                                        ND_cache=ND_params_cache_fname)
         OffBandObsData = IoIO.CorObsData(OffBand_HDUList,
                                          default_ND_params=default_ND_params,
-                                         edge_mask=reduce_edge_mask)
-        if back_obj is None:
-            rawfname = OnBand_HDUList.filename()
-            if rawfname is None:
-                back_obj = Background(OnBand_HDUList)
-            else:
-                back_obj = Background(os.path.dirname(rawfname))
-        bias_dark = back_obj.background(OnBandObsData.header)
-        on_im = OnBand_HDUList[0].data -  bias_dark
+                                         edge_mask=reduce_edge_mask,
+                                         ND_cache=ND_params_cache_fname)
+        with stage_timing.stage('background'):
+            bias_dark = back_obj.background(OnBandObsData.header)
+            on_im = read_data(OnBand_HDUList) -  bias_dark
+            on_back = np.mean(on_im)
         header['ONBSUB'] = (bias_dark,
                              'on-band back (bias, dark) value subtracted')
         header['DONBSUB'] = (bias_dark - OnBandObsData.back_level,
                              'on-band back - ind. est. back via histogram')
     
-        on_back = np.mean(on_im)
         if on_back > background_light_threshold:
             log.warning('On-band background level too high: ' + str(on_back)
                         + ' for ' + OnBand_HDUList.filename())
             return
-        bias_dark = back_obj.background(OffBandObsData.header)
-        off_im = OffBand_HDUList[0].data - bias_dark
+        with stage_timing.stage('background'):
+            bias_dark = back_obj.background(OffBandObsData.header)
+            off_im = read_data(OffBand_HDUList) - bias_dark
+            off_back = np.mean(off_im)
         #D.say('Off-band difference between bias+dark and first hist peak: ' ,
         #      bias_dark - OffBandObsData.back_level)
-        off_back = np.mean(off_im)
         if off_back > background_light_threshold:
             log.warning('Off-band background level too high: ' + str(off_back)
                         + ' for ' + OffBand_HDUList.filename())
@@ -849,21 +1608,10 @@ def reduce_pair(OnBand_fname=None,
         # --> subsequent reduction & analysis do things in native
         # --> coordinates
         
-        # Calculate NPole_ang if we weren't passed it, but store it in
-        # property so it can be used for the next file in this day.
-        # Also truncate to the integer so that astroquery caching can
-        # work --> might want to loosen this for nth degree
-        # calculations when I am ready for those
+        # Interpolate NPole_ang and ang_width from the local ephemeris
+        # table if we weren't passed them.  See ephemeris.py populate
         if NPole_ang is None:
-            # V09 is the Moka observatory at Benson, which looks like
-            # the San Pedro Valley observatory
-            # --> eventually I might want to be general with the object
-            jup = Horizons(id=599,
-                           location='V09',
-                           epochs=np.round(T.jd),
-                           id_type='majorbody')
-            NPole_ang = jup.ephemerides()['NPole_ang'].quantity.value[0]
-            ang_width = jup.ephemerides()['ang_width'].quantity.value[0]
+            NPole_ang, ang_width = get_ephemeris().Jupiter(T)
 
         # --> This is where we do the off-Jupiter reduction
         if ('Na' in header['FILTER'] and
@@ -901,7 +1649,6 @@ def reduce_pair(OnBand_fname=None,
             # Do some quick-and-dirty aperture sums
             # --> improve on this
             #fieldnames = ['TMID', 'ANGDIAM', 'EXPTIME', 'FNAME', 'LINE', 'ONBSUB', 'OFFBSUB', 'DONBSUB', 'DOFFBSUB']
-            this_ap_sum_fname = os.path.join(reddir, ap_sum_fname)
             tmid = (get_tmid(header)).fits
             header['TMID'] = (tmid, 'Midpoint of observation')
             header['ANGDIAM'] = (ang_width, 'Angular diameter of Jupiter (arcsec)')
@@ -917,6 +1664,8 @@ def reduce_pair(OnBand_fname=None,
                    'ADU2R': ADU2R,
                    'ANGDIAM': ang_width}
             fieldnames = list(row.keys())
+            ap_catalog = get_aperture_catalog()
+            ap_timing = {}
             for imtype in ['AP', 'On', 'Off']:
                 if imtype == 'AP':
                     im = na_im
@@ -927,31 +1676,16 @@ def reduce_pair(OnBand_fname=None,
                 else:
                     raise ValueError('Unknown imtype ' + imtype)
                 center = np.asarray(im.shape)/2
-                #for ap_height in [0, 1200, 600, 300, -300, -600, -1200]:
-                #    key = strip_sum(im, center, ap_height, imtype, header, row)
-                #    fieldnames.append(key)
-                for ap_box in [0, 150, 140, 130, 120, 110, 100, 90, 80, 70, 60, 50, 40, 30, 15, 10, 5]:
-                    key = Rj_box_sum(ang_width, im, center, ap_box, imtype, header, row)
-                    fieldnames.append(key)
-                # --> Add torus columns
-                for ew in ['east', 'west']:
-                    for ot in [8, 7, 6]:
-                        for it in [1, 2, 3, 4, 5]:
-                            for h in [1, 2, 3, 4, 5]:
-                                key = torus_box_sum(ang_width, im,
-                                                    center, ew,
-                                                    it, ot, h,
-                                                    imtype, header, row)
-                                fieldnames.append(key)
-    
-                #for y in [600, 150, 0, -150, -600]:
-                #    for x in [-600, -500, -400, -300, -200, 200, 300, 400, 500, 600]:
-                #        key = aperture_sum(im, center, y, x, 60, imtype, header, row)
-                #        fieldnames.append(key)
-                #for y in [30, 20, 10, 5, 0, -5, -10, -20, -30]:
-                #    for x in [30, 20, 10, 5, 0, -5, -10, -20, -30]:
-                #        key = Rj_aperture_sum(ang_width, im, center, y, x, 60, imtype, header, row)
-                #        fieldnames.append(key)
+                with stage_timing.stage('apertures'):
+                    # One pass to build summed-area tables for all
+                    # apertures
+                    im = ApertureSums(im)
+                    # Aperture sets (boxes, torus ribbons, etc.) are
+                    # listed in aperture_catalog_fname
+                    fieldnames.extend(ap_catalog.evaluate(
+                        im, ang_width, center, imtype, header, row,
+                        timing=ap_timing))
+            log_aperture_timing(ap_timing)
             rdate = (Time.now()).fits
             header['RDATE'] = (rdate, 'UT time of reduction')
             header['RVERSION'] = (rversion, 'Reduction version')
@@ -959,24 +1693,16 @@ def reduce_pair(OnBand_fname=None,
             row['RVERSION'] = rversion
             fieldnames.extend(['RDATE', 'RVERSION'])
             # Get ready to write some output to the reduced directory
-            if not os.path.exists(red_data_root):
-                os.mkdir(red_data_root)
-            if not os.path.exists(reddir):
-                os.mkdir(reddir)
-    
-            if not os.path.exists(this_ap_sum_fname):
-                with open(this_ap_sum_fname, 'w', newline='') as csvfile:
-                    csvdw = csv.DictWriter(csvfile, fieldnames=fieldnames,
-                                           quoting=csv.QUOTE_NONNUMERIC)
-                    csvdw.writeheader()
-            with open(this_ap_sum_fname, 'a', newline='') as csvfile:
-                csvdw = csv.DictWriter(csvfile, fieldnames=fieldnames,
-                                       quoting=csv.QUOTE_NONNUMERIC)
-                csvdw.writerow(row)
-        
-            # Get ready to write
-            OnBand_HDUList[0].data = na_im
-            OnBand_HDUList.writeto(outfname, overwrite=recalculate)
+            os.makedirs(os.path.dirname(os.path.abspath(outfname)),
+                        exist_ok=True)
+            if stage_times_to_header:
+                stage_timing.to_header(header, stage_timing.stage_times())
+            with stage_timing.stage('write'):
+                write_ap_sum(outfname, fieldnames, row, ap_sum_queue,
+                             signature=signature)
+                # Jupiter isn't in the image, so no crop
+                write_reduced(outfname, na_im, header,
+                              overwrite=recalculate or incremental)
             return
 
 
@@ -1043,7 +1769,9 @@ def reduce_pair(OnBand_fname=None,
         #                          on_center[1]-25:on_center[1]+25])
         #off_jup = np.average(off_im[off_center[0]-25:off_center[0]+25,
         #                            off_center[1]-25:off_center[1]+25])
-        off_im = ndimage.interpolation.shift(off_im, shift_off)
+        with stage_timing.stage('shift_rotate'):
+            off_im = ndimage.interpolation.shift(off_im, shift_off,
+                                                 order=reduce_resample_order)
         # Note transpose for FITS/FORTRAN from C world
         header['OFFS0'] = (shift_off[1], 'off-band axis 0 shift to align w/on-band')
         header['OFFS1'] = (shift_off[0], 'off-band axis 1 shift to align w/on-band')
@@ -1065,7 +1793,7 @@ def reduce_pair(OnBand_fname=None,
                              OnBandObsData.header['FILTER'])
         header['ON_LOSS'] \
             = (on_loss, 'on-band scat. light loss for discrete sources')
-        off_im[OffBandObsData.ND_coords] = 0
+        off_im[OffBandObsData.ND_mask] = 0
         # X--> Temporarily fix offscale and add MOFFSCL to header
         #moffscale = on_jup/off_jup
         #header['MOFFSCL'] = (moffscale, 'measured on/off Jupiter intensity')
@@ -1091,11 +1819,11 @@ def reduce_pair(OnBand_fname=None,
         # Get an on-band ObsData that has the ND_coords inside the edge of
         # the ND filter and use that to define the good ND filter pixels
         O = IoIO.CorObsData(OnBand_HDUList, default_ND_params=default_ND_params)
-        good_ndpix = scat_sub_im[O.ND_coords]
+        good_ndpix = scat_sub_im[O.ND_mask]
         # Blank out our ND filter with the reduce_edge_mask
-        scat_sub_im[OnBandObsData.ND_coords] = 0
+        scat_sub_im[OnBandObsData.ND_mask] = 0
         # Poke back in good pixels
-        scat_sub_im[O.ND_coords] = good_ndpix
+        scat_sub_im[O.ND_mask] = good_ndpix
         header['OFFFNAME'] = (OffBand_HDUList.filename(),
                               'off-band file')
         header['OFFSCALE'] = (offscale, 'scale factor applied to off-band im')
@@ -1134,10 +1862,13 @@ def reduce_pair(OnBand_fname=None,
         aangle = get_astrometry_angle(header['DATE-OBS'])
         on_angle = aangle - NPole_ang + gem_flip
         # interpolation.rotate rotates CW for positive angle
-        scat_sub_im = ndimage.interpolation.shift(scat_sub_im, on_shift)
         # --> rotation by small NPole_ang gives a slight pincushion
         # effect.  This is why we want to do all calcs without rotating!
-        scat_sub_im = ndimage.interpolation.rotate(scat_sub_im, on_angle)
+        # Coronagraph flips images N/S.  Transpose alert.  Shift,
+        # rotate and flip are done in one resampling
+        with stage_timing.stage('shift_rotate'):
+            scat_sub_im = shift_rotate(scat_sub_im, on_shift, on_angle,
+                                       flipud=True)
     
         # Update centers and NDparams
         center = np.asarray(scat_sub_im.shape)/2
@@ -1171,13 +1902,9 @@ def reduce_pair(OnBand_fname=None,
         header['NDPAR00'] = -np.tan(np.arctan(ND00) + ron_angle)
         header['NDPAR10'] = -np.tan(np.arctan(ND10) + ron_angle)
     
-        # Coronagraph flips images N/S.  Transpose alert
-        scat_sub_im =np.flipud(scat_sub_im)
-    
         # Do some quick-and-dirty aperture sums
         # --> improve on this
         #fieldnames = ['TMID', 'ANGDIAM', 'EXPTIME', 'FNAME', 'LINE', 'ONBSUB', 'OFFBSUB', 'DONBSUB', 'DOFFBSUB']
-        this_ap_sum_fname = os.path.join(reddir, ap_sum_fname)
         tmid = (get_tmid(header)).fits
         header['TMID'] = (tmid, 'Midpoint of observation')
         header['ANGDIAM'] = (ang_width, 'Angular diameter of Jupiter (arcsec)')
@@ -1193,52 +1920,52 @@ def reduce_pair(OnBand_fname=None,
                'ADU2R': ADU2R,
                'ANGDIAM': ang_width}
         fieldnames = list(row.keys())
+        ap_catalog = get_aperture_catalog()
+        ap_timing = {}
+        crop = None
+        if reduce_aperture_crop is not None:
+            Rjpix = ang_width/2/plate_scale # arcsec / (arcsec/pix)
+            c = (center).astype(int)
+            h = int(reduce_aperture_crop * Rjpix)
+            crop = (c[0] - h, c[0] + h, c[1] - h, c[1] + h)
+            # On and Off apertures that reach outside the crop (e.g.
+            # the whole image) would be averages over the crop, so
+            # they are NaN
+            header['APCROP'] = (reduce_aperture_crop, 'On/Off apertures beyond this half-width (Rj) are NaN/absent')
+            row['APCROP'] = reduce_aperture_crop
+            fieldnames.append('APCROP')
         # Remember to shift, rotate, and calibrate On and Off images
         for imtype in ['AP', 'On', 'Off']:
+            # Region of im with resampled data
+            valid = crop
             if imtype == 'AP':
                 im = scat_sub_im
+                valid = None
             elif imtype == 'On':
-                on_im = ndimage.interpolation.shift(on_im, on_shift)
-                on_im = ndimage.interpolation.rotate(on_im, on_angle)
-                im = on_im / ADU2R
+                with stage_timing.stage('shift_rotate'):
+                    im = shift_rotate(on_im, on_shift, on_angle, crop=crop)
+                # Drop unneeded full frames as we go to keep peak
+                # memory down
+                on_im = None
+                im /= ADU2R
             elif imtype == 'Off':
-                off_im = ndimage.interpolation.shift(off_im, on_shift)
-                off_im = ndimage.interpolation.rotate(off_im, on_angle)
-                im = off_im / ADU2R
+                with stage_timing.stage('shift_rotate'):
+                    im = shift_rotate(off_im, on_shift, on_angle, crop=crop)
+                off_im = None
+                im /= ADU2R
             else:
                 raise ValueError('Unknown imtype ' + imtype)
             center = np.asarray(im.shape)/2
-            #for ap_height in [0, 1200, 600, 300, -300, -600, -1200]:
-            #    key = strip_sum(im, center, ap_height, imtype, header, row)
-            #    fieldnames.append(key)
-            for ap_box in [0, 150, 140, 130, 120, 110, 100, 90, 80, 70, 60, 50, 40, 30, 15, 10, 5]:
-                key = Rj_box_sum(ang_width, im, center, ap_box, imtype, header, row)
-                fieldnames.append(key)
-            # --> Add torus columns
-            for ew in ['east', 'west']:
-                for ot in [8, 7, 6]:
-                    for it in [1, 2, 3, 4, 5]:
-                        for h in [1, 2, 3, 4, 5]:
-                            key = torus_box_sum(ang_width, im,
-                                                center, ew,
-                                                it, ot, h,
-                                                imtype, header, row)
-                            fieldnames.append(key)
-                
-
-
-
-
-
-
-            #for y in [600, 150, 0, -150, -600]:
-            #    for x in [-600, -500, -400, -300, -200, 200, 300, 400, 500, 600]:
-            #        key = aperture_sum(im, center, y, x, 60, imtype, header, row)
-            #        fieldnames.append(key)
-            #for y in [30, 20, 10, 5, 0, -5, -10, -20, -30]:
-            #    for x in [30, 20, 10, 5, 0, -5, -10, -20, -30]:
-            #        key = Rj_aperture_sum(ang_width, im, center, y, x, 60, imtype, header, row)
-            #        fieldnames.append(key)
+            with stage_timing.stage('apertures'):
+                # One pass to build summed-area tables for all apertures
+                im = ApertureSums(im)
+                # Aperture sets (boxes, torus ribbons, etc.) are listed in
+                # aperture_catalog_fname
+                fieldnames.extend(ap_catalog.evaluate(
+                    im, ang_width, center, imtype, header, row,
+                    timing=ap_timing, valid=valid))
+            im = None
+        log_aperture_timing(ap_timing)
         rdate = (Time.now()).fits
         header['RDATE'] = (rdate, 'UT time of reduction')
         header['RVERSION'] = (rversion, 'Reduction version')
@@ -1246,23 +1973,197 @@ def reduce_pair(OnBand_fname=None,
         row['RVERSION'] = rversion
         fieldnames.extend(['RDATE', 'RVERSION'])
         # Get ready to write some output to the reduced directory
-        if not os.path.exists(red_data_root):
-            os.mkdir(red_data_root)
-        if not os.path.exists(reddir):
-            os.mkdir(reddir)
-        if not os.path.exists(this_ap_sum_fname):
-            with open(this_ap_sum_fname, 'w', newline='') as csvfile:
-                csvdw = csv.DictWriter(csvfile, fieldnames=fieldnames,
-                                       quoting=csv.QUOTE_NONNUMERIC)
-                csvdw.writeheader()
-        with open(this_ap_sum_fname, 'a', newline='') as csvfile:
-            csvdw = csv.DictWriter(csvfile, fieldnames=fieldnames,
-                                   quoting=csv.QUOTE_NONNUMERIC)
-            csvdw.writerow(row)
-    
-        # Get ready to write
-        OnBand_HDUList[0].data = scat_sub_im
-        OnBand_HDUList.writeto(outfname, overwrite=recalculate)
+        os.makedirs(os.path.dirname(os.path.abspath(outfname)),
+                    exist_ok=True)
+        if stage_times_to_header:
+            # Everything but the write itself
+            stage_timing.to_header(header, stage_timing.stage_times())
+        with stage_timing.stage('write'):
+            write_ap_sum(outfname, fieldnames, row, ap_sum_queue,
+                         signature=signature)
+            write_reduced(outfname, scat_sub_im, header, ang_width,
+                          overwrite=recalculate or incremental)
+
+def write_reduced(outfname, im, header, ang_width=None, overwrite=False):
+    """Write reduced image im with header to outfname in the
+    reduced_dtype, reduced_crop and reduced_compression format.  If
+    ang_width is None, the image isn't cropped.  Otherwise Jupiter is
+    at the center of im and the crop is centered on it, so code that
+    finds Jupiter at the center of the image still works.  The geometry is recorded in CROP_X0, CROP_Y0, FULL_NX and FULL_NY,
+    and OBJ_CR*, DES_CR* and NDPAR*1 are moved to the cropped image"""
+    if reduced_crop is not None and ang_width is not None:
+        ny, nx = im.shape
+        c = (np.asarray(im.shape)/2).astype(int)
+        Rjpix = ang_width/2/plate_scale # arcsec / (arcsec/pix)
+        h = min(int(reduced_crop * Rjpix), c[0], c[1], ny - c[0], nx - c[1])
+        y0 = c[0] - h
+        x0 = c[1] - h
+        # MovieCorObs judges the background from the mean of the
+        # whole image
+        header['FULLMEAN'] = (np.mean(im), 'mean of uncropped image')
+        header['CROP_RJ'] = (reduced_crop, 'half-width of crop around Jupiter (Rj)')
+        header['CROP_X0'] = (x0, 'X origin of crop in uncropped image')
+        header['CROP_Y0'] = (y0, 'Y origin of crop in uncropped image')
+        header['FULL_NX'] = (nx, 'X size of uncropped image')
+        header['FULL_NY'] = (ny, 'Y size of uncropped image')
+        im = im[y0:y0+2*h, x0:x0+2*h]
+        header['OBJ_CR0'] -= x0
+        header['OBJ_CR1'] -= y0
+        header['DES_CR0'] -= x0
+        header['DES_CR1'] -= y0
+        # ND filter edges are x = offset + slope*(y - ny/2)
+        for slope, offset in (('NDPAR00', 'NDPAR01'),
+                              ('NDPAR10', 'NDPAR11')):
+            header[offset] += (- x0 + header[slope]*(c[0] - ny/2))
+    if reduced_dtype is not None:
+        im = im.astype(reduced_dtype)
+    if reduced_compression is None:
+        fits.PrimaryHDU(im, header).writeto(outfname, overwrite=overwrite)
+        return
+    # Header-only readers (e.g. HeaderCollection) see the whole header
+    # in the primary HDU.  fits_access.read_data finds the image
+    fits.HDUList([fits.PrimaryHDU(header=header),
+                  fits.CompImageHDU(im, header,
+                                    compression_type=reduced_compression)]
+                 ).writeto(outfname, overwrite=overwrite)
+
+def tmid_jd(table):
+    """Returns array of float JD of the midpoints of the observations
+    in table (e.g. rows of a collection summary)"""
+    return (Time(list(table['date-obs']), format='fits').jd
+            + np.asarray(table['exptime'])/2/86400)
+
+def get_on_off_matches(directory, collection, policy=None):
+    """Returns list of (on-band filename, list of off-band filenames,
+    list of their weights) for each of our science lines in directory,
+    with the off-band frames chosen by pairing.match policy (default
+    on_off_pairing_policy)"""
+    if policy is None:
+        policy = on_off_pairing_policy
+    summary_table = collection.summary
+    # --> for 2019, use exposure time > 20s to make sure the short
+    # exposures don't mess up proper 300s/60s on/off pairs
+    line_names = ['[SII]', 'Na']
+    matches = []
+    for line in line_names:
+        on_filt = get_filt_name(collection, line, 'on')
+        off_filt = get_filt_name(collection, line, 'off')
+        on_idx = [i for i, l in enumerate(summary_table)
+                  if (l['filter'] == on_filt
+                      and l['imagetyp'].lower() == 'light'
+                      and l['xbinning'] == 1
+                      and l['ybinning'] == 1
+                      and l['exptime'] > 10)]
+        if len(on_idx) == 0:
+            break
+        off_idx = [i for i, l in enumerate(summary_table)
+                   if (l['filter'] == off_filt
+                       and l['imagetyp'].lower() == 'light'
+                       and l['xbinning'] == 1
+                       and l['ybinning'] == 1
+                       and l['exptime'] > 10)]
+
+        if len(off_idx) == 0:
+            break
+        # Times are converted once per line, rather than for each
+        # on-band frame
+        idx, weights = pairing.match(tmid_jd(summary_table[on_idx]),
+                                     tmid_jd(summary_table[off_idx]),
+                                     policy)
+        off_fnames = [os.path.join(directory, summary_table[i]['file'])
+                      for i in off_idx]
+        for i_on, i_off, w in zip(on_idx, idx, weights):
+            on_fname = os.path.join(directory, summary_table[i_on]['file'])
+            # Drop placeholder second frame of single-frame policies
+            n = 1 if w[1] == 0 else 2
+            matches.append((on_fname,
+                            [off_fnames[i] for i in i_off[0:n]],
+                            w[0:n].tolist()))
+    return matches
+
+def get_on_off_pairs(directory, collection, policy=None):
+    """Returns list of [on-band, off-band] filename pairs for each of
+    our science lines in directory.  policy is a pairing.match policy
+    that picks one off-band frame (default on_off_pairing_policy)"""
+    if policy is None:
+        policy = on_off_pairing_policy
+    if policy == 'bracket':
+        raise ValueError('reduce_pair takes one off-band frame, use '
+                         'get_on_off_matches for bracket pairing')
+    return [[on, offs[0]] for on, offs, w
+            in get_on_off_matches(directory, collection, policy)]
+
+# reduce_pair keyword arguments shared by all of the pairs a pool
+# worker reduces.  Set once per worker by init_reduce_worker, so each
+# task only carries its filenames
+_reduce_worker_state = {}
+# Unpickled per-night states (see reduce_pair_task), most recent last
+_reduce_night_states = {}
+reduce_night_states_size = 4
+
+def init_reduce_worker(state):
+    """Pool initializer.  state is a dictionary of reduce_pair keyword
+    arguments (e.g. back_obj, default_ND_params, ap_sum_queue) used for
+    every pair.  Also loads the ephemeris and aperture catalog, which
+    are read once per process"""
+    _reduce_worker_state.clear()
+    _reduce_worker_state.update(state)
+    _reduce_night_states.clear()
+    get_ephemeris().table
+    get_aperture_catalog()
+
+def reduce_pair_task(pair, night=None, night_state=None):
+    """Pool task that reduces one pair with the init_reduce_worker
+    state, logging rather than raising errors.  For pools that span
+    several nights, night_state is a pickle of the keyword arguments
+    specific to night, which is only unpickled the first time a worker
+    sees night.  Returns (success, time spent in reduce_pair,
+    fits_access.io_stats(), stage_timing.stage_times())"""
+    start = time.time()
+    kwargs = dict(_reduce_worker_state)
+    if night is not None:
+        if night not in _reduce_night_states:
+            _reduce_night_states[night] = pickle.loads(night_state)
+            if len(_reduce_night_states) > reduce_night_states_size:
+                del _reduce_night_states[next(iter(_reduce_night_states))]
+        kwargs.update(_reduce_night_states[night])
+    stage_timing.reset()
+    try:
+        reduce_pair(pair[0], pair[1], **kwargs)
+    except Exception as e:
+        log.error(str(e) + ' skipping ' + pair[0] + ' ' + pair[1])
+        return (False, time.time() - start, io_stats(),
+                stage_timing.stage_times())
+    return (True, time.time() - start, io_stats(),
+            stage_timing.stage_times())
+
+def pair_timing(pair, result):
+    """Returns per-pair stage timing record of the reduce_pair_task
+    result of pair"""
+    return {'on': pair[0],
+            'off': pair[1],
+            'ok': result[0],
+            'elapsed': result[1],
+            'stages': result[3]}
+
+def record_stage_times(label, results, tasks=None):
+    """Log summary of the stage times of reduce_pair_task results
+    and append it, with the optional per-pair records in tasks, to
+    stage_timing_fname"""
+    summary = stage_timing.summarize([r[1] for r in results],
+                                     [r[3] for r in results])
+    stage_timing.log_summary(label, summary)
+    stage_timing.write_record(stage_timing_fname, label, summary, tasks)
+
+def log_dispatch_overhead(label, npairs, num_processes, elapsed,
+                          task_times, task_bytes):
+    """Log the pool time per pair not spent in reduce_pair (pickling,
+    dispatch and idle workers) and the size of each task"""
+    if npairs == 0:
+        return
+    overhead = (num_processes*elapsed - np.sum(task_times))/npairs
+    log.info(label + ' pool overhead per pair: ' + str(overhead)
+             + 's, ' + str(task_bytes) + ' bytes pickled per task')
 
 class ReduceDir():
     def __init__(self,
@@ -1275,17 +2176,21 @@ class ReduceDir():
                  NPole_ang=None,
                  ang_width=None,
                  num_processes=None,
-                 movie=None):
+                 movie=None,
+                 incremental=False):
         assert directory is not None
         self.directory = directory
         self._collection = collection
         self.recalculate = recalculate
+        self.incremental = incremental
         self._back_obj = back_obj
         self._default_ND_params = default_ND_params
         # --> This will eventually be a more involved set of ephemerides outputs
         self.NPole_ang = NPole_ang
         self.ang_width = ang_width
-        self.num_processes = num_processes
+        if num_processes is None:
+            num_processes=int(os.cpu_count()/threads_per_core)
+        self.num_processes = int(num_processes)
         self.movie = movie
         self.reduce_dir()
 
@@ -1293,7 +2198,7 @@ class ReduceDir():
     def collection(self):
         if self._collection is not None:
             return self._collection
-        self._collection = ccdproc.ImageFileCollection(self.directory)
+        self._collection = HeaderCollection(self.directory)
         return self._collection
 
     @property
@@ -1301,6 +2206,7 @@ class ReduceDir():
         if self._back_obj is not None:
             return self._back_obj
         self._back_obj = Background(self.directory, self.collection)
+        return self._back_obj
 
     @property
     def default_ND_params(self):
@@ -1316,25 +2222,22 @@ class ReduceDir():
             self._default_ND_params = IoIO.run_level_default_ND_params
         return self._default_ND_params
 
-    def worker_reduce_pair(self, pair):
-        try:
-            reduce_pair(pair[0],
-                        pair[1],
-                        back_obj=self.back_obj,
-                        default_ND_params=self.default_ND_params,
-                        NPole_ang=self.NPole_ang,
-                        ang_width=self.ang_width,
-                        recalculate=self.recalculate)
-        except Exception as e:
-            log.error(str(e) + ' skipping ' + pair[0] + ' ' + pair[1])
-
-        
     def reduce_dir(self):
         if not 'filter' in self.collection.keywords:
             log.warning('FILTER keyword not present in any FITS headers, no usable files in ' + self.directory)
             return None 
-        summary_table = self.collection.summary
         reduced_dir = self.directory.replace('/raw/', '/reduced/')
+        store = APSumStore()
+        signature = None
+        if self.incremental:
+            signature = night_signature(self.directory, self.collection,
+                                        self.default_ND_params)
+            if (not self.recalculate
+                and signature is not None
+                and store.night_signature(reduced_dir) == signature):
+                log.info('Nothing changed since last reduction of '
+                         + self.directory)
+                return
         # --! We need to make sure the Background and
         # default_ND_params code has run once so it evaluates to a
         # value rather than a method when used with multiprocessing
@@ -1347,79 +2250,76 @@ class ReduceDir():
             return
         self.default_ND_params
 
-        # Create a list of on-band off-band pairs that are closest in
-        # time for each of our science lines
-        # --> for 2019, use exposure time > 20s to make sure the short
-        # exposures don't mess up proper 300s/60s on/off pairs
-        line_names = ['[SII]', 'Na']
-        on_off_pairs = []
-        for line in line_names:
-            on_filt = get_filt_name(self.collection, line, 'on')
-            off_filt = get_filt_name(self.collection, line, 'off')
-            on_idx = [i for i, l in enumerate(summary_table)
-                      if (l['filter'] == on_filt
-                          and l['imagetyp'].lower() == 'light'
-                          and l['xbinning'] == 1
-                          and l['ybinning'] == 1
-                          and l['exptime'] > 10)]
-            if len(on_idx) == 0:
-                break
-            off_idx = [i for i, l in enumerate(summary_table)
-                       if (l['filter'] == off_filt
-                           and l['imagetyp'].lower() == 'light'
-                           and l['xbinning'] == 1
-                           and l['ybinning'] == 1
-                           and l['exptime'] > 10)]
-
-            if len(off_idx) == 0:
-                break
-            for i_on in on_idx:
-                tmid_on = get_tmid(summary_table[i_on])
-                dts = [tmid_on - T for T in get_tmid(summary_table[off_idx])]
-                # Unwrap
-                i_off = off_idx[np.argmin(np.abs(dts))]
-                on_fname = os.path.join(self.directory,
-                                        summary_table[i_on]['file'])
-                off_fname = os.path.join(self.directory,
-                                         summary_table[i_off]['file'])
-                pair = [os.path.join(self.directory,
-                                     summary_table[i]['file'])
-                                     for i in (i_on, i_off)]
-                on_off_pairs.append(pair)
+        on_off_pairs = get_on_off_pairs(self.directory, self.collection)
         if len(on_off_pairs) == 0:
             log.warning('No object files found in ' + self.directory)
             return
     
-        # --> I am going to want to improve this
-        if self.NPole_ang is None:
-            # Reading in our first file is the easiest way to get the
-            # properly formatted date for astroquery.  Use UT00:00,
-            # since astroquery caches and repeat querys for the whole
-            # day will therefore benefit
-            with fits.open(on_off_pairs[0][0]) as HDUL:
-                T = Time(HDUL[0].header['DATE-OBS'], format='fits')
-                jup = Horizons(id=599,
-                               location='V09',
-                               epochs=np.round(T.jd),
-                               id_type='majorbody')
-                self.NPole_ang = jup.ephemerides()['NPole_ang'].quantity.value[0]
-                self.ang_width = jup.ephemerides()['ang_width'].quantity.value[0]
+        # If self.NPole_ang is None, reduce_pair interpolates the
+        # ephemeris for each pair
         
-        # Get our summary file(s) ready.
+        # Get our summary store ready.
         this_ap_sum_fname = os.path.join(reduced_dir, ap_sum_fname)
-        if self.recalculate and os.path.isfile(this_ap_sum_fname):
-            # All files will be rewritten, so we want to start with a
-            # frech file
-            os.remove(os.path.join(reduced_dir, ap_sum_fname))
-        else:
+        if self.recalculate:
+            # All files will be rewritten, so we want to start fresh
+            store.delete(reduced_dir)
+        elif (os.path.isfile(this_ap_sum_fname)
+              and store.count(reduced_dir) == 0):
             # If reduced files already exist, they will be skipped,
             # but we may have improved the code to add more reduced
-            # files, in which case we want their records to append to
-            # the summary file(s)
-            pass
+            # files.  Bring in records of a CSV written before we had
+            # the store so they aren't lost
+            store.ingest_csv(this_ap_sum_fname, reduced_dir)
         start = time.time()
-        with Pool(int(args.num_processes)) as p:
-            p.map(self.worker_reduce_pair, on_off_pairs)
+        # Directory-level state goes to each worker once, rather than
+        # with every pair
+        state = {'back_obj': self.back_obj,
+                 'default_ND_params': self.default_ND_params,
+                 'NPole_ang': self.NPole_ang,
+                 'ang_width': self.ang_width,
+                 'recalculate': self.recalculate,
+                 'incremental': self.incremental}
+        num_processes = self.num_processes
+        # Workers send their rows to one writer thread, so they never
+        # contend for the store
+        with Manager() as manager:
+            ap_sum_queue = manager.Queue()
+            state['ap_sum_queue'] = ap_sum_queue
+            writer_errors = []
+            writer = threading.Thread(target=ap_sum_writer,
+                                      args=(ap_sum_queue, store.fname,
+                                            None, writer_errors))
+            writer.start()
+            try:
+                pool_start = time.time()
+                with Pool(num_processes,
+                          initializer=init_reduce_worker,
+                          initargs=(state,)) as p:
+                    results = p.map(reduce_pair_task, on_off_pairs)
+                pool_elapsed = time.time() - pool_start
+            finally:
+                ap_sum_queue.put(None)
+                writer.join()
+        # Rows the writer didn't store would be missing from ap_sum.csv
+        check_writer(writer_errors)
+        ok = [r[0] for r in results]
+        log_dispatch_overhead(self.directory, len(on_off_pairs),
+                              num_processes, pool_elapsed,
+                              [r[1] for r in results],
+                              len(pickle.dumps(on_off_pairs[0])))
+        log_io_stats(self.directory, [r[2] for r in results])
+        record_stage_times(self.directory, results,
+                           [pair_timing(pair, r)
+                            for pair, r in zip(on_off_pairs, results)])
+        if self.incremental:
+            # Drop records of raw files that are gone
+            store.prune(reduced_dir,
+                        [reduced_fname(on) for on, off in on_off_pairs])
+            # Errors may be transient, so try again next time
+            if signature is not None and np.all(ok):
+                store.put_night_signature(reduced_dir, signature)
+        if os.path.isdir(reduced_dir):
+            store.export_csv(this_ap_sum_fname, [reduced_dir])
 
         elapsed = time.time() - start
         log.info('Elapsed time for ' + self.directory + ': ' + str(elapsed))
@@ -1430,7 +2330,8 @@ class ReduceDir():
             # We can be lazy here, since we know our directory
             # structure and OS
             try:
-                make_movie(reduced_dir, recalculate=args.recalculate)
+                make_movie(reduced_dir, recalculate=self.recalculate,
+                           num_processes=self.num_processes)
             except Exception as e:
                 log.error(str(e) + ' skipping movie for ' + self.directory)
         return
@@ -1499,66 +2400,378 @@ def get_dirs(directory,
 
 #print(get_dirs('/data/io/IoIO/raw', start='2018-01-01', stop='2019-01-01'))
                 
+def make_movie_task(directory, recalculate):
+    try:
+        make_movie(directory, recalculate=recalculate)
+    except Exception as e:
+        log.error(str(e) + ' skipping movie for ' + directory)
+
+class ReduceTree():
+    """Reduce all nights in a directory tree with one process pool
+
+    The work of each night is broken into tasks: ND_params of each
+    flat, back_level of each [SII] image, reduction of each on/off
+    pair and, optionally, the movie.  Tasks from all nights share
+    the pool and are submitted as soon as what they depend on is
+    done.  A night's pairs depend on its Background and on its
+    default_ND_params, which for a night without good flats come
+    from the next later night with them (the order the serial tree
+    reduction used)
+
+    Parameters
+    ----------
+    directory : str
+        Root of raw tree.  Default: data_root/raw
+    start, stop : str YYYY-MM-DD
+        Range of nights, inclusive
+    default_ND_params : array
+        Use these rather than deriving them from flats
+    incremental : bool
+        Skip nights whose night_signature hasn't changed since they
+        were last reduced and, within the other nights, pairs whose
+        pair_signature hasn't changed
+    """
+    def __init__(self,
+                 directory=None,
+                 start=None,
+                 stop=None,
+                 recalculate=False,
+                 default_ND_params=None,
+                 num_processes=None,
+                 movie=None,
+                 incremental=False):
+        if directory is None:
+            directory = os.path.join(data_root, 'raw')
+        if num_processes is None:
+            num_processes=int(os.cpu_count()/threads_per_core)
+        self.directory = directory
+        self.start = start
+        self.stop = stop
+        self.recalculate = recalculate
+        self.default_ND_params = default_ND_params
+        self.num_processes = int(num_processes)
+        self.movie = movie
+        self.incremental = incremental
+        self.store = APSumStore()
+        self.reduce_tree()
+
+    def night(self, directory):
+        """Returns dictionary describing the work of one night"""
+        collection = HeaderCollection(directory)
+        log.info(collection.location)
+        n = {'directory': directory,
+             'reduced_dir': directory.replace('/raw/', '/reduced/'),
+             'collection': collection,
+             'flats': [],
+             'ND_list': [],
+             'ND_params': None,
+             'fdict': {},
+             'jd_b_dict': {},
+             'back_missing': {},
+             'back_obj': None,
+             'pairs': [],
+             'pending': 0,
+             'results': [],
+             'errors': 0,
+             'failed': False,
+             'skip': False,
+             'signature': None,
+             'start': None}
+        # Flats are measured even in skipped nights, since earlier
+        # nights may need their ND_params.  They are cached, so this
+        # is quick
+        if self.default_ND_params is None:
+            n['flats'] = get_flat_fnames(
+                get_flat_collection(directory, collection))
+        else:
+            n['ND_params'] = self.default_ND_params
+        # Incremental reductions decide whether to skip the night
+        # once its ND_params are resolved (see check_night), since
+        # they may come from another night's flats
+        if not 'filter' in collection.keywords:
+            log.warning('FILTER keyword not present in any FITS headers, no usable files in ' + directory)
+            self.fail_night(n)
+            return n
+        try:
+            n['fdict'] = Background.SII_fdict(directory, collection)
+        except Exception as e:
+            log.error(str(e) + ' skipping ' + directory)
+            self.fail_night(n)
+            return n
+        n['pairs'] = get_on_off_pairs(directory, collection)
+        if len(n['pairs']) == 0:
+            log.warning('No object files found in ' + directory)
+            self.fail_night(n)
+            return n
+        # Only files not in the back_level cache need back tasks
+        n['jd_b_dict'], n['back_missing'] = cached_back_levels(n['fdict'])
+        if not any(n['back_missing'].values()):
+            self.make_back_obj(n)
+        return n
+
+    def make_back_obj(self, n):
+        try:
+            n['back_obj'] = Background(n['directory'], n['collection'],
+                                       jd_b_dict=n['jd_b_dict'])
+        except Exception as e:
+            log.error(str(e) + ' skipping ' + n['directory'])
+            self.fail_night(n)
+
+    def check_night(self, n):
+        """Calculate the night_signature of night n with its resolved
+        ND_params and mark it to be skipped if it hasn't changed since
+        the last reduction"""
+        n['signature'] = night_signature(n['directory'], n['collection'],
+                                         n['ND_params'])
+        if n['failed']:
+            # Failed before its signature was known
+            self.record_night(n)
+        elif (not self.recalculate
+              and n['signature'] is not None
+              and (self.store.night_signature(n['reduced_dir'])
+                   == n['signature'])):
+            log.info('Nothing changed since last reduction of '
+                     + n['directory'])
+            n['skip'] = True
+
+    def fail_night(self, n):
+        """Mark night n as unusable.  Unless there were errors, it
+        won't be tried again by incremental reductions until its
+        inputs change"""
+        n['failed'] = True
+        self.record_night(n)
+
+    def record_night(self, n):
+        if (self.incremental
+            and n['signature'] is not None
+            and n['errors'] == 0):
+            self.store.put_night_signature(n['reduced_dir'],
+                                           n['signature'])
+
+    def submit(self, key, func, args):
+        self.npending += 1
+        self.pool.apply_async(
+            func, args,
+            callback=lambda r: self.done.put((key, r, None)),
+            error_callback=lambda e: self.done.put((key, None, e)))
+
+    def resolve_ND_params(self):
+        """Carry default_ND_params forward through nights whose flats
+        are all measured"""
+        while (self.next_ND < len(self.nights)
+               and len(self.nights[self.next_ND]['ND_list'])
+                   == len(self.nights[self.next_ND]['flats'])):
+            n = self.nights[self.next_ND]
+            if n['ND_params'] is None:
+                n['ND_params'] = median_ND_params(n['ND_list'])
+            if n['ND_params'] is None:
+                if self.persistent_ND_params is None:
+                    # First time through no flats.  Presumably this is
+                    # recent data from the current run
+                    n['ND_params'] = IoIO.run_level_default_ND_params
+                    log.warning('No default_ND_params supplied and flats in '
+                                + n['directory'])
+                else:
+                    # No flats in current directory, use previous value
+                    n['ND_params'] = self.persistent_ND_params
+            self.persistent_ND_params = n['ND_params']
+            self.next_ND += 1
+            if self.incremental:
+                self.check_night(n)
+            self.maybe_start_pairs(n)
+
+    def maybe_start_pairs(self, n):
+        """Submit pair reductions of night n once its ND_params and
+        Background are ready"""
+        if (n['failed']
+            or n['skip']
+            or n['start'] is not None
+            or n['ND_params'] is None
+            or n['back_obj'] is None):
+            return
+        reduced_dir = n['reduced_dir']
+        this_ap_sum_fname = os.path.join(reduced_dir, ap_sum_fname)
+        if self.recalculate:
+            self.store.delete(reduced_dir)
+        elif (os.path.isfile(this_ap_sum_fname)
+              and self.store.count(reduced_dir) == 0):
+            self.store.ingest_csv(this_ap_sum_fname, reduced_dir)
+        n['start'] = time.time()
+        # Pickle once here rather than with each task.  Workers
+        # unpickle it the first time they see the night
+        night_state = pickle.dumps({'back_obj': n['back_obj'],
+                                    'default_ND_params': n['ND_params']})
+        self.task_bytes = len(pickle.dumps((n['pairs'][0], n['i'],
+                                            night_state)))
+        for pair in n['pairs']:
+            n['pending'] += 1
+            self.submit(('pair', n['i'], pair), reduce_pair_task,
+                        (pair, n['i'], night_state))
+
+    def finish_night(self, n):
+        reduced_dir = n['reduced_dir']
+        elapsed = time.time() - n['start']
+        log.info('Elapsed time for ' + n['directory'] + ': ' + str(elapsed))
+        log.info('Average per file: ' + str(elapsed/len(n['pairs'])))
+        record_stage_times(n['directory'], [r for pair, r in n['results']],
+                           [pair_timing(pair, r) for pair, r in n['results']])
+        n['results'] = []
+        if self.movie is not None:
+            self.submit(('movie', n['i']), make_movie_task,
+                        (reduced_dir, self.recalculate))
+        # Release memory of finished nights
+        n['collection'] = None
+        n['back_obj'] = None
+
+    def handle(self, key, result, err):
+        kind, i = key[0], key[1]
+        n = self.nights[i]
+        if kind == 'flat':
+            if err is not None:
+                log.error(str(err) + ' skipping flat ' + key[2])
+                result = None
+            n['ND_list'].append(result)
+            self.resolve_ND_params()
+        elif kind == 'back':
+            band = key[2]
+            if err is not None:
+                log.error(str(err) + ' skipping ' + n['directory'])
+                n['errors'] += 1
+                n['failed'] = True
+                return
+            n['jd_b_dict'][band].append(result)
+            if (n['failed']
+                or np.any([len(n['jd_b_dict'][b]) < len(n['fdict'][b])
+                           for b in n['fdict']])):
+                return
+            self.make_back_obj(n)
+            self.maybe_start_pairs(n)
+        elif kind == 'pair':
+            if err is not None:
+                log.error(str(err))
+            if result is None or not result[0]:
+                n['errors'] += 1
+            if result is not None:
+                self.task_times.append(result[1])
+                self.task_io.append(result[2])
+                self.task_results.append(result)
+                n['results'].append((key[2], result))
+            n['pending'] -= 1
+            if n['pending'] == 0:
+                if os.path.isdir(n['reduced_dir']):
+                    # Make sure this night's rows have been stored
+                    self.ap_sum_queue.put('flush')
+                    wait_for_writer(self.writer, self.flushed,
+                                    self.writer_errors)
+                    if self.incremental:
+                        # Drop records of raw files that are gone
+                        self.store.prune(
+                            n['reduced_dir'],
+                            [reduced_fname(on) for on, off in n['pairs']])
+                    self.store.export_csv(
+                        os.path.join(n['reduced_dir'], ap_sum_fname),
+                        [n['reduced_dir']])
+                self.record_night(n)
+                self.finish_night(n)
+        elif kind == 'movie':
+            if err is not None:
+                log.error(str(err) + ' skipping movie for '
+                          + n['reduced_dir'])
+
+    def reduce_tree(self):
+        start = time.time()
+        dirs = get_dirs(self.directory, start=self.start, stop=self.stop)
+        # Reverse date order, so persistent_ND_params from a night's
+        # flats carry back to earlier nights without them
+        self.nights = [self.night(d) for d in reversed(dirs)]
+        for i, n in enumerate(self.nights):
+            n['i'] = i
+        self.next_ND = 0
+        self.persistent_ND_params = None
+        self.npending = 0
+        self.done = queue.Queue()
+        self.flushed = threading.Event()
+        self.writer_errors = []
+        self.task_times = []
+        self.task_io = []
+        self.task_results = []
+        self.task_bytes = 0
+        with Manager() as manager:
+            self.ap_sum_queue = manager.Queue()
+            self.writer = threading.Thread(target=ap_sum_writer,
+                                           args=(self.ap_sum_queue,
+                                                 self.store.fname,
+                                                 self.flushed,
+                                                 self.writer_errors))
+            self.writer.start()
+            # Settings common to all nights go to each worker once
+            state = {'recalculate': self.recalculate,
+                     'incremental': self.incremental,
+                     'ap_sum_queue': self.ap_sum_queue}
+            try:
+                with Pool(self.num_processes,
+                          initializer=init_reduce_worker,
+                          initargs=(state,)) as self.pool:
+                    # Leaf tasks first, in night order
+                    for n in self.nights:
+                        for f in n['flats']:
+                            self.submit(('flat', n['i'], f),
+                                        get_ND_params_1flat, (f,))
+                        if n['failed'] or n['skip']:
+                            continue
+                        for band, flist in n['back_missing'].items():
+                            for f in flist:
+                                self.submit(('back', n['i'], band),
+                                            get_back_level_jd, (f,))
+                    # Nights without flats can be resolved right away
+                    self.resolve_ND_params()
+                    while self.npending > 0:
+                        key, result, err = self.done.get()
+                        self.npending -= 1
+                        self.handle(key, result, err)
+            finally:
+                self.ap_sum_queue.put(None)
+                self.writer.join()
+                self.ap_sum_queue = None
+            check_writer(self.writer_errors)
+        elapsed = time.time() - start
+        log.info('Elapsed time for tree ' + self.directory + ': '
+                 + str(elapsed))
+        # Flat and back_level tasks share the pool, so this is only an
+        # upper limit on the pair overhead
+        log_dispatch_overhead(self.directory, len(self.task_times),
+                              self.num_processes, elapsed,
+                              self.task_times, self.task_bytes)
+        log_io_stats(self.directory, self.task_io)
+        record_stage_times(self.directory, self.task_results)
+
 def reduce_cmd(args):
+    if args.back_level_method is not None:
+        global background_back_level_method
+        background_back_level_method = args.back_level_method
     if args.tree is not None:
         top = args.directory
         if top is None:
             top = os.path.join(data_root, 'raw')
-        persistent_default_ND_params = None
-        # --> Improve this to get real dates from directories
-        print(args.start, args.stop)
-        for directory in reversed(get_dirs(top,
-                                           start=args.start,
-                                           stop=args.stop)):
-            collection = ccdproc.ImageFileCollection(directory)
-            log.info(collection.location)
-            if args.default_ND_params is None:
-                # --> Improve this to make run-level ND_params by date
-                # We usually expect this, since we are going to run on
-                # a wide range of directories with different ND
-                # parameters
-                autoflat_subdir = os.path.join(directory, 'AutoFlat') 
-                if os.path.isdir(autoflat_subdir):
-                    log.debug('ACP AutoFlat subdirectory detected.  Ignoring any flats in ' + directory)
-                    flat_collection = \
-                        ccdproc.ImageFileCollection(autoflat_subdir)
-                else:
-                    flat_collection = collection
-                default_ND_params \
-                    = get_default_ND_params(directory, flat_collection)
-                if (default_ND_params is None
-                    and persistent_default_ND_params is None):
-                    # First time through no flats.  Presumably this is
-                    # recent data from the current run
-                    default_ND_params = IoIO.run_level_default_ND_params
-                    log.warning('No default_ND_params supplied and flats in '
-                                + directory)
-                elif (default_ND_params is None
-                      and persistent_default_ND_params is not None):
-                    # No flats in current directory, use previous value
-                    default_ND_params = persistent_default_ND_params
-                persistent_default_ND_params = default_ND_params
-            R = ReduceDir(directory,
-                          collection=collection,
-                          recalculate=args.recalculate,
-                          default_ND_params=default_ND_params,
-                          num_processes=args.num_processes,
-                          movie=args.movie)
+        ReduceTree(top,
+                   start=args.start,
+                   stop=args.stop,
+                   recalculate=args.recalculate,
+                   default_ND_params=args.default_ND_params,
+                   num_processes=args.num_processes,
+                   movie=args.movie,
+                   incremental=args.incremental)
         redtop = top.replace('/raw', '/reduced')
         filt_list = ['cloudy', 'marginal', 'dew', 'bad']
-        csvlist = [os.path.join(d, 'ap_sum.csv')
-                   for d in get_dirs(redtop, filt_list=filt_list)
-                   if os.path.isfile(os.path.join(d, 'ap_sum.csv'))]
-        # https://stackoverflow.com/questions/13613336/python-concatenate-text-files
-        first = True
-        with open(os.path.join(redtop, 'ap_sum.csv'), 'w') as outfile:
-            for fname in csvlist:
-                with open(fname) as infile:
-                    if not first:
-                        # Read past the header
-                        infile.readline()
-                    first = False
-                    outfile.write(infile.read())
+        # Tree-level ap_sum.csv comes straight from the store.  Bring
+        # in any per-day CSVs written before we had the store
+        store = APSumStore()
+        reddirs = get_dirs(redtop, filt_list=filt_list)
+        for d in reddirs:
+            csvfname = os.path.join(d, ap_sum_fname)
+            if os.path.isfile(csvfname) and store.count(d) == 0:
+                store.ingest_csv(csvfname, d)
+        store.export_csv(os.path.join(redtop, ap_sum_fname), reddirs)
         if args.movie is not None:
             movie_concatenate(redtop)
         return
@@ -1568,7 +2781,8 @@ def reduce_cmd(args):
                       recalculate=args.recalculate,
                       default_ND_params=args.default_ND_params,
                       num_processes=args.num_processes,
-                      movie=args.movie)
+                      movie=args.movie,
+                      incremental=args.incremental)
         return
     # Reduce a pair of files -- just keep it simple
     if len(args.on_band) == 2:
@@ -1580,16 +2794,26 @@ def reduce_cmd(args):
     reduce_pair(on_band,
                 off_band,
                 default_ND_params=args.default_ND_params,
-                recalculate=args.recalculate)
+                recalculate=args.recalculate,
+                incremental=args.incremental)
 
 class MovieCorObs():
     def __init__(self,
                  flist,
                  speedup=None,
                  frame_rate=None,
-                 crop=None):
+                 crop=None,
+                 frame_cache=None,
+                 num_processes=None):
+        """Frames of the reduced files in flist for mpy.VideoClip.
+        If frame_cache is a filename (.npy), frames are rendered once
+        into it (see movie_frame_cache), by num_processes processes,
+        rather than as they are asked for"""
         assert isinstance(flist, list) and len(flist) > 0
         self.flist = flist
+        if num_processes is None:
+            num_processes = int(os.cpu_count()/threads_per_core)
+        self.num_processes = int(num_processes)
         self.speedup = speedup
         self.frame_rate = frame_rate
         self.crop = crop
@@ -1607,90 +2831,209 @@ class MovieCorObs():
             self.crop = np.asarray(crop.lower().split('x')).astype(int)
             # [::-1] does transpose, since we are in C-style language
             self.crop = self.crop[::-1]
-            # Do this like an iterator
-        self.fnum = None
-        self.dt_cur = None
-        self.HDUCur = None
-        self.HDUNext = None
         scale = (np.round(self.crop / self.mp4shape)).astype(int)
         if np.any(scale > 1):
             scale = np.max(scale)
         self.failsafeim = np.zeros((self.crop/scale).astype(int))
         
         self.persist_im = None
-        self.last_persist_im = None
-        self.next_f()
-        with fits.open(flist[-1]) as HDULast:
-            self.Tstop = Time(HDULast[0].header['DATE-OBS'], format='fits')
-            last_exp = HDULast[0].header['EXPTIME']
+        self.persist_fnum = None
+        self.frames = None
+        self.show = None
+        if frame_cache is not None:
+            self.prerender(frame_cache)
+            return
+        # Frames are rendered as they are asked for.  good records
+        # which files have been found to be good (True) or bad
+        # (False), and rendered the most recently used frames
+        headers = [read_header(f) for f in flist]
+        self.set_filt(headers[0])
+        self.set_times([h['DATE-OBS'] for h in headers],
+                       [h['EXPTIME'] for h in headers])
+        self.good = [None]*len(flist)
+        self.rendered = {}
+
+    def set_times(self, date_obs, exptime):
+        """Set the start times (s) of the frames relative to the
+        first, self.dt, and the duration of the movie from the
+        DATE-OBS and EXPTIME of each file"""
+        T = Time(date_obs, format='fits')
+        self.Tstart = T[0]
+        self.dt = (T - self.Tstart).sec
         # This is the calculated duration
-        self.duration = ((self.Tstop - self.Tstart).sec + last_exp)/self.speedup
+        self.duration = (self.dt[-1] + exptime[-1])/self.speedup
+
+    def set_filt(self, header):
+        # Beware new filter name SII_on and SII_off
+        if 'SII' in header['FILTER']:
+            # But string name can be proper notation
+            self.filt = '[SII]'
+        elif 'Na' in header['FILTER']:
+            self.filt = 'Na'
+        else:
+            raise ValueError('Improper filter ' + header['FILTER'])
 
-    def prev_f(self):
-        assert self.fnum > 0
-        self.persist_im = None
-        self.HDUNext = self.HDULcur
-        self.dt_next = self.dt_cur
-        self.fnum -= 1
-        self.HDULcur = fits.open(self.flist[self.fnum])
-        T = Time(self.HDULcur[0].header['DATE-OBS'], format='fits')
-        self.dt_cur = (T - self.Tstart).sec
-
-    def next_f(self):
-        if self.persist_im is not None:
-            self.last_persist_im = self.persist_im
-        self.persist_im = None
-        if self.fnum is None:
-            # Initialize here, since we have shared code
-            self.fnum = 0
-            self.HDULcur = fits.open(self.flist[self.fnum])
-            # Beware new filter name SII_on and SII_off
-            if 'SII' in self.HDULcur[0].header['FILTER']:
-                # But string name can be proper notation
-                self.filt = '[SII]'
-            elif 'Na' in self.HDULcur[0].header['FILTER']:
-                self.filt = 'Na'
-            else:
-                raise ValueError('Improper filter ' +
-                                 OnBandObsData.header['FILTER'])
+    @property
+    def render_params(self):
+        """Dictionary of parameters which affect rendered frames"""
+        return {'version': movie_frame_version,
+                'crop': self.crop.tolist(),
+                'mp4shape': self.mp4shape.tolist(),
+                'movie_edge_mask': movie_edge_mask,
+                'movie_background_light_threshold':
+                    movie_background_light_threshold}
+
+    def prerender(self, cache_fname):
+        """Render each file of flist once into self.frames, a uint8
+        array memory-mapped from cache_fname.  Frames of files that
+        haven't changed since they were cached there are reused"""
+        manifest_fname = os.path.splitext(cache_fname)[0] + '.json'
+        params = self.render_params
+        manifest = None
+        if os.path.isfile(manifest_fname) and os.path.isfile(cache_fname):
+            with open(manifest_fname) as f:
+                manifest = json.load(f)
+            if manifest['params'] != params:
+                manifest = None
+        # Cached entry and frame number of each file that is unchanged
+        cached = {}
+        if manifest is not None:
+            old_frames = np.load(cache_fname, mmap_mode='r')
+            for i, e in enumerate(manifest['files']):
+                cached[e['fname']] = (e, i)
+        entries = []
+        for f in self.flist:
+            st = os.stat(f)
+            e, i = cached.get(f, (None, None))
+            if (e is None
+                or e['size'] != st.st_size
+                or e['mtime'] != st.st_mtime_ns):
+                e = {'fname': f, 'size': st.st_size,
+                     'mtime': st.st_mtime_ns}
+                i = None
+            entries.append((e, i))
+        if manifest is not None and entries[0][1] is not None:
+            self.filt = manifest['filt']
         else:
-            assert self.HDUNext is not None, 'Code error? running off the end'
-            self.HDULcur = self.HDUNext
-            self.fnum += 1
-        T = Time(self.HDULcur[0].header['DATE-OBS'], format='fits')
-        if self.dt_cur is None:
-            self.Tstart = T
-            self.dt_cur = 0
+            self.set_filt(read_header(self.flist[0]))
+        if (manifest is not None
+            and [i for e, i in entries] == list(range(len(manifest['files'])))):
+            log.debug('Using cached movie frames ' + cache_fname)
         else:
-            self.dt_cur = (T - self.Tstart).sec
-        if self.fnum < len(self.flist) - 1:
-            self.HDUNext = fits.open(self.flist[self.fnum + 1])
-            T = Time(self.HDUNext[0].header['DATE-OBS'], format='fits')
-            self.dt_next = (T - self.Tstart).sec
+            shape = (len(entries),) + self.failsafeim.shape
+            tmp_fname = cache_fname + '.tmp.npy'
+            frames = np.lib.format.open_memmap(tmp_fname, mode='w+',
+                                               dtype=np.uint8, shape=shape)
+            todo = []
+            for j, (e, i) in enumerate(entries):
+                if i is None:
+                    todo.append(j)
+                else:
+                    frames[j] = old_frames[i]
+            fnames = [entries[j][0]['fname'] for j in todo]
+            num_processes = min(self.num_processes, len(todo))
+            # Pool workers can't have children.  Make the movies of
+            # several nights in parallel instead
+            if current_process().daemon:
+                num_processes = 1
+            if num_processes > 1:
+                p = Pool(num_processes, initializer=init_movie_worker,
+                         initargs=(self,))
+                rendered = p.imap(render_movie_frame_task, fnames)
+            else:
+                p = None
+                rendered = map(self.render_fname, fnames)
+            for j, (date_obs, exptime, im) in zip(todo, rendered):
+                e = entries[j][0]
+                e['date_obs'] = date_obs
+                e['exptime'] = exptime
+                if im is not None and im.shape != shape[1:]:
+                    log.warning('Frame shape ' + str(im.shape)
+                                + ' is not ' + str(shape[1:]) + ' for '
+                                + e['fname'])
+                    im = None
+                e['good'] = im is not None
+                if im is not None:
+                    frames[j] = im
+            if p is not None:
+                p.close()
+                p.join()
+            frames.flush()
+            del frames
+            old_frames = None
+            os.replace(tmp_fname, cache_fname)
+            manifest = {'params': params,
+                        'filt': self.filt,
+                        'files': [e for e, i in entries]}
+            with open(manifest_fname + '.tmp', 'w') as f:
+                json.dump(manifest, f)
+            os.replace(manifest_fname + '.tmp', manifest_fname)
+        self.frames = np.load(cache_fname, mmap_mode='r')
+        files = manifest['files']
+        self.set_times([e['date_obs'] for e in files],
+                       [e['exptime'] for e in files])
+        # Bad frames show the last good frame before them or, before
+        # the first good one, the first good one.  -1 is failsafeim
+        good = np.asarray([e['good'] for e in files])
+        idx = np.arange(len(files))
+        last_good = np.maximum.accumulate(np.where(good, idx, -1))
+        if np.any(good):
+            first_good = np.argmax(good)
         else:
-            self.HDUNext = None
-            self.dt_next = self.dt_cur + self.HDULcur[0].header['EXPTIME']
-
-    def get_good_frame(self, t):
-        if self.last_persist_im is not None:
-            # Some previous image was good.  Use it in place of the
-            # bad one.
-            self.persist_im = self.last_persist_im
-            return self.persist_im
-        # If we made it here, our first image was bad.  Recursively
-        # read the next one and pretend it is the first until we find
-        # a good one
-        if self.HDUNext is None:
-            log.warning('No good images, returning 0ed frame')
-            # Do operations from make_frame that 
-            im = self.failsafeim
-            self.persist_im = np.stack((im,)*3, axis=-1)
-            return self.persist_im
-        # If we made it here there are still some more images to try
-        self.next_f()
-        self.dt_cur = 0
-        return(self.make_frame(t))
-                   
+            log.warning('No good images, returning 0ed frames')
+            first_good = -1
+        self.show = np.where(last_good >= 0, last_good, first_good)
+
+    def render_fname(self, fname):
+        """Returns (DATE-OBS, EXPTIME, render()) of file fname"""
+        with open_fits(fname) as HDUList:
+            hdr = HDUList[0].header
+            return (hdr['DATE-OBS'], hdr['EXPTIME'], self.render(HDUList))
+
+    def render_fnum(self, i):
+        """Returns frame of file i, rendering it if it is not one of
+        the movie_frame_lru_size most recently used"""
+        if i in self.rendered:
+            # Most recently used last
+            self.rendered[i] = self.rendered.pop(i)
+            return self.rendered[i]
+        with open_fits(self.flist[i]) as HDUList:
+            im = self.render(HDUList)
+        self.good[i] = im is not None
+        if im is not None:
+            self.rendered[i] = im
+            if len(self.rendered) > movie_frame_lru_size:
+                del self.rendered[next(iter(self.rendered))]
+        return im
+
+    def is_good(self, i):
+        if self.good[i] is None:
+            self.render_fnum(i)
+        return self.good[i]
+
+    def frame_index(self, t):
+        """Returns index into flist of the file whose frame is shown at
+        time t (s) of the movie, -1 for failsafeim.  Bad frames show
+        the last good frame before them or, before the first good one,
+        the first good one"""
+        i = np.searchsorted(self.dt, t * self.speedup, side='right') - 1
+        i = max(i, 0)
+        if self.show is not None:
+            return self.show[i]
+        for j in itertools.chain(range(i, -1, -1),
+                                 range(i + 1, len(self.flist))):
+            if self.is_good(j):
+                return j
+        return -1
+
+    def frame(self, i):
+        """Returns 2D frame of file i, failsafeim for -1"""
+        if i < 0:
+            return self.failsafeim
+        if self.frames is not None:
+            return self.frames[i]
+        return self.render_fnum(i)
+
     #def do_crop(self, im):
     #    if self.crop is not None:
     #        c = (np.asarray(im.shape)/2).astype(int)
@@ -1699,36 +3042,24 @@ class MovieCorObs():
     #        im = im[ll[0]:ur[0], ll[1]:ur[1]]
     #    return(im)
 
-    def make_frame(self, t):
-        """Make a frame for mpy.VideoClip.  
-        The frame is a 3-layer color image, with shape [nx, ny, 3] and
-        (0,0) in the upper left corner. """
-        # Make a general backward-forward iterator since sometimes we
-        # run the object backward to get back to the beginning of a
-        # movie.  The idea is we read a frame in and store it in
-        # persist_im until we advance time past the beginning of the
-        # next frame.
-        m_dt = t * self.speedup
-        while t > 0 and m_dt < self.dt_cur:
-            self.prev_f()
-        while t <= self.duration and self.dt_next <= m_dt:
-            self.next_f()
-        if self.persist_im is not None:
-            return self.persist_im
-        # If we made it here, we need to create our image
+    def render(self, HDUList):
+        """Returns 2D uint8 movie frame of the reduced image in
+        HDUList, or None if the image is not good enough to show"""
+        hdr = HDUList[0].header
         # Do some checks to see if it is crummy
-        hdr = self.HDULcur[0].header
         if hdr['D_ON-OFF'] > 7:
             log.warning('on & off centers too far apart' 
-                        + self.HDULcur.filename())
-            return(self.get_good_frame(t))
-        im = self.HDULcur[0].data
-        if abs(np.mean(im)) > movie_background_light_threshold:
+                        + HDUList.filename())
+            return None
+        im = read_data(HDUList)
+        # Cropped images record the mean of the whole image
+        mean = hdr.get('FULLMEAN', np.mean(im))
+        if abs(mean) > movie_background_light_threshold:
             log.warning('background light '
-                        + str(abs(np.mean(im)))
+                        + str(abs(mean))
                         + ' too large or small for '
-                        + self.HDULcur.filename())
-            return(self.get_good_frame(t))
+                        + HDUList.filename())
+            return None
         # --> playing with these on 2018-04-21 [seem good in general]
         if self.filt == '[SII]':
             # --> check date
@@ -1744,11 +3075,12 @@ class MovieCorObs():
             chop = 8000
             scale_jup = 50
         # Might want to adjust edge_mask.  -5 was OK on 2018-04-21
-        O = IoIO.CorObsData(self.HDULcur, edge_mask=movie_edge_mask)
+        O = IoIO.CorObsData(primary_image(HDUList),
+                            edge_mask=movie_edge_mask)
         c = (np.asarray(im.shape)/2).astype(int)
         # Scale Jupiter down by 10 to get MR/A and 10 to get
         # it on comparable scale to torus
-        im[O.ND_coords] = im[O.ND_coords] /scale_jup
+        im[O.ND_mask] = im[O.ND_mask] /scale_jup
         #jcrop = np.asarray((50,50))
         #ll = (c - jcrop).astype(int)
         #ur = (c + jcrop).astype(int)
@@ -1757,6 +3089,13 @@ class MovieCorObs():
         if self.crop is not None:
             ll = (c - self.crop/2).astype(int)
             ur = (c + self.crop/2).astype(int)
+            if np.any(ll < 0):
+                # Reduced image was cropped smaller than our crop.
+                # Pad it, so all frames are the same size
+                pad = np.maximum(-ll, 0)
+                im = np.pad(im, [(p, p) for p in pad])
+                ll += pad
+                ur += pad
             im = im[ll[0]:ur[0], ll[1]:ur[1]]
         # chop high pixels
         badc = np.where(np.logical_or(im < 0, im > chop))
@@ -1774,8 +3113,9 @@ class MovieCorObs():
         if np.any(scale > 1):
             scale = np.max(scale)
             im = ndimage.zoom(im, 1/scale, order=0)
-        # Scale pixel values for mp4
-        im = im/np.max(im) * 255
+        # Scale pixel values for mp4.  moviepy truncates frames to
+        # uint8 anyway
+        im = (im/np.max(im) * 255).astype(np.uint8)
         # MP4 thinks of pixels coordinates in the X-Y Cartesian sense,
         # but filling in from the top down
         im = np.flipud(im)
@@ -1785,15 +3125,26 @@ class MovieCorObs():
         #                  cmap=plt.cm.gray, filternorm=0, interpolation='none')
         #plt.show()
         
-        # Thanks to https://stackoverflow.com/questions/39463019/how-to-copy-numpy-array-value-into-higher-dimensions
-        self.persist_im = np.stack((im,)*3, axis=-1)
+        return im
+
+    def make_frame(self, t):
+        """Make a frame for mpy.VideoClip.  
+        The frame is a 3-layer color image, with shape [nx, ny, 3] and
+        (0,0) in the upper left corner. """
+        # Frames are looked up by time, so moviepy can ask for them
+        # in any order (e.g. back to the beginning of the movie)
+        i = self.frame_index(t)
+        if i != self.persist_fnum:
+            # Thanks to https://stackoverflow.com/questions/39463019/how-to-copy-numpy-array-value-into-higher-dimensions
+            self.persist_im = np.stack((self.frame(i),)*3, axis=-1)
+            self.persist_fnum = i
         return self.persist_im
 
 def offset_no_offset(collection_or_directory, include_path=False):
-    if isinstance(collection_or_directory, ccdproc.ImageFileCollection):
-        collection = collection_or_directory
+    if isinstance(collection_or_directory, str):
+        collection = HeaderCollection(collection_or_directory)
     else:
-        collection = ccdproc.ImageFileCollection(collection_or_directory)
+        collection = collection_or_directory
     offset = []
     no_offset = []
     if (not 'decoff' in collection.keywords
@@ -1814,12 +3165,23 @@ def offset_no_offset(collection_or_directory, include_path=False):
         no_offset = [os.path.join(d, n) for n in no_offset]
     return (offset, no_offset)
 
+# MovieCorObs whose frames this pool worker renders
+_movie_worker = None
+
+def init_movie_worker(M):
+    global _movie_worker
+    _movie_worker = M
+
+def render_movie_frame_task(fname):
+    return _movie_worker.render_fname(fname)
+
 def make_movie(directory,
                recalculate=False,
                SII_crop=None,
                Na_crop=None,
                frame_rate=None,
-               speedup=None):
+               speedup=None,
+               num_processes=None):
     assert not 'raw' in directory, "Not ready to make movies from raw directories" 
         
     # Return if we have nothing to do.  Eventually put all desired
@@ -1829,7 +3191,7 @@ def make_movie(directory,
         log.debug('movie output file(s) exist and recalculate=False: '
                   + directory)
         return
-    collection = ccdproc.ImageFileCollection(directory)
+    collection = HeaderCollection(directory)
     collection.sort('date-obs')
     if not 'filter' in collection.keywords:
         log.warning('Directory does not contain any usable images')
@@ -1865,14 +3227,22 @@ def make_movie(directory,
     # only the directory from reduce
     if SII_crop is None:
         SII_crop = "600x600"
+    SII_cache = Na_cache = None
+    if movie_frame_cache:
+        SII_cache = os.path.join(directory, 'movie_frames_SII.npy')
+        Na_cache = os.path.join(directory, 'movie_frames_Na.npy')
     M_SII = MovieCorObs(SII_on_list,
                         speedup,
                         frame_rate,
-                        SII_crop)
+                        SII_crop,
+                        frame_cache=SII_cache,
+                        num_processes=num_processes)
     M_Na = MovieCorObs(Na_on_list,
                        speedup,
                        frame_rate,
-                       Na_crop)
+                       Na_crop,
+                       frame_cache=Na_cache,
+                       num_processes=num_processes)
     duration = np.max((M_SII.duration, M_Na.duration))
     SII_movie = mpy.VideoClip(M_SII.make_frame, duration=duration)
     Na_movie = mpy.VideoClip(M_Na.make_frame, duration=duration)
@@ -1886,49 +3256,32 @@ def make_movie(directory,
            .set_fps(M_SII.frame_rate))
     Na_SII_movie = mpy.CompositeVideoClip(
         [mpy.clips_array([[Na_movie, SII_movie]]), txt])
-    Na_SII_movie.write_videofile(
-        os.path.join(directory, "Na_SII.mp4"),
-        fps=M_SII.frame_rate)
     # Since I am going for dual-display, no need to spend time writing these
     #SII_movie.write_videofile(os.path.join(directory, 
     #                                       "SII_movie.mp4"),
     #                          fps=M_SII.frame_rate)
     # Except I want this for the volcanic eruption paper
     Na_movie = mpy.CompositeVideoClip([Na_movie, txt])
-    Na_movie.write_videofile(os.path.join(directory, 
-                                          "Na_movie.mp4"),
-                              fps=M_SII.frame_rate)
+    # Both movies in one pass over the frames
+    movie_io.write_videos(
+        [(os.path.join(directory, "Na_SII.mp4"), Na_SII_movie),
+         (os.path.join(directory, "Na_movie.mp4"), Na_movie)],
+        duration, M_SII.frame_rate,
+        key=lambda t: (M_Na.frame_index(t), M_SII.frame_index(t)))
   
-def movie_concatenate(directory):
+def movie_concatenate(directory, recalculate=False):
+    """Concatenate the nightly movies below directory.  Only nights
+    that have changed since the last time are redone (see
+    movie_io.concatenate) unless recalculate is True"""
     if directory is None:
         directory = os.path.join(data_root, 'reduced')
-    clips = []
-    Na_clips = []
     # --> eventually I want to have the data themselves indicate this
     filt_list = ['cloudy', 'marginal', 'dew', 'bad', 'stuck']
-    for d in get_dirs(directory, filt_list=filt_list):
-        #if len(clips) == 3 or len(Na_clips) == 3:
-        #    break
-        try:
-            c = mpy.VideoFileClip(os.path.join(d, 'Na_SII.mp4'))
-        except Exception as e:
-            log.error(str(e) + ' Bad Na_SII movie in ' + d)
-        else:
-            clips.append(c)
-        try:
-            c = mpy.VideoFileClip(os.path.join(d, 'Na_movie.mp4'))
-        except Exception as e:
-            log.error(str(e) + ' Bad Na movie in ' + d)
-        else:
-            Na_clips.append(c)
-    log.debug(str(len(clips)) + ' good [Na_SII] movies found')
-    animation = mpy.concatenate_videoclips(clips)
-    animation.write_videofile(os.path.join(directory, 'Na_SII.mp4'),
-                              fps=global_frame_rate)
-    log.debug(str(len(clips)) + ' good [Na] movies found')
-    animation = mpy.concatenate_videoclips(Na_clips)
-    animation.write_videofile(os.path.join(directory, 'Na_movie.mp4'),
-                              fps=global_frame_rate)
+    dirs = get_dirs(directory, filt_list=filt_list)
+    for name in ['Na_SII.mp4', 'Na_movie.mp4']:
+        movie_io.concatenate([os.path.join(d, name) for d in dirs],
+                             os.path.join(directory, name),
+                             recalculate=recalculate)
 
 class PoolWorker():
     """Get multiprocess to work with argparse.  Function is the function to call, iterable is a string indicating the argparse namespace element that will become the iterable for multiprocess, and args is the argparse args namespace"""
@@ -1962,7 +3315,7 @@ def movie_cmd(args):
         movie_concatenate(top)
         return
     if args.concatenate:
-        movie_concatenate(args.directory)
+        movie_concatenate(args.directory, recalculate=args.recalculate)
         return
     assert args.directory is not None
     try:
@@ -1971,7 +3324,8 @@ def movie_cmd(args):
                    SII_crop=args.SII_crop,
                    Na_crop=args.Na_crop,
                    frame_rate=args.frame_rate,
-                   speedup=args.speedup)
+                   speedup=args.speedup,
+                   num_processes=args.num_processes)
     except Exception as e:
         log.error(str(e) + ' skipping movie for ' + args.directory)
         log.error(str(e) + ' trying again without try for ' + args.directory)
@@ -2003,6 +3357,30 @@ if __name__ == "__main__":
         'directory', nargs='?', default=raw_data_root, help='root of directory tree')
     tree_parser.set_defaults(func=ND_params_tree)
 
+    ND_bench_parser = subparsers.add_parser(
+        'ND_params_bench', help='Time ND_params per frame with the find_peaks_cwt and batch ND edge finders')
+    ND_bench_parser.add_argument(
+        'fnames', nargs='+', help='non-flat files to process')
+    ND_bench_parser.add_argument(
+        '--default_ND_params', help='Default ND filter parameters to use')
+    ND_bench_parser.set_defaults(func=ND_params_benchmark)
+
+    back_bench_parser = subparsers.add_parser(
+        'back_level_bench', help='Compare speed and results of back_level methods')
+    back_bench_parser.add_argument(
+        'fnames', nargs='+', help='files to process')
+    back_bench_parser.add_argument(
+        '--tolerance', type=float, help='Maximum acceptable difference (ADU), default readnoise')
+    back_bench_parser.set_defaults(func=back_level_benchmark)
+
+    ap_bench_parser = subparsers.add_parser(
+        'ap_catalog_bench', help='Time aperture catalog evaluation per aperture set')
+    ap_bench_parser.add_argument(
+        'fnames', nargs='+', help='reduced files to process')
+    ap_bench_parser.add_argument(
+        '--catalog', help='aperture catalog JSON file, default ' + aperture_catalog_fname)
+    ap_bench_parser.set_defaults(func=aperture_catalog_benchmark)
+
     reduce_parser = subparsers.add_parser(
         'reduce', help='Reduce files in a directory')
     reduce_parser.add_argument(
@@ -2022,6 +3400,9 @@ if __name__ == "__main__":
     reduce_parser.add_argument(
         '--recalculate', action='store_const', const=True,
         help='recalculate and overwrite files in reduced directory')
+    reduce_parser.add_argument(
+        '--incremental', action='store_const', const=True,
+        help='only reduce nights and on/off pairs whose files, calibration, ephemeris or reduction version changed since they were last reduced')
     reduce_parser.add_argument(
         'on_band', nargs='?', help='on-band filename')
     reduce_parser.add_argument(
@@ -2029,6 +3410,9 @@ if __name__ == "__main__":
     reduce_parser.add_argument(
         '--movie', action='store_const', const=True,
         help="Create movie when done")
+    reduce_parser.add_argument(
+        '--back_level_method', choices=['cwt', 'bincount'],
+        help='IoIO.back_level method of the Background, default ' + background_back_level_method)
     reduce_parser.set_defaults(func=reduce_cmd)
 
     movie_parser = subparsers.add_parser(
@@ -2041,7 +3425,7 @@ if __name__ == "__main__":
         help='Makes a movie out of all of the files in the tree (unless there is already a movie).')
     movie_parser.add_argument(
         '--concatenate', action='store_const', const=True,
-        help='concatenate all movies in directories below directory (default is top-level reduced.  --recalculate is implied')
+        help='concatenate all movies in directories below directory (default is top-level reduced).  Only movies that have changed since the last time are redone, unless --recalculate')
     movie_parser.add_argument(
         '--num_processes', type=int, default=os.cpu_count()/threads_per_core,
         help='number of subprocesses for parallelization')
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+
+"""
+SQLite store of the ReduceCorObs.reduce_pair aperture sums
+
+Each reduce_pair result (the row that used to be appended to the
+per-day ap_sum.csv) is stored as one record keyed by reduced
+filename, so re-reducing a file replaces its record and the tree-level
+collection grows incrementally.  During ReduceDir runs the pool
+workers send their rows over a queue to a single ap_sum_writer, so
+there is no contention between workers for the files.  export_csv
+writes the familiar ap_sum.csv for any set of directories.
+
+Records can carry the signature of the inputs they were reduced from
+(see ReduceCorObs.pair_signature) and each reduced directory can have
+a signature of the raw night it came from, which is what lets
+incremental reductions skip pairs and nights that have not changed.
+"""
+
+import os
+import csv
+import json
+import queue
+import sqlite3
+import argparse
+
+from astropy import log
+
+data_root = '/data/io/IoIO'
+default_store_fname = os.path.join(data_root, 'reduced', 'ap_sum.sqlite')
+# Rows the writer accumulates before committing
+writer_batch_size = 50
+# Interval (s) at which wait_for_writer checks that the writer is alive
+writer_poll_interval = 1
+
+def json_default(o):
+    """Converts numpy scalars that json doesn't know about"""
+    if hasattr(o, 'item'):
+        return o.item()
+    raise TypeError(repr(o) + ' is not JSON serializable')
+
+class APSumStore():
+    """Aperture sum records keyed by reduced filename
+
+    Parameters
+    ----------
+    fname : str
+        SQLite database filename.  Default: default_store_fname
+    """
+    def __init__(self, fname=None):
+        if fname is None:
+            fname = default_store_fname
+        self.fname = fname
+
+    def connect(self):
+        d = os.path.dirname(self.fname)
+        if d != '' and not os.path.isdir(d):
+            os.makedirs(d)
+        con = sqlite3.connect(self.fname, timeout=60)
+        con.execute('CREATE TABLE IF NOT EXISTS ap_sum '
+                    '(fname TEXT PRIMARY KEY, directory TEXT, '
+                    'tmid TEXT, fieldnames TEXT, row TEXT)')
+        con.execute('CREATE INDEX IF NOT EXISTS directory_idx '
+                    'ON ap_sum (directory)')
+        # Stores made before incremental reductions lack the signature
+        # column
+        cols = [c[1] for c in con.execute('PRAGMA table_info(ap_sum)')]
+        if 'signature' not in cols:
+            con.execute('ALTER TABLE ap_sum ADD COLUMN signature TEXT')
+        con.execute('CREATE TABLE IF NOT EXISTS nights '
+                    '(directory TEXT PRIMARY KEY, signature TEXT)')
+        return con
+
+    def put(self, records):
+        """Insert or replace records, a list of (fname, directory,
+        fieldnames, row) or (fname, directory, fieldnames, row,
+        signature) tuples"""
+        con = self.connect()
+        with con:
+            con.executemany(
+                'INSERT OR REPLACE INTO ap_sum '
+                '(fname, directory, tmid, fieldnames, row, signature) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(r[0], os.path.abspath(r[1]), r[3].get('TMID'),
+                  json.dumps(r[2]),
+                  json.dumps(r[3], default=json_default),
+                  r[4] if len(r) > 4 else None)
+                 for r in records])
+        con.close()
+
+    def delete(self, directory):
+        """Remove all records and the night signature of directory"""
+        con = self.connect()
+        with con:
+            con.execute('DELETE FROM ap_sum WHERE directory=?',
+                        (os.path.abspath(directory),))
+            con.execute('DELETE FROM nights WHERE directory=?',
+                        (os.path.abspath(directory),))
+        con.close()
+
+    def prune(self, directory, keep):
+        """Remove records of directory whose fname is not in keep (e.g.
+        reductions of raw files that are gone).  Returns number
+        removed"""
+        keep = set(keep)
+        con = self.connect()
+        with con:
+            gone = [(f,) for (f,) in con.execute(
+                'SELECT fname FROM ap_sum WHERE directory=?',
+                (os.path.abspath(directory),)) if f not in keep]
+            con.executemany('DELETE FROM ap_sum WHERE fname=?', gone)
+        con.close()
+        return len(gone)
+
+    def signature(self, fname):
+        """Returns signature fname was reduced with or None"""
+        con = self.connect()
+        r = con.execute('SELECT signature FROM ap_sum WHERE fname=?',
+                        (fname,)).fetchone()
+        con.close()
+        if r is None:
+            return None
+        return r[0]
+
+    def night_signature(self, directory):
+        """Returns signature of the raw night last reduced into
+        directory or None"""
+        con = self.connect()
+        r = con.execute('SELECT signature FROM nights WHERE directory=?',
+                        (os.path.abspath(directory),)).fetchone()
+        con.close()
+        if r is None:
+            return None
+        return r[0]
+
+    def put_night_signature(self, directory, signature):
+        con = self.connect()
+        with con:
+            con.execute('INSERT OR REPLACE INTO nights VALUES (?, ?)',
+                        (os.path.abspath(directory), signature))
+        con.close()
+
+    def count(self, directory):
+        con = self.connect()
+        n = con.execute('SELECT COUNT(*) FROM ap_sum WHERE directory=?',
+                        (os.path.abspath(directory),)).fetchone()[0]
+        con.close()
+        return n
+
+    def records(self, directories):
+        """Returns list of (fieldnames, row) of directories, in order of
+        directories then TMID"""
+        con = self.connect()
+        recs = []
+        for d in directories:
+            for f, r in con.execute(
+                    'SELECT fieldnames, row FROM ap_sum WHERE directory=? '
+                    'ORDER BY tmid, fname', (os.path.abspath(d),)):
+                recs.append((json.loads(f), json.loads(r)))
+        con.close()
+        return recs
+
+    def export_csv(self, csvfname, directories):
+        """Write ap_sum.csv-style file of the records of directories.
+        Columns are the union of the records' fieldnames in order of
+        first appearance.  Returns number of rows written"""
+        recs = self.records(directories)
+        fieldnames = []
+        for f, _ in recs:
+            fieldnames.extend([k for k in f if k not in fieldnames])
+        tmp = csvfname + '.' + str(os.getpid())
+        with open(tmp, 'w', newline='') as csvfile:
+            csvdw = csv.DictWriter(csvfile, fieldnames=fieldnames,
+                                   quoting=csv.QUOTE_NONNUMERIC)
+            csvdw.writeheader()
+            for _, row in recs:
+                csvdw.writerow(row)
+        os.replace(tmp, csvfname)
+        return len(recs)
+
+    def ingest_csv(self, csvfname, directory=None):
+        """Add the rows of an existing ap_sum.csv"""
+        if directory is None:
+            directory = os.path.dirname(os.path.abspath(csvfname))
+        records = []
+        with open(csvfname, newline='') as csvfile:
+            csvdr = csv.DictReader(csvfile, quoting=csv.QUOTE_NONNUMERIC)
+            for row in csvdr:
+                records.append((row['FNAME'], directory,
+                                csvdr.fieldnames, row))
+        self.put(records)
+        return len(records)
+
+def ap_sum_writer(ap_sum_queue, fname=None, flushed=None, errors=None):
+    """Store (fname, directory, fieldnames, row[, signature]) records from
+    ap_sum_queue until None is received.  Meant to be run as the one
+    writer thread or process of a reduction.  When 'flush' is
+    received, records received so far are stored and the
+    threading.Event flushed is set.  If storing fails, the exception
+    is appended to list errors (or raised if errors is None) and
+    flushed is set, so that nobody waits for a writer that is gone
+    (see wait_for_writer)"""
+    nrecords = 0
+    try:
+        store = APSumStore(fname)
+        done = False
+        while not done:
+            records = []
+            flush = False
+            item = ap_sum_queue.get()
+            while True:
+                if item is None:
+                    done = True
+                    break
+                if item == 'flush':
+                    flush = True
+                    break
+                records.append(item)
+                if len(records) >= writer_batch_size:
+                    break
+                try:
+                    item = ap_sum_queue.get_nowait()
+                except queue.Empty:
+                    break
+            if len(records) > 0:
+                store.put(records)
+                nrecords += len(records)
+            if flush and flushed is not None:
+                flushed.set()
+    except Exception as e:
+        log.error('ap_sum_writer: ' + str(e) + ' after storing '
+                  + str(nrecords) + ' records')
+        if errors is None:
+            raise
+        errors.append(e)
+        return nrecords
+    finally:
+        if flushed is not None:
+            flushed.set()
+    log.debug('ap_sum_writer stored ' + str(nrecords) + ' records in '
+              + store.fname)
+    return nrecords
+
+def check_writer(errors):
+    """Raise the first error ap_sum_writer recorded in errors"""
+    if len(errors) > 0:
+        raise errors[0]
+
+def wait_for_writer(writer, flushed, errors, timeout=None):
+    """Wait until ap_sum_writer thread writer sets flushed, checking
+    every timeout (default writer_poll_interval) s that it is still
+    running.  Raises the error the writer recorded in errors, if it
+    failed, rather than waiting for ever"""
+    if timeout is None:
+        timeout = writer_poll_interval
+    while not flushed.wait(timeout):
+        if not writer.is_alive():
+            break
+    check_writer(errors)
+    if not flushed.is_set():
+        raise RuntimeError('ap_sum_writer exited without flushing')
+    flushed.clear()
+
+def export_cmd(args):
+    n = APSumStore(args.store).export_csv(args.csvfname, args.directories)
+    log.info('Wrote ' + str(n) + ' rows to ' + args.csvfname)
+
+def ingest_cmd(args):
+    store = APSumStore(args.store)
+    for f in args.csvfnames:
+        n = store.ingest_csv(f)
+        log.info('Ingested ' + str(n) + ' rows from ' + f)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="IoIO reduction aperture sum store")
+    parser.add_argument(
+        '--store', help='store filename, default ' + default_store_fname)
+    subparsers = parser.add_subparsers(dest='one of the subcommands in {}, above', help='sub-command help')
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser(
+        'export', help='Write ap_sum.csv-style file for reduced directories')
+    export_parser.add_argument(
+        'csvfname', help='output CSV filename')
+    export_parser.add_argument(
+        'directories', nargs='+', help='reduced directories')
+    export_parser.set_defaults(func=export_cmd)
+
+    ingest_parser = subparsers.add_parser(
+        'ingest', help='Add rows of existing ap_sum.csv files')
+    ingest_parser.add_argument(
+        'csvfnames', nargs='+', help='CSV files')
+    ingest_parser.set_defaults(func=ingest_cmd)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+
+"""
+Benchmarks of the IoIO reduction on synthetic coronagraph frames
+
+Reduction performance used to be measurable only against the
+/data/io/IoIO archive.  This writes a night of synthetic SX694 frames
+(bias, dark, readnoise, the ND filter stripe of
+IoIO.run_level_default_ND_params, Jupiter on the ND filter, scattered
+light and a model of the Io plasma torus or Na nebula) to a scratch
+directory and times the steps of the reduction on them.  No network
+or real data are needed: ephemeris values are fixed and all of the
+caches and stores are pointed into the scratch directory.
+
+Each run appends a record with the timings to a JSON-lines results
+file and warns about benchmarks that have become slower than in the
+previous run on the same host.
+"""
+
+import os
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+
+import numpy as np
+from astropy import log
+from astropy.io import fits
+from astropy.time import Time
+
+import IoIO
+import header_index
+import ap_sum_store
+import ReduceCorObs as R
+
+default_results_fname = 'IoIO_bench.jsonl'
+# Slowdown relative to the previous run that is reported as a
+# regression
+regression_tolerance = 0.25
+# SX694 unbinned (Y, X)
+bench_shape = (2200, 2750)
+bench_date = '2019-06-01'
+# Ephemeris values are fixed so that no ephemeris table is needed
+bench_NPole_ang = 339.
+bench_ang_width = 45. # arcsec
+# Coronagraph field radius (pix) and ND filter transmission
+field_radius = 1100
+ND_transmission = 1e-3
+
+benchmarks = ['synthetic_frame', 'CorObsData', 'ND_params', 'obj_center',
+              'back_level', 'Background', 'reduce_pair', 'make_frame']
+
+def synthetic_frame(filt='SII_on', date_obs=None, exptime=300,
+                    ND_params=None, jupiter=True, seed=None):
+    """Returns HDUList of a synthetic raw IoIO frame through filter
+    filt ('SII_on', 'SII_off', 'Na_on' or 'Na_off').  Jupiter is put
+    on the ND filter near the y_center CorObsData looks for it, a few
+    pixels off from frame to frame.  On-band frames have torus ([SII])
+    or nebula (Na) emission around it"""
+    if date_obs is None:
+        date_obs = bench_date + 'T05:00:00'
+    if ND_params is None:
+        ND_params = IoIO.run_level_default_ND_params
+    ND_params = np.asarray(ND_params)
+    rng = np.random.default_rng(seed)
+    ny, nx = bench_shape
+    y = np.arange(ny)[:, None]
+    x = np.arange(nx)[None, :]
+    edges = ND_params[1, :] + ND_params[0, :]*(y - ny/2)
+    on_ND = (x >= edges[:, 0:1]) & (x < edges[:, 1:2])
+    attenuation = np.where(on_ND, ND_transmission, 1)
+    # Sky and instrumental scattered light, vignetted by the
+    # coronagraph field stop
+    cy = ny/2 + 70 + rng.uniform(-5, 5)
+    cx = np.mean(ND_params[1, :] + ND_params[0, :]*(cy - ny/2)) \
+        + rng.uniform(-3, 3)
+    r = np.hypot(y - cy, x - cx)
+    field = np.hypot(y - ny/2, x - nx/2) < field_radius
+    scale = exptime/300
+    im = field * attenuation * scale * (20 + 3000/(1 + (r/40)**2))
+    if jupiter:
+        Rjpix = bench_ang_width/2/R.plate_scale
+        # A few thousand ADU through the ND filter, saturated off it
+        im += np.where(r < Rjpix, 3e6*scale, 0) * attenuation
+        if filt.endswith('_on'):
+            ang = np.radians(bench_NPole_ang)
+            # Distance from Jupiter along and across the centrifugal
+            # equator, which is close enough to the rotational one
+            along = ((x - cx)*np.cos(ang) + (y - cy)*np.sin(ang))/Rjpix
+            across = (-(x - cx)*np.sin(ang) + (y - cy)*np.cos(ang))/Rjpix
+            if filt.startswith('SII'):
+                # Ansas at 5.9 Rj
+                emission = 30*np.exp(-((np.abs(along) - 5.9)**2
+                                       + across**2)/0.5)
+            else:
+                emission = 20*np.exp(-r/Rjpix/20)
+            im += field * attenuation * scale * emission
+    # Photon noise (gain ~ 0.3 e-/ADU), readnoise, bias and dark
+    im += rng.standard_normal(im.shape) * np.sqrt(im/IoIO.global_gain
+                                                  + IoIO.global_readnoise**2)
+    im += R.global_bias + R.global_dark*exptime
+    im = np.clip(np.round(im), 0, 2**16 - 1).astype(np.uint16)
+    hdr = fits.Header()
+    hdr['IMAGETYP'] = 'LIGHT'
+    hdr['DATE-OBS'] = date_obs
+    hdr['EXPTIME'] = float(exptime)
+    hdr['XBINNING'] = 1
+    hdr['YBINNING'] = 1
+    hdr['XORGSUBF'] = 0
+    hdr['YORGSUBF'] = 0
+    hdr['FILTER'] = filt
+    hdr['OBJECT'] = 'Jupiter'
+    hdr['CCD-TEMP'] = -10.
+    return fits.HDUList(fits.PrimaryHDU(im, hdr))
+
+def write_night(directory, npairs=3, lines=('SII', 'Na')):
+    """Write npairs of on-band (300s) and off-band (60s) synthetic
+    frames of each of lines to directory, named like the raw files.
+    Returns list of filenames"""
+    os.makedirs(directory, exist_ok=True)
+    T = Time(bench_date + 'T03:00:00', format='fits')
+    fnames = []
+    seed = 0
+    for line in lines:
+        for i in range(npairs):
+            for band, exptime in (('on', 300), ('off', 60)):
+                fname = os.path.join(directory, line + '_' + band
+                                     + '-band_' + '{:03d}'.format(i)
+                                     + '.fits')
+                synthetic_frame(line + '_' + band, T.fits, exptime,
+                                seed=seed).writeto(fname, overwrite=True)
+                fnames.append(fname)
+                T += (exptime + 30)/86400
+                seed += 1
+    return fnames
+
+def timed(func, repeat, setup=None):
+    """Returns list of times of repeat calls of func, each after an
+    untimed call of setup"""
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+def run(workdir, repeat=3, only=None):
+    """Write a synthetic night in workdir and time the benchmarks
+    named in only (default all) repeat times each.  Returns dictionary
+    of lists of times (s)"""
+    if only is None:
+        only = benchmarks
+    # Keep everything in workdir and measure the real work, not
+    # cache hits
+    header_index.default_index_fname = os.path.join(workdir,
+                                                    'header_index.sqlite')
+    ap_sum_store.default_store_fname = os.path.join(workdir,
+                                                    'ap_sum.sqlite')
+    R.ND_params_cache_fname = None
+    R.back_level_cache_fname = None
+    rawdir = os.path.join(workdir, 'raw', bench_date)
+    reddir = os.path.join(workdir, 'reduced', bench_date)
+    os.makedirs(reddir, exist_ok=True)
+    fnames = write_night(rawdir)
+    on_fname, off_fname = fnames[0:2]
+    default_ND_params = IoIO.run_level_default_ND_params
+    results = {}
+
+    def add(name, func, setup=None):
+        if name in only:
+            results[name] = timed(func, repeat, setup)
+            log.debug(name + ': ' + str(np.median(results[name])) + ' s')
+
+    add('synthetic_frame', lambda: synthetic_frame(seed=0))
+    with fits.open(on_fname) as HDUL:
+        im = HDUL[0].data
+        def new_CorObsData():
+            return IoIO.CorObsData(fits.HDUList([HDUL[0].copy()]),
+                                   default_ND_params=default_ND_params,
+                                   recalculate=True)
+        add('CorObsData', new_CorObsData)
+        O = new_CorObsData()
+        # Construction calculates everything and releases the image,
+        # so give it back and forget the result to time each step
+        def forget(attr):
+            def setup():
+                O.HDUList = fits.HDUList([HDUL[0].copy()])
+                setattr(O, attr, None)
+            return setup
+        add('ND_params', lambda: O.ND_params, forget('_ND_params'))
+        add('obj_center', lambda: O.obj_center, forget('_obj_center'))
+        add('back_level', lambda: IoIO.back_level(
+            im, method=R.background_back_level_method))
+    back_obj = R.Background(rawdir, num_processes=1)
+    add('Background', lambda: R.Background(rawdir, num_processes=1))
+    reduced = []
+    for on, off in zip(fnames[0:6:2], fnames[1:6:2]):
+        outfname = os.path.join(reddir, os.path.basename(on)
+                                .replace('.fits', 'r.fits'))
+        def reduce():
+            R.reduce_pair(on, off, back_obj=back_obj,
+                          default_ND_params=default_ND_params,
+                          NPole_ang=bench_NPole_ang,
+                          ang_width=bench_ang_width,
+                          outfname=outfname,
+                          recalculate=True)
+        if 'reduce_pair' in only and not reduced:
+            add('reduce_pair', reduce)
+        elif 'make_frame' in only:
+            reduce()
+        reduced.append(outfname)
+    if 'make_frame' in only:
+        if not all([os.path.isfile(f) for f in reduced]):
+            log.warning('make_frame: reduce_pair did not produce all of '
+                        + str(reduced))
+        else:
+            add('make_frame',
+                lambda: R.MovieCorObs(list(reduced)).make_frame(0))
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def record(results, repeat):
+    """Returns dictionary describing this run and its results"""
+    return {'date': Time.now().fits,
+            'host': platform.node(),
+            'revision': git_revision(),
+            'rversion': R.rversion,
+            'numpy': np.__version__,
+            'repeat': repeat,
+            'results': {name: {'median': float(np.median(t)),
+                               'min': float(np.min(t))}
+                        for name, t in results.items()}}
+
+def previous_record(results_fname, host):
+    """Returns last record in results_fname from host or None"""
+    prev = None
+    if not os.path.isfile(results_fname):
+        return None
+    with open(results_fname) as f:
+        for line in f:
+            rec = json.loads(line)
+            if rec['host'] == host:
+                prev = rec
+    return prev
+
+def compare(rec, prev):
+    """Log each benchmark of rec with its ratio to prev.  Returns list
+    of names of benchmarks slower by more than regression_tolerance"""
+    slower = []
+    for name, r in rec['results'].items():
+        msg = name + ': ' + '{:.4f}'.format(r['median']) + ' s'
+        p = None if prev is None else prev['results'].get(name)
+        if p is None:
+            log.info(msg)
+            continue
+        ratio = r['median']/p['median']
+        msg += ' ({:.2f}x previous)'.format(ratio)
+        if ratio > 1 + regression_tolerance:
+            log.warning(msg + ' REGRESSION since ' + str(prev['revision']))
+            slower.append(name)
+        else:
+            log.info(msg)
+    return slower
+
+def bench_cmd(args):
+    workdir = args.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='IoIO_bench')
+    try:
+        results = run(workdir, repeat=args.repeat, only=args.only)
+    finally:
+        if args.workdir is None and not args.keep:
+            shutil.rmtree(workdir)
+    rec = record(results, args.repeat)
+    prev = previous_record(args.results, rec['host'])
+    compare(rec, prev)
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(rec) + '\n')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time the IoIO reduction on synthetic frames")
+    parser.add_argument(
+        '--results', default=default_results_fname,
+        help='JSON-lines file results are appended to and compared with, default ' + default_results_fname)
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='times to run each benchmark, default 3')
+    parser.add_argument(
+        '--only', nargs='+', choices=benchmarks,
+        help='benchmarks to run, default all')
+    parser.add_argument(
+        '--workdir', help='directory for synthetic data, default a temporary directory that is removed afterward')
+    parser.add_argument(
+        '--keep', action='store_true',
+        help='keep temporary directory')
+    args = parser.parse_args()
+    bench_cmd(args)
@@ -24,7 +24,7 @@ import pandas as pd
 from astropy import log
 from astropy import units as u
 from astropy.io import fits
-from astropy.nddata import CCDData, StdDevUncertainty
+from astropy.nddata import CCDData
 from astropy.table import QTable
 from astropy.time import Time, TimeDelta
 from astropy.stats import mad_std, biweight_location
@@ -36,6 +36,8 @@ from photutils import Background2D, MedianBackground
 import ccdproc as ccdp
 
 from IoIO import CorObsData
+from header_index import HeaderCollection
+from fits_access import open_fits, ImageSections, iter_row_blocks
 
 # Record in global variables Starlight Xpress Trius SX694 CCD
 # characteristics.  Note that CCD was purchased in 2017 and is NOT the
@@ -113,6 +115,11 @@ max_mem_frac = 0.6
 max_ccddata_size = (sx694_naxis1 * sx694_naxis2
                     * (2 * 64 + 8)) / 8
 
+# bias_dataframe estimates readnoise from the differences between
+# every bias_rdnoise_row_step-th row and the next.  1 uses all rows.
+# Larger values subsample the biweight, at the cost of precision
+bias_rdnoise_row_step = 1
+
 
 data_root = '/data/io/IoIO'
 raw_data_root = os.path.join(data_root, 'raw')
@@ -436,7 +443,7 @@ def fname_by_imagetyp_ccdt_exp(directory=None,
         subdirs = []
     if glob_include is None:
         # Trick to make loop on glob_include, below, pass None to
-        # ccdp.ImageFileCollection
+        # HeaderCollection
         glob_include = [None]
     fdict_list = []
     if collection is None:
@@ -459,10 +466,9 @@ def fname_by_imagetyp_ccdt_exp(directory=None,
         for gi in glob_include:
             # Speed things up considerably by allowing globbing.  As
             # per comment above, if None passed to glob_include, this
-            # runs once with None passed to ccdp.ImageFileCollection's
+            # runs once with None passed to HeaderCollection's
             # glob_include
-            collection = ccdp.ImageFileCollection(directory,
-                                                  glob_include=gi)
+            collection = HeaderCollection(directory, glob_include=gi)
             # Call ourselves recursively, but using the code below,
             # since collection is now defined
             gi_fdict_list = fname_by_imagetyp_ccdt_exp \
@@ -517,35 +523,107 @@ def fname_by_imagetyp_ccdt_exp(directory=None,
                                'fnames': full_files})
     return fdict_list
 
+def counts_median(values, counts):
+    """Returns median of data given as sorted values and the number of
+    times each occurs (e.g. from np.bincount), like np.median of the
+    data itself"""
+    cum = np.cumsum(counts)
+    n = cum[-1]
+    # --> np.median averages the middle two of an even number of points
+    lo = values[np.searchsorted(cum, (n - 1)//2, side='right')]
+    hi = values[np.searchsorted(cum, n//2, side='right')]
+    return (lo + hi)/2
+
+def counts_biweight_location(values, counts, c=6.0):
+    """Returns astropy.stats.biweight_location of data given as sorted
+    values and their counts.  The sums run over the distinct values
+    rather than the data"""
+    values = np.asarray(values, dtype=float)
+    M = counts_median(values, counts)
+    d = values - M
+    ad = np.abs(d)
+    order = np.argsort(ad, kind='stable')
+    mad = counts_median(ad[order], counts[order])
+    if mad == 0:
+        return M
+    u = d / (c * mad)
+    w = (1 - u**2)**2
+    w[np.abs(u) >= 1] = 0
+    return M + np.sum(counts*d*w) / np.sum(counts*w)
+
+def bias_stats(HDUList, row_step=None):
+    """Returns dictionary of median, mean, std, min, max and readnoise
+    (ADU) of the uint16 primary image of HDUList (opened with
+    raw=True).  The image is read a block of rows at a time into
+    histograms of the pixel values and of the absolute differences
+    between every row_step-th (default bias_rdnoise_row_step) row and
+    the next, from which the statistics are calculated exactly.
+    Readnoise is the square root of the biweight location of the
+    squared differences"""
+    if row_step is None:
+        row_step = bias_rdnoise_row_step
+    counts = np.zeros(2**16, dtype=np.int64)
+    dcounts = np.zeros(2**16, dtype=np.int64)
+    last = None
+    y = 0
+    for block in iter_row_blocks(HDUList):
+        if block.dtype != np.uint16:
+            raise ValueError('bias_stats needs uint16 data, not '
+                             + str(block.dtype))
+        counts += np.bincount(block.ravel(), minlength=2**16)
+        rows = block.astype(np.int32)
+        if last is not None:
+            rows = np.vstack((last, rows))
+        # --> Row differences of uint16 would wrap
+        diffs = np.abs(np.diff(rows, axis=0))
+        # Global index of the first row of rows
+        y0 = y if last is None else y - 1
+        diffs = diffs[(-y0) % row_step::row_step]
+        dcounts += np.bincount(diffs.ravel(), minlength=2**16)
+        last = rows[-1:]
+        y += block.shape[0]
+    values = np.flatnonzero(counts)
+    c = counts[values]
+    n = np.sum(c)
+    mean = np.dot(values, c)/n
+    dvalues = np.flatnonzero(dcounts)
+    rdnoise = np.sqrt(counts_biweight_location(
+        dvalues.astype(float)**2, dcounts[dvalues]))
+    return {'median': counts_median(values, c),
+            'mean': mean,
+            'std': np.sqrt(np.dot(c, (values - mean)**2)/n),
+            'rdnoise': rdnoise,
+            'min': values[0],
+            'max': values[-1]}
+
 def bias_dataframe(fname, gain):
     """Worker routine to enable parallel processing of time-consuming matrix calculation"""
-    ccd = ccddata_read(fname, add_metadata=True)
-    if not full_frame(ccd):
-        log.debug('bias wrong shape: ' + fname)
-        return {'good': False}
-    if light_image(ccd):
-        log.debug('bias recorded during light conditions: ' +
-                  fname)
-        return {'good': False}
-    im = ccd.data
-    # Create uncertainty image
-    diffs2 = (im[1:] - im[0:-1])**2
-    rdnoise = np.sqrt(biweight_location(diffs2))
-    uncertainty = np.multiply(rdnoise, np.ones(im.shape))
-    ccd.uncertainty = StdDevUncertainty(uncertainty)
+    # Reject binned and light-contaminated biases from the header and
+    # the light_image patches before reading the whole image
+    with open_fits(fname, raw=True) as HDUList:
+        sections = ImageSections(HDUList)
+        if not full_frame(sections):
+            log.debug('bias wrong shape: ' + fname)
+            return {'good': False}
+        if light_image(sections):
+            log.debug('bias recorded during light conditions: ' +
+                      fname)
+            return {'good': False}
+        stats = bias_stats(HDUList)
+        hdr = HDUList[0].header
     # Prepare to create a pandas data frame to track relevant
     # quantities
-    tm = Time(ccd.meta['DATE-OBS'], format='fits')
-    ccdt = ccd.meta['CCD-TEMP']
+    tm = Time(hdr['DATE-OBS'], format='fits')
+    ccdt = hdr['CCD-TEMP']
     tt = tm.tt.datetime
     dataframe = {'time': tt,
                  'ccdt': ccdt,
-                 'median': np.median(im),
-                 'mean': np.mean(im),
-                 'std': np.std(im)*gain,
-                 'rdnoise': rdnoise*gain,
-                 'min': np.min(im),  
-                 'max': np.max(im)}
+                 'median': stats['median'],
+                 'mean': stats['mean'],
+                 'std': stats['std']*gain,
+                 'rdnoise': stats['rdnoise']*gain,
+                 'min': stats['min'],
+                 'max': stats['max']}
     return {'good': True,
             'fname': fname,
             'dataframe': dataframe,
@@ -595,18 +673,12 @@ def bias_combine(directory=None,
     # objects (lccd)
 
     for fdict in fdict_list:
-        # Parallelize collection of stats.  Make sure we don't read in
-        # too many files for our instantaneous memory available.  Also
-        # make sure we don't use too many processors.  Using the
-        # global max_ccddata_size assures this is a reaosnably
-        # conservative calculation, though I haven't check the details
-        # of intermediate calculations
+        # Parallelize collection of stats.  bias_stats reads a block
+        # of rows at a time into histograms, so each process needs
+        # only a few MB and only the number of processors limits the
+        # number of files read at once
         num_files = len(fdict['fnames'])
-        mem = psutil.virtual_memory()
-        num_files_can_fit = \
-            int(min(num_files,
-                    mem.available*mem_frac/max_ccddata_size))
-        num_can_process = min(num_processes, num_files_can_fit)
+        num_can_process = min(num_processes, num_files)
         gains = [gain] * num_files
         try:
             with Pool(processes=num_can_process) as p:
@@ -1508,8 +1580,8 @@ def flat_combine(directory=None,
         if not os.path.isdir(directory):
             log.debug('No directory ' + directory)
             return False
-        collection = ccdp.ImageFileCollection(directory,
-                                              glob_include=glob_include)
+        collection = HeaderCollection(directory,
+                                      glob_include=glob_include)
     directory = collection.location
     if collection.summary is None:
         if subdir is not None:
@@ -1548,7 +1620,7 @@ def flat_combine(directory=None,
             # Use the CorObsData ND filter stuff with a negative
             # edge_mask to blank out all of the fuzz from the ND filter cut
             obs_data = CorObsData(ccd.to_hdu(), edge_mask=edge_mask)
-            mask[obs_data.ND_coords] = True
+            mask[obs_data.ND_mask] = True
             rdnoise = ccd.meta['RDNOISE']
             mask[ccd.data < rdnoise * init_threshold] = True
             ccd.mask = mask
@@ -1588,7 +1660,7 @@ def flat_combine(directory=None,
         # Capture our ND filter metadata
         im.meta = hdul[0].header
         good_pix = np.ones(ccd.shape, bool)
-        good_pix[obs_data.ND_coords] = False
+        good_pix[obs_data.ND_mask] = False
         points = np.where(good_pix)
         values = im[points]
         xi = obs_data.ND_coords
@@ -1624,7 +1696,8 @@ def flat_combine(directory=None,
 
 
 def bias_analyze(directory='/data/io/IoIO/reduced/bias_dark'):
-    collection = ccdp.ImageFileCollection(directory)
+    collection = HeaderCollection(directory,
+                                  keywords=['ccd-temp', 'median', 'mean'])
     s = collection.summary
     f = plt.figure(figsize=[8.5, 11])
     #good_idx = s['date-obs'] > '2020-04-17T00:00'
@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+
+"""
+Local table of Jupiter's NPole_ang and ang_width for IoIO reductions
+
+ReduceCorObs used to query JPL Horizons (astroquery) for every
+directory and pair it reduced, which requires the network and
+serializes tree reductions on remote latency.  Ephemeris reads a table
+covering the whole observing span from a local ECSV file and linearly
+interpolates it for any DATE-OBS.  The table is built ahead of time
+with populate (which queries Horizons) or ingest (which reads a table
+saved elsewhere, e.g. a Horizons download).
+
+A date is covered only if the table rows on either side of it are no
+more than ephemeris_step apart, so gaps (e.g. between the few days
+that ephemeris_query_missing adds around each miss) are not
+interpolated across.  Processes that add rows to the table take a
+lock on it (fname + '.lock') and merge with what is on disk, so pool
+workers don't drop each other's rows.
+"""
+
+import os
+import re
+import fcntl
+import argparse
+import contextlib
+
+import numpy as np
+from astropy import log
+from astropy.time import Time
+from astropy.table import Table, vstack, unique
+
+data_root = '/data/io/IoIO'
+default_ephemeris_fname = os.path.join(data_root, 'Jupiter_ephemeris.ecsv')
+# Moka observatory at Benson, which looks like the San Pedro Valley
+# observatory
+ephemeris_location = 'V09'
+ephemeris_step = '1d'
+# If True, dates not covered by the table are queried from Horizons
+# and added to it.  Otherwise a ValueError is raised
+ephemeris_query_missing = False
+
+columns = ['jd', 'NPole_ang', 'ang_width']
+
+# Horizons step units in days
+step_units = {'d': 1, 'h': 1/24, 'm': 1/1440}
+
+def step_days(step=None):
+    """Returns Horizons step (e.g. '1d', '6h', '30m', default
+    ephemeris_step) in days"""
+    if step is None:
+        step = ephemeris_step
+    m = re.fullmatch(r'\s*([\d.]+)\s*([dhm])\w*\s*', step)
+    if m is None:
+        raise ValueError('Unknown ephemeris step ' + str(step))
+    return float(m.group(1)) * step_units[m.group(2)]
+
+def horizons_table(start, stop, step=None, location=None):
+    """Returns Table of Jupiter jd, NPole_ang (deg) and ang_width
+    (arcsec) from JPL Horizons.  start and stop are anything Time
+    understands"""
+    # Only needed to populate the table
+    from astroquery.jplhorizons import Horizons
+    if step is None:
+        step = ephemeris_step
+    if location is None:
+        location = ephemeris_location
+    start = Time(start)
+    stop = Time(stop)
+    jup = Horizons(id=599,
+                   location=location,
+                   epochs={'start': start.iso[0:10],
+                           'stop': stop.iso[0:10],
+                           'step': step},
+                   id_type='majorbody')
+    e = jup.ephemerides()
+    return Table([e['datetime_jd'].quantity.value,
+                  e['NPole_ang'].quantity.value,
+                  e['ang_width'].quantity.value],
+                 names=columns)
+
+class Ephemeris():
+    """Interpolated local table of Jupiter NPole_ang and ang_width
+
+    Parameters
+    ----------
+    fname : str
+        ECSV file with columns jd, NPole_ang (deg), ang_width
+        (arcsec).  Default: default_ephemeris_fname
+    """
+    def __init__(self, fname=None):
+        if fname is None:
+            fname = default_ephemeris_fname
+        self.fname = fname
+        self._table = None
+        self._unwrapped = None
+
+    @property
+    def table(self):
+        if self._table is None:
+            if os.path.isfile(self.fname):
+                self._table = Table.read(self.fname, format='ascii.ecsv')
+            else:
+                self._table = Table(names=columns, dtype=[float]*3)
+        return self._table
+
+    def reload(self):
+        """Forget the table, so it is read again from fname"""
+        self._table = None
+        self._unwrapped = None
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Context manager that holds an exclusive lock on the table
+        file and re-reads it, for read-merge-write updates"""
+        d = os.path.dirname(self.fname)
+        if d != '' and not os.path.isdir(d):
+            os.makedirs(d, exist_ok=True)
+        with open(self.fname + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self.reload()
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def merge(self, t):
+        """Add rows of Table t (columns jd, NPole_ang, ang_width) to the
+        table, replacing rows with the same jd"""
+        t = Table([t[c] for c in columns], names=columns)
+        # unique keeps the first of duplicates, so put new rows first
+        merged = unique(vstack([t, self.table]), keys='jd', keep='first')
+        merged.sort('jd')
+        self._table = merged
+        self._unwrapped = None
+
+    def write(self):
+        d = os.path.dirname(self.fname)
+        if d != '' and not os.path.isdir(d):
+            os.makedirs(d)
+        # Write then rename so parallel readers never see a partial
+        # file
+        tmp = self.fname + '.' + str(os.getpid())
+        self.table.write(tmp, format='ascii.ecsv', overwrite=True)
+        os.replace(tmp, self.fname)
+
+    def _query(self, start, stop, step=None, location=None):
+        """Query Horizons for start to stop, merge and save.  Call with
+        the table locked"""
+        log.info('Querying Horizons for Jupiter ephemeris '
+                 + str(start) + ' to ' + str(stop))
+        self.merge(horizons_table(start, stop, step=step,
+                                  location=location))
+        self.write()
+
+    def populate(self, start, stop, step=None, location=None):
+        """Query Horizons for start to stop and save"""
+        with self.locked():
+            self._query(start, stop, step=step, location=location)
+
+    def ingest(self, fname):
+        """Add table in fname (any astropy-readable format with
+        columns jd or datetime_jd, NPole_ang and ang_width) and save"""
+        t = Table.read(fname)
+        if 'jd' not in t.colnames:
+            t.rename_column('datetime_jd', 'jd')
+        with self.locked():
+            self.merge(t)
+            self.write()
+
+    def covers(self, jd):
+        """True if jd is a row of the table or the rows on either side
+        of it are no more than ephemeris_step apart"""
+        t = np.asarray(self.table['jd'])
+        if len(t) < 2:
+            return False
+        i = np.searchsorted(t, jd, side='left')
+        if i < len(t) and t[i] == jd:
+            return True
+        if i == 0 or i == len(t):
+            return False
+        # Allow for rounding of the Horizons times
+        return t[i] - t[i-1] <= step_days() * (1 + 1e-6)
+
+    def Jupiter(self, T):
+        """Returns (NPole_ang, ang_width) of Jupiter at T (Time or
+        anything Time understands)"""
+        jd = Time(T).jd
+        if not self.covers(jd):
+            if not ephemeris_query_missing:
+                raise ValueError(
+                    'Date ' + Time(T).fits + ' not covered by ephemeris '
+                    + self.fname + ' (or in a gap longer than '
+                    + ephemeris_step + ').  Run ephemeris.py populate')
+            # Old behavior was one query per night.  Grab a few days
+            # around T so we don't come right back.  Another process
+            # may have done so while we waited for the lock
+            with self.locked():
+                if not self.covers(jd):
+                    self._query(Time(jd - 2, format='jd'),
+                                Time(jd + 2, format='jd'))
+        t = self.table
+        if self._unwrapped is None:
+            # NPole_ang is an angle, so unwrap before interpolating
+            self._unwrapped = np.degrees(
+                np.unwrap(np.radians(t['NPole_ang'])))
+        NPole_ang = np.interp(jd, t['jd'], self._unwrapped) % 360
+        ang_width = np.interp(jd, t['jd'], t['ang_width'])
+        return NPole_ang, ang_width
+
+_ephemeris = None
+def get_ephemeris():
+    """Returns Ephemeris read from default_ephemeris_fname, reading it
+    only once per process"""
+    global _ephemeris
+    if _ephemeris is None:
+        _ephemeris = Ephemeris()
+    return _ephemeris
+
+def populate_cmd(args):
+    Ephemeris(args.ephemeris).populate(args.start, args.stop,
+                                       step=args.step)
+
+def ingest_cmd(args):
+    Ephemeris(args.ephemeris).ingest(args.fname)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Maintain local Jupiter ephemeris table for IoIO reductions")
+    parser.add_argument(
+        '--ephemeris', help='ephemeris table, default ' + default_ephemeris_fname)
+    subparsers = parser.add_subparsers(dest='one of the subcommands in {}, above', help='sub-command help')
+    subparsers.required = True
+
+    populate_parser = subparsers.add_parser(
+        'populate', help='Query JPL Horizons for an observing span')
+    populate_parser.add_argument(
+        'start', help='start date (e.g. 2017-01-01)')
+    populate_parser.add_argument(
+        'stop', help='stop date')
+    populate_parser.add_argument(
+        '--step', default=ephemeris_step, help='Horizons step size, default ' + ephemeris_step)
+    populate_parser.set_defaults(func=populate_cmd)
+
+    ingest_parser = subparsers.add_parser(
+        'ingest', help='Add a saved table with jd (or datetime_jd), NPole_ang and ang_width columns')
+    ingest_parser.add_argument(
+        'fname', help='table filename')
+    ingest_parser.set_defaults(func=ingest_cmd)
+
+    args = parser.parse_args()
+    args.func(args)
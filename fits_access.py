@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+"""
+Memory-mapped, lazy access to the FITS files of the IoIO reduction
+
+Touching HDUList[0].data makes astropy read and scale the whole
+primary HDU, even when only the header, a few boxes (e.g. at the
+corners of the CCD) or one block of rows at a time is needed.  The
+functions here open files memory-mapped and read only what is asked
+for, using HDU.section for pieces of the image.  They keep a count of
+the image bytes read in this process so that reductions can report
+their I/O together with their peak RSS (see io_stats)
+"""
+
+import os
+import resource
+
+import numpy as np
+from astropy import log
+from astropy.io import fits
+
+# Rows per block returned by iter_row_blocks.  At 2750 columns of
+# uint16, 256 rows is ~1.4 MB
+row_block_size = 256
+
+_bytes_read = 0
+
+def _count(a):
+    global _bytes_read
+    _bytes_read += a.nbytes
+    return a
+
+def open_fits(fname, raw=False):
+    """Returns HDUList of fname.  Nothing but the primary header is
+    read until it is needed.  astropy can't memory-map images that have
+    BZERO or BSCALE, so these are read whole when .data is accessed.
+    Open with raw=True to memory-map the unscaled image and use
+    read_section, which does the scaling"""
+    if raw:
+        return fits.open(fname, memmap=True, lazy_load_hdus=True,
+                         do_not_scale_image_data=True)
+    # memmap=None memory-maps where astropy can
+    return fits.open(fname, lazy_load_hdus=True)
+
+def scale(raw, header):
+    """Returns raw image data scaled by the BZERO and BSCALE of header.
+    Like astropy, 16 and 32 bit integers with the unsigned BZERO
+    offset become unsigned integers"""
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    if bscale == 1 and bzero == 0:
+        return np.asarray(raw)
+    if (bscale == 1 and raw.dtype.kind == 'i'
+        and bzero == 2**(8*raw.dtype.itemsize - 1)):
+        return (raw.astype(np.int64) + bzero).astype(
+            'u' + str(raw.dtype.itemsize))
+    return raw * np.float64(bscale) + bzero
+
+def read_header(fname):
+    """Returns primary header of fname without touching the data"""
+    with open_fits(fname) as HDUList:
+        return HDUList[0].header.copy()
+
+def image_shape(header):
+    """Returns (ny, nx) of primary image from its header"""
+    return (header['NAXIS2'], header['NAXIS1'])
+
+def image_hdu(HDUList):
+    """Returns the HDU of HDUList with the image: the primary HDU or,
+    in tile-compressed files, which have a header-only primary HDU,
+    the first extension"""
+    if HDUList[0].header.get('NAXIS', 0) == 0 and len(HDUList) > 1:
+        return HDUList[1]
+    return HDUList[0]
+
+def primary_image(HDUList):
+    """Returns HDUList if its image is in the primary HDU, otherwise a
+    new HDUList with the (decompressed) image in the primary HDU, for
+    code like IoIO.CorObsData that expects it there"""
+    hdu = image_hdu(HDUList)
+    if hdu is HDUList[0]:
+        return HDUList
+    return fits.HDUList(fits.PrimaryHDU(hdu.data, HDUList[0].header))
+
+def read_data(HDUList):
+    """Returns full image of HDUList, counting the bytes"""
+    return _count(image_hdu(HDUList).data)
+
+def read_section(HDUList, ys, xs):
+    """Returns primary image section [ys, xs] (slices) of HDUList
+    opened with open_fits(fname, raw=True), reading only those rows
+    and columns from the file"""
+    return _count(scale(HDUList[0].section[ys, xs], HDUList[0].header))
+
+class ImageSections():
+    """Read-only, array-like view of the primary image of HDUList
+    (opened with raw=True).  Has shape, and slicing it with two slices
+    reads only that section of the file"""
+    def __init__(self, HDUList):
+        self.HDUList = HDUList
+        self.shape = image_shape(HDUList[0].header)
+
+    def __getitem__(self, key):
+        ys, xs = key
+        return read_section(self.HDUList, ys, xs)
+
+def read_boxes(fname, boxes):
+    """Returns list of sections of fname, one for each (ys, xs) in
+    boxes"""
+    with open_fits(fname, raw=True) as HDUList:
+        return [read_section(HDUList, ys, xs) for ys, xs in boxes]
+
+def iter_row_blocks(HDUList, nrows=None):
+    """Yields primary image of HDUList (opened with raw=True) in
+    blocks of nrows (default row_block_size) rows, so whole-image statistics can be accumulated
+    without holding the whole image in memory"""
+    if nrows is None:
+        nrows = row_block_size
+    ny, nx = image_shape(HDUList[0].header)
+    for y in range(0, ny, nrows):
+        yield read_section(HDUList, slice(y, min(y + nrows, ny)),
+                           slice(0, nx))
+
+def io_stats():
+    """Returns dictionary with pid, image bytes read so far and peak RSS
+    (bytes) of this process"""
+    # ru_maxrss is in kB on Linux
+    return {'pid': os.getpid(),
+            'bytes_read': _bytes_read,
+            'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            * 1024}
+
+def log_io_stats(label, stats_list):
+    """Log total image data read and largest peak RSS of the processes
+    (e.g. pool workers) whose io_stats are in stats_list"""
+    bytes_read = {}
+    maxrss = 0
+    for st in stats_list:
+        bytes_read[st['pid']] = max(bytes_read.get(st['pid'], 0),
+                                    st['bytes_read'])
+        maxrss = max(maxrss, st['maxrss'])
+    log.info(label + ': ' + str(sum(bytes_read.values())/2**20)
+             + ' MB image data read, ' + str(maxrss/2**20)
+             + ' MB peak RSS per process')
@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+"""
+Persistent index of the FITS headers in the IoIO raw and reduced trees
+
+ccdproc.ImageFileCollection opens every FITS header in a directory
+each time it is constructed, which adds up to tens of thousands of
+header reads when a whole tree is reduced.  HeaderIndex keeps one row
+per file (path, size, mtime and header) in an SQLite database and only
+re-reads headers of files that are new or have changed.
+HeaderCollection provides the subset of the ImageFileCollection
+interface that the reduction code uses (location, keywords, summary,
+values, files_filtered and sort), so it can be used in its place.
+"""
+
+import os
+import fnmatch
+import sqlite3
+import json
+import argparse
+
+import numpy as np
+from astropy import log
+from astropy.io import fits
+from astropy.table import Table, MaskedColumn
+
+data_root = '/data/io/IoIO'
+default_index_fname = os.path.join(data_root, 'header_index.sqlite')
+
+# Same set of extensions ccdproc.ImageFileCollection recognizes
+fits_extensions = ['.fit', '.fits', '.fts',
+                   '.fit.gz', '.fits.gz', '.fts.gz']
+
+# Keywords that are put in HeaderCollection.summary by default.  These
+# are the ones the reduction code filters on
+index_keywords = ['imagetyp', 'filter', 'exptime', 'date-obs',
+                  'xbinning', 'ybinning', 'ccd-temp', 'raoff', 'decoff',
+                  'object', 'objctra', 'objctdec', 'sitelat', 'sitelong',
+                  'alt-obs']
+
+# Cards we don't bother storing
+skip_cards = ['', 'COMMENT', 'HISTORY']
+
+def is_fits(fname):
+    fname = fname.lower()
+    return np.any([fname.endswith(e) for e in fits_extensions])
+
+def header_to_dict(header):
+    """Returns dictionary of simple (str, int, float, bool) header
+    values with lowercase keys"""
+    hd = {}
+    for card in header.cards:
+        if card.keyword in skip_cards:
+            continue
+        value = card.value
+        if isinstance(value, (str, bool, int, float)):
+            hd[card.keyword.lower()] = value
+    return hd
+
+class HeaderIndex():
+    """Persistent, incrementally updated index of FITS headers
+
+    Parameters
+    ----------
+    fname : str
+        SQLite database filename.  Default: default_index_fname.  If
+        the database can't be opened, headers are read directly from
+        the files and nothing is saved
+    """
+    def __init__(self, fname=None):
+        if fname is None:
+            fname = default_index_fname
+        self.fname = fname
+
+    def connect(self):
+        try:
+            con = sqlite3.connect(self.fname, timeout=60)
+            con.execute('CREATE TABLE IF NOT EXISTS headers '
+                        '(fname TEXT PRIMARY KEY, directory TEXT, '
+                        'size INTEGER, mtime INTEGER, header TEXT)')
+            con.execute('CREATE INDEX IF NOT EXISTS directory_idx '
+                        'ON headers (directory)')
+        except sqlite3.Error as e:
+            log.warning('Header index ' + self.fname
+                        + ' not available, reading headers directly: '
+                        + str(e))
+            con = sqlite3.connect(':memory:')
+            con.execute('CREATE TABLE headers '
+                        '(fname TEXT PRIMARY KEY, directory TEXT, '
+                        'size INTEGER, mtime INTEGER, header TEXT)')
+        return con
+
+    def refresh(self, directory):
+        """Bring index of directory up to date, reading headers of only
+        new and changed files.  Returns dictionary of header
+        dictionaries keyed by (non-path) filename"""
+        directory = os.path.abspath(directory)
+        on_disk = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_file() and is_fits(entry.name):
+                    st = entry.stat()
+                    on_disk[entry.name] = (st.st_size, st.st_mtime_ns)
+        con = self.connect()
+        with con:
+            rows = con.execute('SELECT fname, size, mtime, header '
+                               'FROM headers WHERE directory=?',
+                               (directory,)).fetchall()
+            indexed = {os.path.basename(r[0]): r for r in rows}
+            headers = {}
+            nread = 0
+            for f, (size, mtime) in on_disk.items():
+                r = indexed.get(f)
+                if r is not None and r[1] == size and r[2] == mtime:
+                    headers[f] = json.loads(r[3])
+                    continue
+                full = os.path.join(directory, f)
+                try:
+                    hd = header_to_dict(fits.getheader(full))
+                except Exception as e:
+                    log.warning('Skipping unreadable FITS file '
+                                + full + ': ' + str(e))
+                    continue
+                nread += 1
+                headers[f] = hd
+                con.execute('INSERT OR REPLACE INTO headers VALUES '
+                            '(?, ?, ?, ?, ?)',
+                            (full, directory, size, mtime,
+                             json.dumps(hd)))
+            gone = [r[0] for f, r in indexed.items() if f not in on_disk]
+            con.executemany('DELETE FROM headers WHERE fname=?',
+                            [(g,) for g in gone])
+        con.close()
+        log.debug('Header index ' + directory + ': read '
+                  + str(nread) + ' of ' + str(len(headers)) + ' headers')
+        return headers
+
+    def collection(self, directory, keywords=None, glob_include=None):
+        """Returns HeaderCollection for directory"""
+        return HeaderCollection(directory, keywords=keywords,
+                                glob_include=glob_include, index=self)
+
+class HeaderCollection():
+    """Stand-in for ccdproc.ImageFileCollection backed by a HeaderIndex
+
+    Parameters
+    ----------
+    location : str
+        Directory
+    keywords : list of str or '*'
+        Keywords to put in summary.  '*' means all keywords found in
+        any header.  Default: index_keywords
+    glob_include : str
+        Unix shell-style wildcard limiting files (e.g. 'Bias*')
+    index : HeaderIndex
+        Default: HeaderIndex()
+    """
+    def __init__(self, location, keywords=None, glob_include=None,
+                 index=None):
+        if index is None:
+            index = HeaderIndex()
+        if keywords is None:
+            keywords = index_keywords
+        self.location = location
+        headers = index.refresh(location)
+        files = sorted(headers.keys())
+        if glob_include is not None:
+            files = fnmatch.filter(files, glob_include)
+        if keywords == '*':
+            keywords = []
+            for f in files:
+                keywords.extend([k for k in headers[f].keys()
+                                 if k not in keywords])
+        else:
+            keywords = [k.lower() for k in keywords]
+        self._summary = None
+        self._keywords = ['file']
+        if len(files) == 0:
+            return
+        t = Table()
+        t['file'] = files
+        for k in keywords:
+            values = [headers[f].get(k) for f in files]
+            mask = [v is None for v in values]
+            if np.all(mask):
+                # Like ImageFileCollection, keywords not found in any
+                # header are not listed in keywords
+                continue
+            good = [v for v in values if v is not None]
+            if np.all([isinstance(v, (int, float))
+                       and not isinstance(v, bool) for v in good]):
+                fill = 0
+            elif np.all([isinstance(v, bool) for v in good]):
+                fill = False
+            else:
+                fill = ''
+                values = [str(v) if v is not None else v for v in values]
+            values = [fill if v is None else v for v in values]
+            t[k] = MaskedColumn(values, mask=mask)
+            self._keywords.append(k)
+        self._summary = t
+
+    @property
+    def summary(self):
+        return self._summary
+
+    @property
+    def keywords(self):
+        return self._keywords
+
+    def sort(self, keys):
+        if self._summary is not None:
+            self._summary.sort(keys)
+
+    def values(self, keyword, unique=False):
+        if self._summary is None:
+            return []
+        vals = list(self._summary[keyword.lower()])
+        if unique:
+            vals = list(set([v for v in vals
+                             if v is not np.ma.masked]))
+        return vals
+
+    def files_filtered(self, include_path=False, **kwd):
+        """Returns list of files whose keyword values match kwd.  String
+        comparisons are case-insensitive.  A value of '*' matches any
+        file that has the keyword"""
+        if self._summary is None:
+            return []
+        match = np.ones(len(self._summary), bool)
+        for k, v in kwd.items():
+            k = k.lower()
+            if k not in self._keywords:
+                return []
+            col = self._summary[k]
+            m = ~np.ma.getmaskarray(col)
+            if v != '*':
+                if isinstance(v, str):
+                    m &= np.asarray([str(c).lower() == v.lower()
+                                     for c in col.filled('')])
+                else:
+                    m &= np.asarray(np.ma.getdata(col) == v)
+            match &= m
+        files = list(self._summary['file'][match])
+        if include_path:
+            files = [os.path.join(self.location, f) for f in files]
+        return files
+
+def index_tree(directory, index=None):
+    """Refresh the header index of directory and all of its
+    subdirectories"""
+    if index is None:
+        index = HeaderIndex()
+    for d, subdirs, files in os.walk(directory):
+        if np.any([is_fits(f) for f in files]):
+            index.refresh(d)
+
+def index_cmd(args):
+    index_tree(args.directory, HeaderIndex(args.index))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Refresh persistent FITS header index of IoIO data tree")
+    parser.add_argument(
+        'directory', nargs='?', default=data_root, help='root of directory tree')
+    parser.add_argument(
+        '--index', help='index filename, default ' + default_index_fname)
+    args = parser.parse_args()
+    index_cmd(args)
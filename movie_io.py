@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+
+"""
+ffmpeg plumbing for the IoIO movies
+
+moviepy's write_videofile runs the whole frame callback of a clip for
+each file it writes, and concatenate_videoclips decodes every input
+to encode them again.  write_videos steps through the frame times
+once and pipes the frames of several clips (e.g. Na_SII.mp4 and
+Na_movie.mp4, which show the same Na frames) to one ffmpeg encoder
+each, which run alongside each other.  concat_copy joins movies with
+ffmpeg's concat demuxer without re-encoding, which is only valid when
+their streams match (see stream_info).
+
+concatenate keeps a manifest (.json next to the output) of the clips,
+with their checksums, that make up a concatenated movie, so that when
+nightly clips are added only they are appended, and when one changes
+only it is redone.  Clips whose streams don't match the others are
+re-encoded to match once, into a segment next to the clip
+"""
+
+import os
+import re
+import json
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from collections import Counter
+
+import numpy as np
+from astropy import log
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+
+# Bump to redo concatenations and re-encoded segments
+concat_version = '1'
+# ffmpeg encoder for re-encoding segments with stream_info codec
+encoders = {'h264': 'libx264'}
+
+def ffmpeg_binary():
+    return get_setting('FFMPEG_BINARY')
+
+def tmp_fname(fname):
+    """Returns name to write fname to before it is complete.  ffmpeg
+    picks the format from the extension, so that is kept"""
+    base, ext = os.path.splitext(fname)
+    return base + '.tmp' + ext
+
+def stream_info(fname):
+    """Returns dictionary of the codec, pix_fmt, size, fps and tbn
+    (time base) of the first video stream of fname, None if fname is
+    missing or has no video stream"""
+    if not os.path.isfile(fname):
+        return None
+    # ffmpeg describes the input and exits with an error, since there
+    # is no output
+    p = subprocess.run([ffmpeg_binary(), '-hide_banner', '-i', fname],
+                       capture_output=True, text=True)
+    m = re.search(r'Stream #.*Video: (.*)', p.stderr)
+    if m is None:
+        return None
+    line = m.group(1)
+    # Commas that are not in parentheses separate the fields
+    fields = re.split(r',\s*(?![^()]*\))', line)
+    # e.g. 1240x600 [SAR 1:1 DAR 31:15].  Don't match 0x31637661 in
+    # the codec tag
+    sizes = [m.group(0) for m in [re.match(r'\d+x\d+', f)
+                                  for f in fields[1:]]
+             if m is not None]
+    info = {'codec': fields[0].split()[0],
+            'pix_fmt': re.match(r'\w*', fields[1]).group(0),
+            'size': sizes[0] if len(sizes) > 0 else None}
+    for key in ['fps', 'tbn']:
+        m = re.search(r'([\d.]+k?) ' + key, line)
+        info[key] = None if m is None else m.group(1)
+    return info
+
+def write_videos(outputs, duration, fps, codec='libx264', key=None):
+    """Write clips to files in one pass over the frame times.  outputs
+    is a list of (fname, clip), where clip is a moviepy clip (size,
+    get_frame).  Frames are taken at the times and with the encoder
+    settings of clip.write_videofile.  If key(t) is the same as at
+    the previous frame time, so are the frames (e.g. they show the
+    same images), and they are not composed again"""
+    writers = []
+    try:
+        for fname, clip in outputs:
+            writers.append(FFMPEG_VideoWriter(tmp_fname(fname), clip.size,
+                                              fps, codec=codec))
+        last_key = None
+        for t in np.arange(0, duration, 1.0/fps):
+            k = None if key is None else key(t)
+            if k is None or k != last_key:
+                frames = [clip.get_frame(t).astype('uint8')
+                          for fname, clip in outputs]
+            last_key = k
+            for w, frame in zip(writers, frames):
+                w.write_frame(frame)
+    finally:
+        for w in writers:
+            w.close()
+    for fname, clip in outputs:
+        os.replace(tmp_fname(fname), fname)
+
+def concat_copy(fnames, outfname):
+    """Concatenate movies fnames into outfname without re-encoding"""
+    with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+        for fname in fnames:
+            # Quotes are escaped concat demuxer style
+            f.write("file '" + os.path.abspath(fname).replace("'", r"'\''")
+                    + "'\n")
+        f.flush()
+        subprocess.run([ffmpeg_binary(), '-hide_banner', '-loglevel', 'error',
+                        '-y', '-f', 'concat', '-safe', '0', '-i', f.name,
+                        '-c', 'copy', tmp_fname(outfname)], check=True)
+    os.replace(tmp_fname(outfname), outfname)
+
+def checksum(fname):
+    """Returns SHA1 hex digest of the contents of fname"""
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def manifest_fname(outfname):
+    return os.path.splitext(outfname)[0] + '.json'
+
+def segment_fname(fname):
+    """Returns name of the re-encoded segment of clip fname"""
+    base, ext = os.path.splitext(fname)
+    return base + '.seg' + ext
+
+def reencode(fname, outfname, info):
+    """Re-encode fname into outfname with the streams described by
+    stream_info dictionary info.  The image is scaled to fit and
+    padded"""
+    w, h = info['size'].split('x')
+    vf = ('scale=' + w + ':' + h + ':force_original_aspect_ratio=decrease,'
+          + 'pad=' + w + ':' + h + ':(ow-iw)/2:(oh-ih)/2')
+    cmd = [ffmpeg_binary(), '-hide_banner', '-loglevel', 'error', '-y',
+           '-i', fname, '-an', '-vf', vf,
+           '-c:v', encoders.get(info['codec'], info['codec']),
+           '-pix_fmt', info['pix_fmt']]
+    if info['fps'] is not None:
+        cmd += ['-r', info['fps']]
+    if info['tbn'] is not None:
+        tbn = info['tbn']
+        if tbn.endswith('k'):
+            tbn = str(int(float(tbn[:-1])*1000))
+        cmd += ['-video_track_timescale', tbn]
+    subprocess.run(cmd + [tmp_fname(outfname)], check=True)
+    os.replace(tmp_fname(outfname), outfname)
+
+def concatenate(fnames, outfname, recalculate=False):
+    """Concatenate the good movies of fnames into outfname by stream
+    copy, redoing only what has changed since the last time (see
+    module documentation) unless recalculate is True"""
+    mfname = manifest_fname(outfname)
+    previous = []
+    target = None
+    if (not recalculate
+        and os.path.isfile(mfname)
+        and os.path.isfile(outfname)):
+        with open(mfname) as f:
+            manifest = json.load(f)
+        if manifest['version'] == concat_version:
+            previous = manifest['clips']
+            target = manifest['target']
+    known = {c['fname']: c for c in previous}
+    clips = []
+    for fname in fnames:
+        if not os.path.isfile(fname):
+            log.error('Bad movie ' + fname)
+            continue
+        st = os.stat(fname)
+        c = known.get(fname)
+        if (c is None
+            or c['size'] != st.st_size
+            or c['mtime'] != st.st_mtime_ns):
+            info = stream_info(fname)
+            if info is None:
+                log.error('Bad movie ' + fname)
+                continue
+            c = {'fname': fname,
+                 'size': st.st_size,
+                 'mtime': st.st_mtime_ns,
+                 'sha1': checksum(fname),
+                 'info': info,
+                 'segment': None}
+        clips.append(c)
+    log.debug(str(len(clips)) + ' good movies found for ' + outfname)
+    if len(clips) == 0:
+        return
+    # Clips are copied if they have the streams most of them have
+    counts = Counter([json.dumps(c['info'], sort_keys=True) for c in clips])
+    new_target = json.loads(counts.most_common(1)[0][0])
+    if new_target != target:
+        # Segments were re-encoded for the old target
+        previous = []
+        target = new_target
+        for c in clips:
+            c['segment'] = None
+    for c in clips:
+        if c['info'] == target:
+            c['segment'] = c['fname']
+        elif c['segment'] is None or not os.path.isfile(c['segment']):
+            log.info('Re-encoding ' + c['fname'] + ' to match '
+                     + str(target))
+            c['segment'] = segment_fname(c['fname'])
+            reencode(c['fname'], c['segment'], target)
+    contents = [(c['fname'], c['sha1']) for c in clips]
+    previous_contents = [(c['fname'], c['sha1']) for c in previous]
+    if contents == previous_contents:
+        log.info('No changes to ' + outfname)
+        return
+    n = len(previous_contents)
+    if n > 0 and contents[0:n] == previous_contents:
+        log.info('Appending ' + str(len(clips) - n) + ' movies to '
+                 + outfname)
+        concat_copy([outfname] + [c['segment'] for c in clips[n:]],
+                    outfname)
+    else:
+        concat_copy([c['segment'] for c in clips], outfname)
+    with open(tmp_fname(mfname), 'w') as f:
+        json.dump({'version': concat_version,
+                   'target': target,
+                   'clips': clips}, f)
+    os.replace(tmp_fname(mfname), mfname)
+
+def concat_cmd(args):
+    concatenate(args.fnames, args.outfname, recalculate=args.recalculate)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Concatenate movies, without re-encoding those with matching streams, redoing only what has changed since the last time")
+    parser.add_argument('--recalculate', action='store_true',
+                        help='concatenate all of the movies again')
+    parser.add_argument('outfname', help='output movie')
+    parser.add_argument('fnames', nargs='+', help='movies to concatenate')
+    args = parser.parse_args()
+    concat_cmd(args)
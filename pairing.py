@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+
+"""
+Matching of on-band to off-band observations by time
+
+Times are float JD (e.g. mid-exposure), converted once by the caller.
+The off-band times are sorted once and each on-band time is located
+with np.searchsorted, so matching a night is O((N_on + N_off) log
+N_off) numpy work rather than N_on x N_off astropy Time arithmetic.
+Only numpy is needed, so policies can be tried out on plain arrays.
+Run this module to check them (see self_test).
+
+Policies
+--------
+nearest : off-band frame closest in time.  Ties go to the frame that
+    comes first in off_jd, like np.argmin
+nearest_before : latest off-band frame at or before the on-band frame,
+    or the nearest if there is none
+bracket : the off-band frames on either side of the on-band frame,
+    weighted for linear interpolation to its time.  Outside the range
+    of off_jd, the nearest frame with weight 1
+"""
+
+import argparse
+
+import numpy as np
+from astropy import log
+
+policies = ['nearest', 'nearest_before', 'bracket']
+
+def match(on_jd, off_jd, policy='nearest'):
+    """Returns (idx, weights), arrays of shape (len(on_jd), 2) of the
+    indices into off_jd of the off-band frames that go with each
+    on-band time and their weights.  Policies that pick one frame put
+    it in column 0 with weight 1 and repeat it in column 1 with weight
+    0"""
+    if policy not in policies:
+        raise ValueError('Unknown pairing policy ' + str(policy)
+                         + '.  Expecting one of ' + str(policies))
+    on_jd = np.atleast_1d(np.asarray(on_jd, dtype=float))
+    off_jd = np.asarray(off_jd, dtype=float)
+    if len(off_jd) == 0:
+        raise ValueError('No off-band times to match')
+    # Stable, so equal times stay in off_jd order
+    order = np.argsort(off_jd, kind='stable')
+    t = off_jd[order]
+    last = len(t) - 1
+    # Positions in t of the first frame after (or at) each on-band
+    # time and of the last frame before it.  Frames with equal
+    # times resolve to the first of them in off_jd order
+    after = np.searchsorted(t, on_jd, side='left')
+    before = np.searchsorted(t, on_jd, side='right') - 1
+    has_after = after <= last
+    has_before = before >= 0
+    after = np.minimum(after, last)
+    before = np.searchsorted(t, t[np.maximum(before, 0)], side='left')
+
+    dt_after = t[after] - on_jd
+    dt_before = on_jd - t[before]
+    use_after = has_after & (~has_before
+                             | (dt_after < dt_before)
+                             | ((dt_after == dt_before)
+                                & (order[after] < order[before])))
+    nearest = np.where(use_after, after, before)
+
+    weights = np.zeros((len(on_jd), 2))
+    weights[:, 0] = 1
+    if policy == 'nearest':
+        pos = np.stack((nearest, nearest), axis=1)
+    elif policy == 'nearest_before':
+        first = np.where(has_before, before, nearest)
+        pos = np.stack((first, first), axis=1)
+    else:
+        inside = has_before & has_after & (dt_before > 0)
+        first = np.where(inside, before, nearest)
+        second = np.where(inside, after, nearest)
+        span = t[second] - t[first]
+        w = np.zeros(len(on_jd))
+        np.divide(dt_before, span, out=w, where=inside & (span > 0))
+        weights[:, 0] = 1 - w
+        weights[:, 1] = w
+        pos = np.stack((first, second), axis=1)
+    return (order[pos], weights)
+
+def self_test():
+    """Check the policies on plain float JD arrays.  Raises
+    AssertionError on the first failure"""
+    # nearest: equal distances go to the frame first in off_jd
+    idx, w = match([1.5], [2.0, 1.0], 'nearest')
+    assert idx[0, 0] == 0, idx
+    idx, w = match([1.5], [1.0, 2.0], 'nearest')
+    assert idx[0, 0] == 0, idx
+    # ... also among frames with the same time
+    idx, w = match([1.2, 2.9], [3.0, 1.0, 1.0], 'nearest')
+    assert list(idx[:, 0]) == [1, 0], idx
+    assert np.all(w == [[1, 0], [1, 0]]), w
+    # nearest_before: latest frame at or before, nearest if none
+    idx, w = match([1.9, 2.0, 0.5], [1.0, 2.0], 'nearest_before')
+    assert list(idx[:, 0]) == [0, 1, 0], idx
+    assert np.all(idx[:, 0] == idx[:, 1]), idx
+    assert np.all(w == [1, 0]), w
+    # bracket: linear interpolation weights, nearest outside the range
+    idx, w = match([1.25, 2.0, 0.5, 3.5], [2.0, 1.0, 3.0], 'bracket')
+    assert idx[0].tolist() == [1, 0] and np.allclose(w[0], [0.75, 0.25]), \
+        (idx, w)
+    assert idx[1, 0] == 0 and w[1, 0] == 1, (idx, w)
+    assert idx[2, 0] == 1 and w[2, 0] == 1, (idx, w)
+    assert idx[3, 0] == 2 and w[3, 0] == 1, (idx, w)
+    rng = np.random.default_rng(0)
+    on_jd = rng.uniform(-1, 11, 1000)
+    off_jd = np.round(rng.uniform(0, 10, 50), 1)
+    for policy in policies:
+        idx, w = match(on_jd, off_jd, policy)
+        assert idx.shape == (len(on_jd), 2) and w.shape == idx.shape
+        assert np.allclose(np.sum(w, axis=1), 1), policy
+        assert np.all(w >= 0), policy
+    # The bracket interpolates to the on-band time
+    idx, w = match(on_jd, off_jd, 'bracket')
+    inside = (on_jd >= off_jd.min()) & (on_jd <= off_jd.max())
+    assert np.allclose(np.sum(w*off_jd[idx], axis=1)[inside],
+                       on_jd[inside])
+    # No on-band times, no matches
+    for policy in policies:
+        idx, w = match([], [1.0], policy)
+        assert idx.shape == (0, 2) and w.shape == (0, 2), policy
+    # No off-band times or unknown policy is an error
+    for policy in policies + ['closest']:
+        try:
+            match([1.0], [], policy)
+        except ValueError:
+            pass
+        else:
+            assert False, 'empty off_jd accepted by ' + policy
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the on/off-band pairing policies on synthetic times")
+    args = parser.parse_args()
+    self_test()
+    log.info('pairing policies ' + str(policies) + ' pass')
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+
+"""
+Low-overhead per-stage timing of the IoIO reduction
+
+Code wraps each stage of its work in "with stage(name):", which adds
+the time.perf_counter() time spent to a dictionary kept by this
+process: two clock reads and a dictionary update per stage, so it is
+cheap enough to leave on.  Stages should not nest, so that their times
+add up.  Like fits_access.io_stats, pool tasks take the times with
+stage_times() and return them to the parent process, where the times
+of many tasks are summarized per directory and across the tree,
+logged and appended as JSON-lines records to a file.  Run this module
+on that file to print the records
+"""
+
+import os
+import json
+import time
+import argparse
+import contextlib
+
+import numpy as np
+from astropy import log
+from astropy.time import Time
+
+# Order stages are reported in.  Any others go after these
+stages = ['read', 'background', 'ND_params', 'obj_center',
+          'shift_rotate', 'apertures', 'write']
+# FITS keywords to_header records stage times in
+header_keys = {'read': 'T_READ',
+               'background': 'T_BACK',
+               'ND_params': 'T_NDPAR',
+               'obj_center': 'T_OBJCEN',
+               'shift_rotate': 'T_SHIFT',
+               'apertures': 'T_APSUM',
+               'write': 'T_WRITE'}
+
+_times = {}
+
+@contextlib.contextmanager
+def stage(name):
+    """Context manager that adds the time spent in its block to stage
+    name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _times[name] = _times.get(name, 0) + time.perf_counter() - start
+
+def reset():
+    """Forget the stage times of this process"""
+    _times.clear()
+
+def stage_times():
+    """Returns dictionary of time (s) spent in each stage by this
+    process since the last reset"""
+    return dict(_times)
+
+def ordered(names):
+    """Returns names in stages order, unknown names last"""
+    return ([s for s in stages if s in names]
+            + sorted([s for s in names if s not in stages]))
+
+def to_header(header, times):
+    """Record times of stages that have keywords in header_keys in
+    header"""
+    for name in ordered(times):
+        key = header_keys.get(name)
+        if key is not None:
+            header[key] = (times[name], 'reduction time (s) in ' + name)
+
+def summarize(task_times, task_stage_times):
+    """Returns dictionary with the number of tasks, their total time
+    and the total time (s) of each stage, given the lists of the
+    elapsed time and stage_times() of each task.  Time not in any
+    stage is 'other'"""
+    totals = {}
+    for times in task_stage_times:
+        for name, t in times.items():
+            totals[name] = totals.get(name, 0) + t
+    elapsed = float(np.sum(task_times))
+    totals = {name: totals[name] for name in ordered(totals)}
+    totals['other'] = elapsed - sum(totals.values())
+    return {'ntasks': len(task_times),
+            'elapsed': elapsed,
+            'stages': totals}
+
+def log_summary(label, summary):
+    """Log the time per task of each stage of summary and its
+    fraction of the total"""
+    n = summary['ntasks']
+    elapsed = summary['elapsed']
+    if n == 0 or elapsed <= 0:
+        return
+    parts = [name + ' ' + '{:.3f}'.format(t/n) + ' ('
+             + '{:.0f}'.format(100*t/elapsed) + '%)'
+             for name, t in summary['stages'].items()]
+    log.info(label + ' stage times per pair (s): ' + ', '.join(parts))
+
+def write_record(fname, label, summary, tasks=None):
+    """Append JSON line with label (e.g. directory), summary and
+    optional list of per-task records to fname.  Does nothing if
+    fname is None"""
+    if fname is None:
+        return
+    rec = {'date': Time.now().fits,
+           'label': label}
+    rec.update(summary)
+    if tasks is not None:
+        rec['tasks'] = tasks
+    os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+    with open(fname, 'a') as f:
+        f.write(json.dumps(rec) + '\n')
+
+def read_records(fname):
+    """Returns list of records in fname"""
+    with open(fname) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def report_cmd(args):
+    for rec in read_records(args.fname)[-args.last:]:
+        n = rec['ntasks']
+        print(rec['date'] + ' ' + rec['label'] + ': ' + str(n)
+              + ' pairs, ' + '{:.1f}'.format(rec['elapsed']) + ' s')
+        if n == 0:
+            continue
+        for name, t in rec['stages'].items():
+            print('    {:14s}{:10.3f} s/pair'.format(name, t/n))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Print stage timing records written by ReduceCorObs.py")
+    parser.add_argument(
+        'fname', help='JSON-lines stage timing file')
+    parser.add_argument(
+        '--last', type=int, default=10,
+        help='number of most recent records to print, default 10')
+    args = parser.parse_args()
+    report_cmd(args)